@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for scenzgrid. Synthetic input rasters are created in a
+temporary directory and the core operations (file paths, coordinate
+reprojection, empty checks, warping of single cells, warp performance
+profiles, complete tiling runs and stacking) are timed. The results are written as JSON so that runs of
+different commits can be compared.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import numpy
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import osgeo.gdal as gdal
+from osgeo import osr
+
+from data_utils import *
+from warp_utils import *
+from cellarray_utils import *
+import benchstacktile
+
+# centre and pixel size of the synthetic rasters (central New Zealand)
+CRS_SETTINGS = {
+    'EPSG:2193': {'centre': (1750000., 5450000.), 'pixelsize': 100.},
+    'EPSG:4326': {'centre': (174.5, -41.), 'pixelsize': 0.001},
+}
+
+BENCHMARKS = ['filepath', 'reproject', 'isempty', 'warpcell', 'warpprofile', 'tiling', 'stacking']
+
+
+def timeRepeats(func, repeats, number = 1):
+    ''' Call func number times in each of repeats runs and return the
+    statistics of the run times per call in seconds '''
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        for n in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {'min': min(times), 'mean': sum(times) / len(times), 'max': max(times),
+            'repeats': repeats, 'number': number}
+
+
+def createSyntheticRaster(filename, size, crs, nodatafrac, driver = 'GTiff', bands = 1, nodata = -9999, seed = 0):
+    ''' Write a raster with a smooth random field. The nodata pixels form
+    coherent regions that cover nodatafrac of the raster.
+
+        @type size:     C{int}
+        @param size:    number of rows and columns
+        @type crs:      C{str}
+        @param crs:     one of CRS_SETTINGS
+        @type nodatafrac: C{float}
+        @param nodatafrac: fraction of nodata pixels (0-1)
+        @rtype:         C{str}
+        @return:        filename
+    '''
+    settings = CRS_SETTINGS[crs]
+    pixelsize = settings['pixelsize']
+    xmin = settings['centre'][0] - size * pixelsize / 2.
+    ymax = settings['centre'][1] + size * pixelsize / 2.
+    rng = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[0:size, 0:size] / float(size)
+    options = []
+    if driver == 'GTiff': options = ['TILED=YES']
+    dst_ds = gdal.GetDriverByName(driver).Create(filename, size, size, bands, gdal.GDT_Int16, options)
+    dst_ds.SetGeoTransform((xmin, pixelsize, 0, ymax, 0, -pixelsize))
+    dst_ds.SetProjection(getSpatialReference(crs).ExportToWkt())
+    for b in range(1, bands+1):
+        field = numpy.zeros((size, size))
+        for k in range(4):
+            fx, fy, phase = rng.uniform(1, 6, 3)
+            field += numpy.sin(2 * numpy.pi * (fx * x + phase)) * numpy.cos(2 * numpy.pi * (fy * y + phase))
+        array = (1000 + 500 * field + rng.normal(0, 20, (size, size))).astype(numpy.int16)
+        if nodatafrac >= 1:
+            array[:] = nodata # the quantile would leave the maximum of the field valid
+        elif nodatafrac > 0:
+            array[field < numpy.quantile(field, nodatafrac)] = nodata
+        band = dst_ds.GetRasterBand(b)
+        band.SetNoDataValue(nodata)
+        band.SetDescription('band%d' %(b))
+        band.WriteArray(array)
+    dst_ds = None
+    return filename
+
+
+def getGitCommit():
+    ''' Return the current commit of the repository or None '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def getRasterCentre(infile):
+    ''' Return lon/lat of the centre of a raster '''
+    ds = gdal.Open(infile, GA_ReadOnly)
+    gt = ds.GetGeoTransform()
+    x = gt[0] + gt[1] * ds.RasterXSize / 2.
+    y = gt[3] + gt[5] * ds.RasterYSize / 2.
+    src_srs = getSpatialReference(ds.GetProjection())
+    return reprojectCoords([[x, y]], src_srs, getSpatialReference('EPSG:4326'))[0]
+
+
+def benchFilePath(settings, workdir):
+    ''' Time getFilePath() and the vectorised getFilePaths() for cells of resolution 0 to 12 '''
+    cells = ['R' + ''.join([str((k * 7 + j) % 9) for j in range(k % 13)]) for k in range(10000)]
+    def run():
+        for cellstr in cells:
+            getFilePath(cellstr)
+    result = timeRepeats(run, settings['repeats'])
+    result['cells'] = len(cells)
+    codes = encodeCells(cells)
+    result['vectorised'] = timeRepeats(lambda: getFilePaths(codes), settings['repeats'])
+    return result
+
+
+def benchReproject(settings, workdir):
+    ''' Time reprojectCoords() of the corners of a raster extent from NZTM to lat/long '''
+    src_srs = getSpatialReference('EPSG:2193')
+    tgt_srs = getSpatialReference('EPSG:4326')
+    coords = [[1700000., 5400000.], [1700000., 5500000.], [1800000., 5500000.], [1800000., 5400000.]]
+    return timeRepeats(lambda: reprojectCoords(coords, src_srs, tgt_srs), settings['repeats'], 1000)
+
+
+def benchIsEmpty(settings, workdir):
+    ''' Time isEmpty() of a completely empty and of a valid tile '''
+    results = {}
+    for name, nodatafrac in [('empty', 1.), ('valid', 0.)]:
+        filename = createSyntheticRaster(os.path.join(workdir, 'isempty_%s.kea' %(name)), settings['tilesize'],
+                                         'EPSG:2193', nodatafrac, driver = 'KEA')
+        assert isEmpty(filename) == (name == 'empty'), 'synthetic %s tile misclassified' %(name)
+        results[name] = timeRepeats(lambda: isEmpty(filename), settings['repeats'])
+    return results
+
+
+def benchWarpCell(settings, workdir, infile):
+    ''' Time the in-process warping of the maxres cell at the centre of the input '''
+    rddgs = getStandardDGGS()
+    lon, lat = getRasterCentre(infile)
+    c = rddgs.cell_from_point(settings['maxres'], (lon, lat), plane = False)
+    ds = gdal.Open(infile, GA_ReadOnly)
+    s_srs = ds.GetProjection()
+    ds = None
+    warper = TileWarper(infile, s_srs, getStandardProj4(), -9999, settings['tilesize'], 243, settings['resample'])
+    filepath = os.path.join(workdir, 'warpcell.kea')
+    def run():
+        if os.path.exists(filepath): os.remove(filepath)
+        warpCell(warper, filepath, getCellBounds(c), None)
+    result = timeRepeats(run, settings['repeats'])
+    warper.close()
+    result['cell'] = str(c)
+    return result
+
+
+def compareWarps(reference, arrays, nodata):
+    ''' Return the differences of warped tiles to reference tiles: the RMSE and
+    maximum absolute difference over the pixels valid in both and the fraction
+    of pixels that are valid in only one of them '''
+    sumsq = 0.
+    maxdiff = 0.
+    common = 0
+    mismatch = 0
+    total = 0
+    for refarray, array in zip(reference, arrays):
+        if refarray is None or array is None: continue
+        refvalid = getValidMask(refarray, nodata)
+        valid = getValidMask(array, nodata)
+        both = refvalid & valid
+        diff = refarray[both].astype(numpy.float64) - array[both]
+        if diff.size:
+            sumsq += float((diff ** 2).sum())
+            maxdiff = max(maxdiff, float(numpy.abs(diff).max()))
+        common += int(both.sum())
+        mismatch += int((refvalid != valid).sum())
+        total += refarray.size
+    return {'rmse': (sumsq / common) ** 0.5 if common else None, 'maxdiff': maxdiff,
+            'mismatch': mismatch / float(total) if total else None, 'pixels': common}
+
+
+def benchWarpProfile(settings, workdir, infile):
+    ''' Warp the same maxres cells with every warp performance profile and report
+    their throughput and their differences to exact transformation '''
+    rddgs = getStandardDGGS()
+    nw, se = getLonLatExtent(infile)
+    cells = [c for row in rddgs.cells_from_region(settings['maxres'], nw, se, plane = False) for c in row]
+    step = max(1, len(cells) // settings['profilecells'])
+    bounds = [getCellBounds(c) for c in cells[::step][:settings['profilecells']]]
+    ds = gdal.Open(infile, GA_ReadOnly)
+    s_srs = ds.GetProjection()
+    ds = None
+    nodata = -9999
+    cachemax = gdal.GetCacheMax() # profiles change the block cache of the process
+    def warpAll(profile):
+        warper = TileWarper(infile, s_srs, getStandardProj4(), nodata, settings['tilesize'], 243,
+                            settings['resample'], profile = profile)
+        arrays = [warper.warpArray(b) for b in bounds]
+        warper.close()
+        gdal.SetCacheMax(cachemax)
+        return arrays
+    reference = warpAll(getWarpProfile('exact'))
+    results = {}
+    for name in settings['profiles']:
+        profile = getWarpProfile(name)
+        arrays = []
+        def run():
+            arrays[:] = warpAll(profile)
+        result = timeRepeats(run, settings['repeats'])
+        result['tiles'] = len(bounds)
+        result['tilespersecond'] = len(bounds) / result['min']
+        result['megapixelspersecond'] = len(bounds) * settings['tilesize'] ** 2 / result['min'] / 1e6
+        result.update(compareWarps(reference, arrays, nodata))
+        result['profile'] = profile
+        results[name] = result
+    print('%-10s %10s %10s %12s %10s %10s' %('profile', 'tiles/s', 'MPixel/s', 'RMSE', 'max diff', 'mismatch'))
+    for name in settings['profiles']:
+        result = results[name]
+        print('%-10s %10.2f %10.2f %12s %10.3f %10s' %(name, result['tilespersecond'], result['megapixelspersecond'],
+              'n/a' if result['rmse'] is None else '%.4f' %(result['rmse']), result['maxdiff'],
+              'n/a' if result['mismatch'] is None else '%.2e' %(result['mismatch'])))
+    return results
+
+
+def benchTiling(settings, workdir, infile):
+    ''' Time complete runs of tilerasterlayer.py for maximum resolutions 0 to maxres '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tilerasterlayer.py')
+    results = {}
+    for maxres in range(settings['maxres']+1):
+        outdir = os.path.join(workdir, 'tiles_%d' %(maxres))
+        cmd = [sys.executable, script, infile, outdir, '0', str(maxres), '--clean',
+               '-t', str(settings['tilesize']), '-r', settings['resample']] + settings['tilingoptions']
+        def run():
+            subprocess.check_call(cmd, stdout = subprocess.DEVNULL)
+        results[str(maxres)] = timeRepeats(run, settings['repeats'])
+        results[str(maxres)]['tiles'] = sum([len([f for f in files if f.endswith('.kea')])
+                                             for root, dirs, files in os.walk(outdir)])
+        shutil.rmtree(outdir)
+    return results
+
+
+def benchStacking(settings, workdir):
+    ''' Time stackCells() for different numbers of layers, see benchstacktile.py '''
+    results = {}
+    cells = ['R7%d%d' %(k // 9, k % 9) for k in range(settings['stackcells'])]
+    for layers in settings['layers']:
+        indir = os.path.join(workdir, 'layers_%d' %(layers))
+        inputs = benchstacktile.createLayers(indir, cells, layers, 1, settings['tilesize'], 243)
+        results[str(layers)] = {}
+        for method, rios in [('rios', True), ('direct', False)]:
+            runs = [benchstacktile.runStacking(cells, indir, os.path.join(workdir, 'stacks'), inputs, rios)
+                    for r in range(settings['repeats'])]
+            seconds = [run[0] for run in runs]
+            results[str(layers)][method] = {'min': min(seconds), 'mean': sum(seconds) / len(seconds),
+                                            'max': max(seconds), 'repeats': len(seconds),
+                                            'peakbytes': max([run[1] for run in runs]), 'cells': len(cells)}
+        shutil.rmtree(indir)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outfile", type = str, help="Specify the JSON file for the results.")
+    parser.add_argument("-b", "--benchmarks", help="Comma separated list of benchmarks (default: %s)" %(','.join(BENCHMARKS)))
+    parser.add_argument("-s", "--size", type = int, help="Number of rows and columns of the synthetic input (default: 2000)")
+    parser.add_argument("-c", "--crs", help="CRS of the synthetic input: EPSG:2193 (NZTM, default) or EPSG:4326")
+    parser.add_argument("-f", "--format", help="Format of the synthetic input: GTiff (default) or KEA")
+    parser.add_argument("-n", "--nodatafrac", type = float, help="Fraction of nodata pixels in the synthetic input (default: 0.3)")
+    parser.add_argument("-m", "--maxres", type = int, help="Maximum resolution of the tiling runs (default: 6)")
+    parser.add_argument("-t", "--tilesize", type = int, help="Tile size (default: 729)")
+    parser.add_argument("-r", "--resamplingmethod", help="Resampling method (default: cubic)")
+    parser.add_argument("-l", "--layers", help="Comma separated numbers of layers for stacking (default: 2,10,50,200)")
+    parser.add_argument("-p", "--profiles", help="Comma separated warp profiles to compare (default: %s)" %(','.join(sorted(WARP_PROFILES))))
+    parser.add_argument("--profilecells", type = int, help="Number of maxres cells warped per profile (default: 20)")
+    parser.add_argument("--stackcells", type = int, help="Number of cells stacked per run (default: 2)")
+    parser.add_argument("--repeats", type = int, help="Number of runs of every benchmark (default: 3)")
+    parser.add_argument("--tilingoptions", help="Additional options for tilerasterlayer.py, e.g. '-p local'")
+    parser.add_argument("--workdir", help="Directory for the synthetic data (default: temporary directory)")
+
+    args = parser.parse_args()
+
+    settings = {'size': 2000, 'crs': 'EPSG:2193', 'format': 'GTiff', 'nodatafrac': 0.3, 'maxres': 6,
+                'tilesize': 729, 'resample': 'cubic', 'layers': [2, 10, 50, 200], 'stackcells': 2,
+                'profiles': sorted(WARP_PROFILES), 'profilecells': 20,
+                'repeats': 3, 'tilingoptions': []}
+    if args.size: settings['size'] = int(args.size)
+    if args.crs: settings['crs'] = args.crs
+    if args.format: settings['format'] = args.format
+    if args.nodatafrac is not None: settings['nodatafrac'] = float(args.nodatafrac)
+    if args.maxres is not None: settings['maxres'] = int(args.maxres)
+    if args.tilesize: settings['tilesize'] = int(args.tilesize)
+    if args.resamplingmethod: settings['resample'] = args.resamplingmethod
+    if args.layers: settings['layers'] = [int(l) for l in args.layers.split(',')]
+    if args.profiles: settings['profiles'] = args.profiles.split(',')
+    if args.profilecells: settings['profilecells'] = int(args.profilecells)
+    if args.stackcells: settings['stackcells'] = int(args.stackcells)
+    if args.repeats: settings['repeats'] = int(args.repeats)
+    if args.tilingoptions: settings['tilingoptions'] = args.tilingoptions.split()
+    if settings['crs'] not in CRS_SETTINGS:
+        print("Error: CRS has to be one of %s" %(', '.join(sorted(CRS_SETTINGS))))
+        sys.exit()
+    for name in settings['profiles']:
+        if name not in WARP_PROFILES:
+            print("Error: warp profile has to be one of %s" %(', '.join(sorted(WARP_PROFILES))))
+            sys.exit()
+    if args.benchmarks:
+        benchmarks = args.benchmarks.split(',')
+    else:
+        benchmarks = BENCHMARKS
+
+    results = {'commit': getGitCommit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'gdal': gdal.VersionInfo('RELEASE_NAME'), 'python': platform.python_version(),
+               'host': platform.node(), 'settings': settings, 'results': {}}
+    workdir = tempfile.mkdtemp(prefix = 'benchmark_', dir = args.workdir)
+    try:
+        extension = {'GTiff': '.tif', 'KEA': '.kea'}[settings['format']]
+        infile = createSyntheticRaster(os.path.join(workdir, 'input' + extension), settings['size'], settings['crs'],
+                                       settings['nodatafrac'], driver = settings['format'])
+        for name in benchmarks:
+            start = time.time()
+            if name == 'filepath': result = benchFilePath(settings, workdir)
+            elif name == 'reproject': result = benchReproject(settings, workdir)
+            elif name == 'isempty': result = benchIsEmpty(settings, workdir)
+            elif name == 'warpcell': result = benchWarpCell(settings, workdir, infile)
+            elif name == 'warpprofile': result = benchWarpProfile(settings, workdir, infile)
+            elif name == 'tiling': result = benchTiling(settings, workdir, infile)
+            elif name == 'stacking': result = benchStacking(settings, workdir)
+            else:
+                print('Unknown benchmark: %s' %(name))
+                continue
+            results['results'][name] = result
+            print('%s finished in %g seconds' %(name, time.time() - start))
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(args.outfile, mode='w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=1, sort_keys=True)
+    print('Results written to %s' %(args.outfile))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Benchmark of the stacking of single cells: RIOS stacking against the
+single-pass GDAL stacking of stacktile.py. Synthetic layer tiles are created
+in a temporary directory; reported are the run time, the peak memory
+allocated by numpy and python and the number of files opened per cell
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import numpy
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import osgeo.gdal as gdal
+
+from data_utils import *
+import stacktile
+
+# number of gdal.Open calls, see countOpens()
+_opens = [0]
+
+def countOpens():
+    """
+    Replaces gdal.Open by a wrapper that counts the opened files; RIOS and
+    stacktile both look up gdal.Open at call time
+    """
+    gdalopen = gdal.Open
+    def countingOpen(*args, **kwargs):
+        _opens[0] += 1
+        return gdalopen(*args, **kwargs)
+    gdal.Open = countingOpen
+
+def createLayers(indir, cells, layers, bands, tilesize, blocksize):
+    """
+    Writes random KEA tiles for every cell and layer and returns the inputs of
+    every cell as (layer name, tile, band descriptions) tuples
+    """
+    rddgs = getStandardDGGS()
+    t_srs = getStandardProj4()
+    inputs = {}
+    for cellstr in cells:
+        xmin, ymin, xmax, ymax = getCellBounds(getCell(rddgs, cellstr))
+        inputs[cellstr] = []
+        for l in range(layers):
+            layername = 'layer%03d' %(l)
+            filepath = os.path.join(indir, layername, getFilePath(cellstr))
+            if not os.path.exists(os.path.dirname(filepath)): os.makedirs(os.path.dirname(filepath))
+            dst_ds = gdal.GetDriverByName('KEA').Create(filepath, tilesize, tilesize, bands, gdal.GDT_Int16,
+                                                        ['IMAGEBLOCKSIZE=%d' %(blocksize)])
+            dst_ds.SetGeoTransform((xmin, (xmax - xmin) / tilesize, 0, ymax, 0, -(ymax - ymin) / tilesize))
+            dst_ds.SetProjection(t_srs)
+            names = []
+            for b in range(1, bands+1):
+                band = dst_ds.GetRasterBand(b)
+                band.SetDescription('band%d' %(b))
+                band.SetNoDataValue(-9999)
+                band.WriteArray(numpy.random.randint(0, 10000, (tilesize, tilesize)).astype(numpy.int16))
+                names.append('band%d' %(b))
+            dst_ds = None
+            inputs[cellstr].append((layername, filepath, names))
+    return inputs
+
+def runStacking(cells, indir, outdir, inputs, rios):
+    """
+    Stacks all cells and returns (seconds, peak bytes, opened files)
+    """
+    if os.path.exists(outdir): shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    _opens[0] = 0
+    tracemalloc.start()
+    start = time.time()
+    statuses = stacktile.stackCells(cells, indir, outdir, inputs = inputs, rios = rios)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    failed = [cellstr for cellstr in statuses if statuses[cellstr] != 'done']
+    if failed: print('Stacking failed for: %s' %(' '.join(failed)))
+    return elapsed, peak, _opens[0]
+
+def checkStacks(cells, riosdir, directdir):
+    """
+    Returns True if both methods created identical stacks
+    """
+    for cellstr in cells:
+        a = gdal.Open(os.path.join(riosdir, getFilePath(cellstr)))
+        b = gdal.Open(os.path.join(directdir, getFilePath(cellstr)))
+        if a.RasterCount != b.RasterCount or not numpy.array_equal(a.ReadAsArray(), b.ReadAsArray()):
+            return False
+        for k in range(1, a.RasterCount+1):
+            if a.GetRasterBand(k).GetDescription() != b.GetRasterBand(k).GetDescription():
+                return False
+    return True
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cells", type = int, help="Number of cells (default: 4)")
+    parser.add_argument("-l", "--layers", type = int, help="Number of layers (default: 10)")
+    parser.add_argument("-b", "--bands", type = int, help="Number of bands per layer (default: 1)")
+    parser.add_argument("-t", "--tilesize", type = int, help="Tile size (default: 729)")
+    parser.add_argument("-r", "--repeats", type = int, help="Number of runs of each method (default: 3)")
+    parser.add_argument("-o", "--outfile", help="Write the results to a JSON file")
+    parser.add_argument("--workdir", help="Directory for the synthetic data (default: temporary directory)")
+
+    args = parser.parse_args()
+
+    if args.cells: ncells = int(args.cells)
+    else: ncells = 4
+    if args.layers: layers = int(args.layers)
+    else: layers = 10
+    if args.bands: bands = int(args.bands)
+    else: bands = 1
+    if args.tilesize: tilesize = int(args.tilesize)
+    else: tilesize = 729
+    if args.repeats: repeats = int(args.repeats)
+    else: repeats = 3
+
+    workdir = tempfile.mkdtemp(prefix = 'benchstacktile_', dir = args.workdir)
+    try:
+        indir = os.path.join(workdir, 'layers')
+        cells = ['R7%d' %(k % 9) + str(k // 9) for k in range(ncells)]
+        inputs = createLayers(indir, cells, layers, bands, tilesize, 243)
+        countOpens()
+        results = {'cells': ncells, 'layers': layers, 'bands': bands, 'tilesize': tilesize}
+        for method, rios in [('rios', True), ('direct', False)]:
+            runs = [runStacking(cells, indir, os.path.join(workdir, method), inputs, rios) for r in range(repeats)]
+            results[method] = {'seconds': min([run[0] for run in runs]),
+                               'peakbytes': max([run[1] for run in runs]),
+                               'opens_per_cell': runs[-1][2] / float(ncells)}
+            print('%-6s: %8.3f s  peak memory %8.1f MB  %5.1f files opened per cell'
+                  %(method, results[method]['seconds'], results[method]['peakbytes'] / 1048576.,
+                    results[method]['opens_per_cell']))
+        results['identical'] = checkStacks(cells, os.path.join(workdir, 'rios'), os.path.join(workdir, 'direct'))
+        print('identical output: %s' %(results['identical']))
+        if args.outfile:
+            with open(args.outfile, mode='w', encoding='utf-8') as outfile:
+                json.dump(results, outfile, indent=1)
+    finally:
+        shutil.rmtree(workdir)
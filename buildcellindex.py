@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Creates the persistent cell index of a region for tilerasterlayer.py and
+stacklayers.py (option --cellindex)
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import argparse
+
+from osgeo import ogr
+
+from data_utils import *
+from cellindex_utils import *
+
+
+if __name__ == '__main__':
+    start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outfile", type = str, help="Specify the cell index file (SQLite).")
+    parser.add_argument("minres", type = int, help="Specify the minimum grid resolution.")
+    parser.add_argument("maxres", type = int, help="Specify the maximum grid resolution.")
+    parser.add_argument("-g", "--globalex", help="Index global coverage (default: False).", action ="store_true")
+    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines the extent")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+
+    args = parser.parse_args()
+
+    if args.outfile == None:
+        print("Error: no output file specified")
+        sys.exit()
+    outfile = args.outfile
+
+    if args.minres == None:
+        print("Error: minres not specified")
+        sys.exit()
+    minresolution = int(args.minres)
+
+    if args.maxres == None:
+        print("Error: maxres not specified")
+        sys.exit()
+    maxresolution = int(args.maxres)
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False
+
+    if args.globalex:
+        nw = [-180, 90]
+        se = [180, -90]
+    else:
+        if args.shapefile:
+            inShapefile = str(args.shapefile)
+        else: # use NZ coastline as default
+            inShapefile = '/projects/landcare00031/data/AOIs/nzcoast.shp'
+        # Get a Layer's Extent; shapefile has to use lat/long
+        inDriver = ogr.GetDriverByName("ESRI Shapefile")
+        inDataSource = inDriver.Open(inShapefile, 0)
+        inLayer = inDataSource.GetLayer()
+        ext = inLayer.GetExtent()
+        nw = [ext[0], ext[3]]
+        se = [ext[1], ext[2]]
+
+    rddgs = getStandardDGGS()
+    total = buildCellIndex(outfile, rddgs, minresolution, maxresolution, nw, se, debug)
+    print('%d cells indexed' %(total))
+
+    elapsed = time.time() - start
+    print('Elapsed time (buildcellindex): %g seconds' %(elapsed))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Vectorised handling of whole resolutions of rHEALPix cells. Cells are encoded
+as single integers so that sets of cells can be stored, sorted and compared as
+NumPy arrays; names, file paths, parents, children and plane bounds are
+derived for all cells of an array at once.
+
+The code of a cell of resolution r on face f (index into FACES) with the
+subcell digits d_1 ... d_r is (f + 1) * 9**r + d_1 d_2 ... d_r read as a
+base 9 number. The codes of resolution r lie in [9**r, 7 * 9**r), so the
+resolution follows from the code, the parent is code // 9 and the children
+are code * 9 + d. Codes fit into int64 up to resolution MAX_RESOLUTION.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy
+
+from data_utils import *
+
+# names of the resolution 0 cells in the order of rhealpix_dggs
+FACES = 'NOPQRS'
+MAX_RESOLUTION = 18
+POWERS9 = numpy.array([9**r for r in range(MAX_RESOLUTION+2)], dtype = numpy.int64)
+POWERS3 = numpy.array([3**r for r in range(MAX_RESOLUTION+1)], dtype = numpy.int64)
+
+
+def getResolutions(codes):
+    ''' Return the resolution of every cell code '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    return numpy.searchsorted(POWERS9, codes, side = 'right') - 1
+
+
+def encodeCells(cells):
+    ''' Return the codes of a list of cells or cell names, e.g. ['R7', 'S102033']
+
+        @type cells:    C{list}
+        @param cells:   rHEALPix cells or their names
+        @rtype:         C{numpy.ndarray}
+        @return:        int64 codes
+    '''
+    names = [str(c) for c in cells]
+    codes = numpy.empty(len(names), dtype = numpy.int64)
+    for k in range(len(names)):
+        codes[k] = int(str(FACES.index(names[k][0]) + 1) + names[k][1:], 9) if len(names[k]) > 1 \
+            else FACES.index(names[k][0]) + 1
+    return codes
+
+
+def getDigits(codes, res):
+    ''' Return the face indices and the (cells, res) array of subcell digits of
+    codes that all have the resolution res '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    digits = numpy.empty((len(codes), res), dtype = numpy.int64)
+    rest = codes.copy()
+    for k in range(res-1, -1, -1):
+        digits[:, k] = rest % 9
+        rest //= 9
+    return rest - 1, digits
+
+
+def splitLevels(codes):
+    ''' Return [(res, indices)] for the resolutions present in an array of codes '''
+    resolutions = getResolutions(codes)
+    return [(res, numpy.nonzero(resolutions == res)[0]) for res in numpy.unique(resolutions)]
+
+
+def decodeLevel(codes, res, suffix = '', separators = ()):
+    ''' Return the names of codes of one resolution as array of strings.
+    A separator is inserted before every digit position in separators and
+    suffix is appended; used for names and file paths alike. '''
+    faces, digits = getDigits(codes, res)
+    chars = [numpy.frombuffer(FACES.encode('ascii'), dtype = numpy.uint8)[faces]]
+    for k in range(res):
+        if k in separators: chars.append(numpy.full(len(codes), ord(os.sep), dtype = numpy.uint8))
+        chars.append((digits[:, k] + ord('0')).astype(numpy.uint8))
+    for char in suffix.encode('ascii'):
+        chars.append(numpy.full(len(codes), char, dtype = numpy.uint8))
+    array = numpy.ascontiguousarray(numpy.stack(chars, axis = 1))
+    return array.view('S%d' %(array.shape[1])).ravel().astype(str)
+
+
+def decodeCells(codes):
+    ''' Return the names of cell codes as array of strings '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    names = numpy.empty(len(codes), dtype = 'U%d' %(MAX_RESOLUTION+1))
+    for res, indices in splitLevels(codes):
+        names[indices] = decodeLevel(codes[indices], res)
+    return names
+
+
+def getFilePaths(codes, outfileroot = None):
+    ''' Return the file paths of cell codes as array of strings, identical to
+    data_utils.getFilePath() (prefixed by outfileroot if given) '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    paths = []
+    order = []
+    for res, indices in splitLevels(codes):
+        # a directory for the face and for every complete group of three digits except the last group
+        separators = tuple([0] + [3*g for g in range(1, (res-1) // 3 + 1)]) if res > 0 else ()
+        paths.append(decodeLevel(codes[indices], res, '.kea', separators))
+        order.append(indices)
+    if not paths:
+        return numpy.array([], dtype = str)
+    result = numpy.empty(len(codes), dtype = max([level.dtype for level in paths]))
+    for level, indices in zip(paths, order):
+        result[indices] = level
+    if outfileroot is not None:
+        result = numpy.char.add(os.path.join(outfileroot, ''), result)
+    return result
+
+def getParents(codes):
+    ''' Return the codes of the parent cells '''
+    return numpy.asarray(codes, dtype = numpy.int64) // 9
+
+
+def getChildren(codes):
+    ''' Return the (cells, 9) codes of the subcells, in the order of Cell.subcells() '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    return codes[:, numpy.newaxis] * 9 + numpy.arange(9, dtype = numpy.int64)
+
+
+def getFaceRowCol(codes):
+    ''' Return (face, row, col, res) of cell codes; row and col count the cells
+    of the resolution within the face from its upper left corner '''
+    codes = numpy.asarray(codes, dtype = numpy.int64)
+    resolutions = getResolutions(codes)
+    faces = numpy.empty(len(codes), dtype = numpy.int64)
+    rows = numpy.zeros(len(codes), dtype = numpy.int64)
+    cols = numpy.zeros(len(codes), dtype = numpy.int64)
+    for res, indices in splitLevels(codes):
+        faces[indices], digits = getDigits(codes[indices], res)
+        for k in range(res):
+            rows[indices] = rows[indices] * 3 + digits[:, k] // 3
+            cols[indices] = cols[indices] * 3 + digits[:, k] % 3
+    return faces, rows, cols, resolutions
+
+
+def fromFaceRowCol(faces, rows, cols, resolutions):
+    ''' Return the codes of cells given by (face, row, col, res), the inverse of
+    getFaceRowCol(); scalars are broadcast '''
+    faces, rows, cols, resolutions = numpy.broadcast_arrays(*[numpy.asarray(a, dtype = numpy.int64)
+                                                              for a in (faces, rows, cols, resolutions)])
+    codes = faces + 1
+    for k in range(resolutions.max(initial = 0)):
+        active = resolutions > k # cells that have a k-th digit
+        shift = POWERS3[numpy.maximum(resolutions - 1 - k, 0)]
+        digit = (rows // shift % 3) * 3 + cols // shift % 3
+        codes = numpy.where(active, codes * 9 + digit, codes)
+    return codes
+
+
+def getFaceBounds(rddgs):
+    ''' Return the (6, 4) plane bounds (xmin, ymin, xmax, ymax) of the
+    resolution 0 cells of a DGGS in the order of FACES '''
+    return numpy.array([getCellBounds(getCell(rddgs, face)) for face in FACES])
+
+
+def getPlaneBounds(codes, facebounds):
+    ''' Return the (cells, 4) plane bounds (xmin, ymin, xmax, ymax) of cell
+    codes, computed from the bounds of the faces, see getFaceBounds() '''
+    faces, rows, cols, resolutions = getFaceRowCol(codes)
+    origins = facebounds[faces]
+    width = (origins[:, 2] - origins[:, 0]) / POWERS3[resolutions]
+    height = (origins[:, 3] - origins[:, 1]) / POWERS3[resolutions]
+    xmin = origins[:, 0] + cols * width
+    ymax = origins[:, 3] - rows * height
+    return numpy.column_stack([xmin, ymax - height, xmin + width, ymax])
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Persistent index of the cells of a region of the standard rHEALPix DGGS. The
+cell names, plane bounds, parents and file paths of all resolutions are stored
+in a SQLite database once, so that later runs enumerate regions with a range
+query instead of computing the geometry of every cell again
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import sqlite3
+
+from data_utils import *
+
+# number of cells written to the database at once
+INSERT_CHUNK = 10000
+
+
+class IndexedCell(object):
+    """
+    Lightweight stand-in for rhealpix_dggs.dggs.Cell that is read from the cell
+    index. Provides the name, the plane vertices and the subcells, i.e.
+    everything the tiling and stacking scripts need.
+    """
+
+    def __init__(self, cellstr, bounds):
+        self.cellstr = cellstr
+        self.bounds = bounds
+
+    def __str__(self):
+        return self.cellstr
+
+    def __repr__(self):
+        return self.cellstr
+
+    def vertices(self, plane = True):
+        ''' Return the plane vertices in the order of Cell.vertices(): upper left,
+        upper right, lower right and lower left. The index only holds plane
+        coordinates, so plane = False is not supported. '''
+        if not plane:
+            raise ValueError('IndexedCell %s only has plane vertices' %(self.cellstr))
+        xmin, ymin, xmax, ymax = self.bounds
+        return [(xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]
+
+    def subcells(self):
+        ''' Generate the 3x3 subcells, numbered row by row from the upper left
+        like the subcells of rHEALPix cells '''
+        xmin, ymin, xmax, ymax = self.bounds
+        width = (xmax - xmin) / 3.
+        height = (ymax - ymin) / 3.
+        for d in range(9):
+            row = d // 3
+            col = d % 3
+            yield IndexedCell(self.cellstr + str(d), (xmin + col*width, ymax - (row+1)*height,
+                                                       xmin + (col+1)*width, ymax - row*height))
+
+
+def getLonLatBounds(cell):
+    ''' Return (lonmin, latmin, lonmax, latmax) of a rHEALPix cell. Cells that
+    contain a pole or cross the antimeridian span all longitudes. '''
+    vertices = cell.vertices(plane = False)
+    lons = [v[0] for v in vertices]
+    lats = [v[1] for v in vertices]
+    lonmin, lonmax = min(lons), max(lons)
+    latmin, latmax = min(lats), max(lats)
+    if cell.ellipsoidal_shape() == 'cap':
+        if latmax > 0: latmax = 90.
+        else: latmin = -90.
+        lonmin, lonmax = -180., 180.
+    elif lonmax - lonmin > 180.:
+        lonmin, lonmax = -180., 180.
+    return (lonmin, latmin, lonmax, latmax)
+
+
+def buildCellIndex(filename, rddgs, minres, maxres, nw, se, debug = False):
+    ''' Write the index of all cells of a region between minres and maxres
+
+        @type filename: C{str}
+        @param filename: SQLite database; an existing file is replaced
+        @type rddgs:    C{rhealpix_dggs.dggs.RHEALPixDGGS}
+        @param rddgs:   DGGS, see data_utils.getStandardDGGS()
+        @type nw:       C{list}
+        @param nw:      [lon, lat] of the north-west corner of the region
+        @type se:       C{list}
+        @param se:      [lon, lat] of the south-east corner of the region
+        @rtype:         C{int}
+        @return:        number of indexed cells
+    '''
+    if os.path.exists(filename): os.remove(filename)
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE cells (res INTEGER, cellid TEXT PRIMARY KEY, gridrow INTEGER, '
+                 'xmin REAL, ymin REAL, xmax REAL, ymax REAL, '
+                 'lonmin REAL, latmin REAL, lonmax REAL, latmax REAL, parent TEXT, path TEXT)')
+    total = 0
+    for i in range(minres, maxres+1):
+        grid = rddgs.cells_from_region(i, nw, se, plane=False)
+        rows = []
+        for r in range(len(grid)):
+            for c in grid[r]:
+                cellstr = str(c)
+                if i > 0: parent = cellstr[:-1]
+                else: parent = None
+                rows.append((i, cellstr, r) + getCellBounds(c) + getLonLatBounds(c) + (parent, getFilePath(cellstr)))
+                if len(rows) >= INSERT_CHUNK:
+                    conn.executemany('INSERT INTO cells VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+                    total += len(rows)
+                    rows = []
+        conn.executemany('INSERT INTO cells VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        total += len(rows)
+        if debug: print('Resolution %d indexed (%d cells so far)' %(i, total))
+    conn.execute('CREATE INDEX cells_region ON cells (res, latmin, latmax, lonmin, lonmax)')
+    conn.execute('CREATE INDEX cells_parent ON cells (parent)')
+    meta = {'minres': minres, 'maxres': maxres, 'nw': list(nw), 'se': list(se),
+            'central_meridian': CENTRAL_MERIDIAN, 'north_square': N_SQUARE, 'south_square': S_SQUARE}
+    conn.executemany('INSERT INTO meta VALUES (?,?)', [(key, json.dumps(meta[key])) for key in meta])
+    conn.commit()
+    conn.close()
+    return total
+
+
+class CellIndex(object):
+    """
+    Read access to a cell index written by buildCellIndex(). Offers
+    cells_from_region() like RHEALPixDGGS and answers it from the database
+    if the region is covered by the index; otherwise the cells are computed
+    by the DGGS as before.
+    """
+
+    def __init__(self, filename, rddgs = None, debug = False):
+        if not os.path.exists(filename):
+            raise IOError('Could not open the cell index: %s' %(filename))
+        self.filename = filename
+        self.rddgs = rddgs
+        self.debug = debug
+        self.conn = sqlite3.connect(filename)
+        self.meta = dict([(key, json.loads(value)) for key, value in self.conn.execute('SELECT key, value FROM meta')])
+        if [self.meta['central_meridian'], self.meta['north_square'], self.meta['south_square']] != \
+           [CENTRAL_MERIDIAN, N_SQUARE, S_SQUARE]:
+            raise ValueError('Cell index %s was built for another DGGS' %(filename))
+
+    def covers(self, res, nw, se):
+        ''' Returns True if the index contains all cells of the region at resolution res '''
+        if res < self.meta['minres'] or res > self.meta['maxres']:
+            return False
+        inw = self.meta['nw']
+        ise = self.meta['se']
+        return nw[0] >= inw[0] and nw[1] <= inw[1] and se[0] <= ise[0] and se[1] >= ise[1]
+
+    def cells_from_region(self, res, nw, se, plane = False):
+        ''' Return the cells of a region at resolution res as list of rows of
+        IndexedCell objects. The region of the index itself is answered exactly;
+        for smaller regions all cells whose longitude/latitude bounds intersect
+        the region are returned. '''
+        if plane or not self.covers(res, nw, se):
+            if self.rddgs is None:
+                raise ValueError('Region is not covered by the cell index %s' %(self.filename))
+            if self.debug: print('Resolution %d: region not covered by the cell index' %(res))
+            return self.rddgs.cells_from_region(res, nw, se, plane = plane)
+        query = 'SELECT gridrow, cellid, xmin, ymin, xmax, ymax FROM cells WHERE res = ?'
+        params = [res]
+        if list(nw) != self.meta['nw'] or list(se) != self.meta['se']:
+            query = query + ' AND latmax >= ? AND latmin <= ? AND lonmax >= ? AND lonmin <= ?'
+            params = params + [se[1], nw[1], nw[0], se[0]]
+        grid = []
+        lastrow = None
+        for gridrow, cellid, xmin, ymin, xmax, ymax in self.conn.execute(query + ' ORDER BY rowid', params):
+            if gridrow != lastrow:
+                grid.append([])
+                lastrow = gridrow
+            grid[-1].append(IndexedCell(cellid, (xmin, ymin, xmax, ymax)))
+        return grid
+
+    def getCell(self, cellstr):
+        ''' Return the indexed cell of a cell name or None '''
+        row = self.conn.execute('SELECT xmin, ymin, xmax, ymax FROM cells WHERE cellid = ?', (cellstr,)).fetchone()
+        if row is None:
+            return None
+        return IndexedCell(cellstr, tuple(row))
+
+    def getChildren(self, cellstr):
+        ''' Return the names of the indexed subcells of a cell '''
+        return [row[0] for row in self.conn.execute('SELECT cellid FROM cells WHERE parent = ? ORDER BY rowid', (cellstr,))]
+
+    def getPath(self, cellstr):
+        ''' Return the relative file path of a cell, see data_utils.getFilePath() '''
+        row = self.conn.execute('SELECT path FROM cells WHERE cellid = ?', (cellstr,)).fetchone()
+        if row is None:
+            return getFilePath(cellstr)
+        return row[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def getRegionSource(rddgs, cellindexfile = None, debug = False):
+    ''' Return the object the cells of a region are enumerated with: the cell
+    index if one is given, otherwise the DGGS itself '''
+    if cellindexfile:
+        return CellIndex(cellindexfile, rddgs, debug)
+    return rddgs
@@ -1,175 +1,372 @@
-#!/usr/bin/env python
-"""
-'Meta-script' that queries remote sensing database, tiles identified images and
-then stacks them together thereby creating a rHEALPix data cube
-
-"""
-# This file is part of scenzgrid-py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import os
-import sys
-import time
-import psycopg2
-import argparse
-import shutil
-
-import lcrfs
-
-from slurm_utils import *
-
-
-if __name__ == '__main__':
-    start = time.time()
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("tiledir", type = str, help="Specify the directory where rHEALPix tiled datasets are stored.")
-    parser.add_argument("cubedir", type = str, help="Specify the directory where the datacube will be stored.")
-    parser.add_argument("scene", help="Specify list of landsat scenes (comma-separated without blanks)")
-    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
-    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")    
-    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
-    parser.add_argument("-e", "--excludelist", help="Supply file with list of tiles to be excluded (has to match maxres).")
-    parser.add_argument("-p", "--parallelism", help="Choice of no (default) or slurm")
-    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
-
-    args = parser.parse_args()
-
-    if args.tiledir == None:
-        print("Error: no tile directory specified")
-        sys.exit()
-    tiledir = args.tiledir    
-
-    if args.cubedir == None:
-        print("Error: no datacube directory specified")
-        sys.exit()
-    cubedir = args.cubedir
-
-    if args.scene == None:
-        print("Error: no landsat scene specified")
-        sys.exit()
-    scene = args.scene.split(',')
-
-    if args.minres == None:
-        print("Error: minres not specified")
-        sys.exit()
-    minresolution = int(args.minres)
-
-    if args.maxres == None:
-        print("Error: yres not specified")
-        sys.exit()
-    maxresolution = int(args.maxres)
-
-    if args.shapefile:
-        shapefile = str(args.shapefile)
-    else:
-        shapefile = None
-
-    if args.excludelist:
-        excludelist = args.excludelist
-    else:
-        excludelist = None
-
-    if args.parallelism == 'slurm':
-        parallelism = args.parallelism
-    else:
-        parallelism = None
-
-    if args.verbose:
-        debug = True
-    else:
-        debug = False
-    
-    jobs = []  # initialize job list
-    # connect to database and select entries based on provided query parameters
-
-    con = psycopg2.connect("dbname='rsdata' user='spatial' host='10.0.111.237' password='tobefilledin'")
-    cursor = con.cursor()
-
-    if len(scene) == 1:
-        scenestr = "scene = '%s'" %(scene[0])
-    else:
-        scenestr = "(scene = '%s'" %(scene[0])
-        appendstr = ""
-        for s in scene[1:]:
-            appendstr = appendstr + " OR scene = '%s'" %(s)
-        scenestr = scenestr + appendstr + ')'
-    print(scenestr)
-	    
-    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = %s AND sat_type = %s
-    #                  and scene = %s  AND cal_date < %s AND cal_date >= %s;""",
-    #               ("pa", "landsat8", scene[0], "140501", "140101"))
-    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = %s AND scene = %s;""",
-    #               ("pa", scene[0]))
-    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = ? AND \
-    #               (scene = ? OR scene = ?);""",
-    #               (product, "p72r88", "p72r89"))
-
-    sql = "SELECT lcrfsfilename FROM landsat_list WHERE product = 'pa' AND %s;" %(scenestr)
-    #sql = "SELECT lcrfsfilename FROM landsat_list WHERE product = 'pa' AND %s AND cal_date < '140501' AND cal_date >= '140101';" %(scenestr)
-    print(sql)
-    cursor.execute(sql)
-    
-    i = 0
-    for row in cursor:
-        i += 1
-        pa = row[0]
-        # create corresponding cloud mask name and ps name
-        sensor = lcrfs.lcrfs('sensor', pa)
-        ps = lcrfs.change(pa, 'sensor', sensor[:-2] + 'ps')
-        flats = lcrfs.change(ps, 'stage', 'flats')
-        cloud = lcrfs.change(ps, 'stage', 'cloud')
-        # make sure these files actually exist
-        flatspath = os.path.join(lcrfs.lcrfs('path', flats), flats)
-        cloudpath = os.path.join(lcrfs.lcrfs('path', cloud), cloud)
-        if not os.path.exists(flatspath):
-            print('%s does not exist' %(flatspath))
-            continue
-        if not os.path.exists(cloudpath):
-            print('%s does not exist' %(cloudpath))
-            continue
-        flats_fn = os.path.splitext(flats)[0]        
-        flatsoutpath = os.path.join(tiledir, flats_fn)
-        cloud_fn = os.path.splitext(cloud)[0]
-        cloudoutpath = os.path.join(tiledir, cloud_fn)
-
-        # Transform the set of images and tile them using tilerasterlayer.py
-        # Existing datasets with same name are overwritten
-        optparams = ''
-        if shapefile:
-            optparams = '--shapefile %s ' %(shapefile)
-        if excludelist:
-            optparams = optparams + '--excludelist %s ' %(excludelist)
-        flatscmd = '''python tilerasterlayer.py %s %s %d %d %s \
-        --verbose''' %(flatspath, flatsoutpath, minresolution, maxresolution, optparams)
-        print(flatscmd)
-        if parallelism == 'slurm': jobs = submitSLURMjob(flatscmd, jobs)
-        cloudcmd = '''python tilerasterlayer.py %s %s %d %d %s \
-        --resamplingmethod near --verbose''' \
-        %(cloudpath, cloudoutpath, minresolution, maxresolution, optparams)
-        print(cloudcmd)
-        if parallelism == 'slurm': jobs = submitSLURMjob(cloudcmd, jobs)
-    con.close()
-    if parallelism == 'slurm': jobs = checkSLURMjobs(jobs, debug = True)
-    # stack datasets together i.e. create datacube
-    stackcmd = '''python stacklayers.py %s %s %d %d %s --parallelism %s \
-    --verbose''' %(tiledir, cubedir, minresolution, maxresolution, optparams, parallelism)
-    print(stackcmd)
-    os.system(stackcmd)
-    
-    elapsed = time.time() - start
-    print('Elapsed time (createcube): %g seconds' %(elapsed))
+#!/usr/bin/env python
+"""
+'Meta-script' that queries remote sensing database, tiles identified images and
+then stacks them together thereby creating a rHEALPix data cube. With
+--pipeline every cell is stacked as soon as all layers covering it are tiled,
+so tiling and stacking overlap.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import psycopg2
+import argparse
+import shutil
+import subprocess
+
+import lcrfs
+
+from slurm_utils import *
+from instrument_utils import *
+from data_utils import *
+from manifest_utils import *
+from inventory_utils import *
+
+
+def getLayerCells(rddgs, infile, minres, maxres):
+    """
+    Returns the names of all cells between minres and maxres that the tiles of
+    a layer can cover, i.e. the cells of maxres within the extent of its input
+    file and all their ancestors
+    """
+    nw, se = getLonLatExtent(infile)
+    cells = set()
+    for row in rddgs.cells_from_region(maxres, nw, se, plane=False):
+        for c in row:
+            cellstr = str(c)
+            for i in range(minres, maxres+1):
+                cells.add(cellstr[:i+1])
+    return cells
+
+
+def getStackCells(rddgs, shapefile, minres, maxres):
+    """
+    Returns the names of all cells between minres and maxres that stacklayers.py
+    stacks, i.e. the cells within the extent of the shapefile (default: NZ
+    coastline) that intersect its polygons
+    """
+    if shapefile:
+        inShapefile = shapefile
+    else: # use NZ coastline as default
+        inShapefile = '/projects/landcare00031/data/AOIs/nzcoast.shp'
+    nw, se, aoi = getAOI(inShapefile, getStandardProj4())
+    skipcells = set()
+    if aoi is not None:
+        skipcells = getCellsOutsideGeometry(rddgs, minres, maxres, nw, se, aoi, 'AOI')
+    cells = set()
+    for i in range(minres, maxres+1):
+        for row in rddgs.cells_from_region(i, nw, se, plane=False):
+            cells.update([str(c) for c in row if str(c) not in skipcells])
+    return cells
+
+
+def runPipeline(layers, tiledir, cubedir, minres, maxres, shapefile = None, chunksize = 50, debug = False):
+    """
+    Submits one SLURM job per layer and stacks every cell as soon as all layers
+    that can cover it are tiled; a slow layer only delays its own cells. Only
+    the cells of the area of interest are stacked and the stacks are recorded
+    in the manifest of the cube, both like in stacklayers.py. The stacking
+    chunks that become ready together are submitted as one job array.
+
+        @type layers:     C{list}
+        @param layers:    (layer directories, tiling command, input file) of every tiling job
+        @type shapefile:  C{str}
+        @param shapefile: area of interest (default: NZ coastline), see getStackCells()
+        @type chunksize:  C{int}
+        @param chunksize: number of cells stacked by one array task
+    """
+    rddgs = getStandardDGGS()
+    stackcells = getStackCells(rddgs, shapefile, minres, maxres)
+    waiting = {} # number of layers that are not yet tiled for every cell
+    layercells = {}
+    for layerdir, cmd, infile in layers:
+        layercells[layerdir] = getLayerCells(rddgs, infile, minres, maxres) & stackcells
+        for cellstr in layercells[layerdir]:
+            waiting[cellstr] = waiting.get(cellstr, 0) + 1
+    tiling = {} # job -> layer directory
+    for layerdir, cmd, infile in layers:
+        tiling[submitSLURMjob(cmd, [], debug = debug)[-1]] = layerdir
+    print('%d layers submitted for tiling, %d cells to stack' %(len(tiling), len(waiting)))
+
+    manifest = loadManifest(cubedir)
+    params = {'virtual': False, 'zarr': False} # see stacklayers.py
+    stacking = {} # job array -> [(cell, stack file, fingerprint)] of every task
+    ready = [] # cells whose layers are all tiled
+    failed = []
+    missing = {}
+    delay = 1
+    while tiling or stacking:
+        try:
+            finished = pollSLURMjobs(list(tiling) + list(stacking), missing, debug = debug)
+        except (subprocess.CalledProcessError, OSError) as err:
+            print('squeue failed: %s' %(err))
+            finished = []
+        for job, state in finished:
+            if job in tiling:
+                layerdir = tiling.pop(job)
+                print('%s tiled with state %s' %(layerdir, state))
+                if not isJobSuccessful(state): failed.append(layerdir)
+                for cellstr in layercells[layerdir]:
+                    waiting[cellstr] -= 1
+                    if waiting[cellstr] == 0: ready.append(cellstr)
+            else:
+                chunks = stacking.pop(job)
+                taskstates = getCommandStates(job, state, len(chunks))
+                for k in range(len(chunks)):
+                    for cellstr, stackfile, fingerprint in chunks[k]:
+                        recordCell(manifest, cellstr, fingerprint, params,
+                                   getTileStatus(stackfile, isJobSuccessful(taskstates[k])))
+                    if not isJobSuccessful(taskstates[k]):
+                        print('Stacking task %s_%d finished with state %s' %(job, k, taskstates[k]))
+        if ready:
+            # the inventory only walks the layers that changed since the last update
+            inventory = updateInventory(tiledir, debug = debug)
+            saveInventory(tiledir, inventory)
+            celllayers = getCellLayers(inventory, tiledir)
+            chunk = []
+            for cellstr in ready:
+                if cellstr not in celllayers: continue # no layer has data for this cell
+                fingerprint = getCellFingerprint(celllayers, cellstr)
+                stackfile = os.path.join(cubedir, getFilePath(cellstr))
+                if not needsUpdate(manifest, cellstr, fingerprint, params, stackfile): continue
+                if os.path.exists(stackfile): os.remove(stackfile) # outdated stack
+                chunk.append((cellstr, stackfile, fingerprint))
+            commands = []
+            chunks = []
+            for k in range(0, len(chunk), chunksize):
+                cells = [cellstr for cellstr, stackfile, fingerprint in chunk[k:k+chunksize]]
+                inputs = dict([(cellstr, getCellInputs(inventory, celllayers, cellstr)) for cellstr in cells])
+                cmd = 'python stacktile.py --inputs %s %s %s %s' \
+                    %(saveCellInputs(inputs, cubedir), ','.join(cells), tiledir, cubedir)
+                if debug: print(cmd)
+                commands.append(cmd)
+                chunks.append(chunk[k:k+chunksize])
+            if commands:
+                stacking[submitSLURMjobArray(commands, [], debug = debug)[-1]] = chunks # one task per chunk
+            print('%d cells ready, %d stacks submitted, %d layers still tiling' %(len(ready), len(chunk), len(tiling)))
+            ready = []
+        saveManifest(cubedir, manifest)
+        if finished:
+            delay = 1
+        elif tiling or stacking:
+            time.sleep(delay)
+            delay = min(delay * 1.5, 60)
+    if failed:
+        print('Tiling did not complete for %d of %d layers: %s' %(len(failed), len(layers), ' '.join(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tiledir", type = str, help="Specify the directory where rHEALPix tiled datasets are stored.")
+    parser.add_argument("cubedir", type = str, help="Specify the directory where the datacube will be stored.")
+    parser.add_argument("scene", help="Specify list of landsat scenes (comma-separated without blanks)")
+    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
+    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")    
+    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
+    parser.add_argument("-e", "--excludelist", help="Supply file with list of tiles to be excluded (has to match maxres).")
+    parser.add_argument("-p", "--parallelism", help="Choice of no (default) or slurm")
+    parser.add_argument("--separate", help="Tile the flats image and the cloud mask of a scene in separate processes, e.g. if they are not co-registered (default: False).", action ="store_true")
+    parser.add_argument("-c", "--cloudvalue", type = float, help="Value of the cloud class in the cloud masks; cells whose mask is fully cloudy are skipped for the mask and the flats image (not with --separate)")
+    parser.add_argument("--pipeline", help="Stack every cell as soon as all layers covering it are tiled; requires slurm (default: False).", action ="store_true")
+    parser.add_argument("-n", "--chunksize", type = int, help="Number of cells stacked by one job with --pipeline (default: 50)")
+    parser.add_argument("--events", help="Append timing events of all tiling and stacking steps as JSON lines to this file, see summariseevents.py")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+
+    args = parser.parse_args()
+
+    if args.tiledir == None:
+        print("Error: no tile directory specified")
+        sys.exit()
+    tiledir = args.tiledir    
+
+    if args.cubedir == None:
+        print("Error: no datacube directory specified")
+        sys.exit()
+    cubedir = args.cubedir
+
+    if args.scene == None:
+        print("Error: no landsat scene specified")
+        sys.exit()
+    scene = args.scene.split(',')
+
+    if args.minres == None:
+        print("Error: minres not specified")
+        sys.exit()
+    minresolution = int(args.minres)
+
+    if args.maxres == None:
+        print("Error: yres not specified")
+        sys.exit()
+    maxresolution = int(args.maxres)
+
+    if args.shapefile:
+        shapefile = str(args.shapefile)
+    else:
+        shapefile = None
+
+    if args.excludelist:
+        excludelist = args.excludelist
+    else:
+        excludelist = None
+
+    if args.parallelism == 'slurm':
+        parallelism = args.parallelism
+    else:
+        parallelism = None
+
+    if args.separate:
+        separate = True
+    else:
+        separate = False
+
+    if args.cloudvalue is not None:
+        cloudvalue = args.cloudvalue
+    else:
+        cloudvalue = None
+    if cloudvalue is not None and separate:
+        print("Fully cloudy cells can only be skipped if both images are tiled together. Ignoring --cloudvalue")
+        cloudvalue = None
+
+    if args.pipeline and parallelism == 'slurm':
+        pipeline = True
+    else:
+        pipeline = False
+    if args.pipeline and not pipeline:
+        print("The pipelined mode requires slurm. Tiling and stacking one after the other instead")
+
+    if args.chunksize:
+        chunksize = int(args.chunksize)
+    else:
+        chunksize = 50
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False
+
+    if args.events:
+        enableEvents(args.events) # inherited by tilerasterlayer.py and stacklayers.py
+    
+    jobs = []  # initialize job list
+    commands = [] # tiling commands, submitted as one job array
+    layers = [] # (layer directories, tiling command, input file) of every tiling job for the pipelined mode
+    # connect to database and select entries based on provided query parameters
+
+    con = psycopg2.connect("dbname='rsdata' user='spatial' host='10.0.111.237' password='tobefilledin'")
+    cursor = con.cursor()
+
+    if len(scene) == 1:
+        scenestr = "scene = '%s'" %(scene[0])
+    else:
+        scenestr = "(scene = '%s'" %(scene[0])
+        appendstr = ""
+        for s in scene[1:]:
+            appendstr = appendstr + " OR scene = '%s'" %(s)
+        scenestr = scenestr + appendstr + ')'
+    print(scenestr)
+	    
+    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = %s AND sat_type = %s
+    #                  and scene = %s  AND cal_date < %s AND cal_date >= %s;""",
+    #               ("pa", "landsat8", scene[0], "140501", "140101"))
+    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = %s AND scene = %s;""",
+    #               ("pa", scene[0]))
+    #cursor.execute("""SELECT lcrfsfilename FROM landsat_list WHERE product = ? AND \
+    #               (scene = ? OR scene = ?);""",
+    #               (product, "p72r88", "p72r89"))
+
+    sql = "SELECT lcrfsfilename FROM landsat_list WHERE product = 'pa' AND %s;" %(scenestr)
+    #sql = "SELECT lcrfsfilename FROM landsat_list WHERE product = 'pa' AND %s AND cal_date < '140501' AND cal_date >= '140101';" %(scenestr)
+    print(sql)
+    cursor.execute(sql)
+    
+    i = 0
+    for row in cursor:
+        i += 1
+        pa = row[0]
+        # create corresponding cloud mask name and ps name
+        sensor = lcrfs.lcrfs('sensor', pa)
+        ps = lcrfs.change(pa, 'sensor', sensor[:-2] + 'ps')
+        flats = lcrfs.change(ps, 'stage', 'flats')
+        cloud = lcrfs.change(ps, 'stage', 'cloud')
+        # make sure these files actually exist
+        flatspath = os.path.join(lcrfs.lcrfs('path', flats), flats)
+        cloudpath = os.path.join(lcrfs.lcrfs('path', cloud), cloud)
+        if not os.path.exists(flatspath):
+            print('%s does not exist' %(flatspath))
+            continue
+        if not os.path.exists(cloudpath):
+            print('%s does not exist' %(cloudpath))
+            continue
+        flats_fn = os.path.splitext(flats)[0]        
+        flatsoutpath = os.path.join(tiledir, flats_fn)
+        cloud_fn = os.path.splitext(cloud)[0]
+        cloudoutpath = os.path.join(tiledir, cloud_fn)
+
+        # Transform the set of images and tile them using tilerasterlayer.py
+        # Existing datasets with same name are overwritten
+        optparams = ''
+        if shapefile:
+            optparams = '--shapefile %s ' %(shapefile)
+        if excludelist:
+            optparams = optparams + '--excludelist %s ' %(excludelist)
+        if not separate:
+            # the co-registered images share one grid enumeration and one empty decision per cell;
+            # cells without valid data in the cloud mask (or fully cloudy ones) are skipped for both
+            sceneparams = optparams
+            if cloudvalue is not None:
+                sceneparams = sceneparams + '--skipvalue %s ' %(repr(cloudvalue))
+            scenecmd = '''python tilerasterlayer.py %s %s %d %d %s \
+            --resamplingmethod near --addinput %s %s cubic --verbose''' \
+            %(cloudpath, cloudoutpath, minresolution, maxresolution, sceneparams, flatspath, flatsoutpath)
+            print(scenecmd)
+            if parallelism == 'slurm': commands.append(scenecmd)
+            layers.append((cloudoutpath + ' ' + flatsoutpath, scenecmd, cloudpath))
+            continue
+        flatscmd = '''python tilerasterlayer.py %s %s %d %d %s \
+        --verbose''' %(flatspath, flatsoutpath, minresolution, maxresolution, optparams)
+        print(flatscmd)
+        if parallelism == 'slurm': commands.append(flatscmd)
+        layers.append((flatsoutpath, flatscmd, flatspath))
+        cloudcmd = '''python tilerasterlayer.py %s %s %d %d %s \
+        --resamplingmethod near --verbose''' \
+        %(cloudpath, cloudoutpath, minresolution, maxresolution, optparams)
+        print(cloudcmd)
+        if parallelism == 'slurm': commands.append(cloudcmd)
+        layers.append((cloudoutpath, cloudcmd, cloudpath))
+    con.close()
+    if pipeline:
+        # tiling and stacking overlap; no stacklayers.py run waiting for all layers
+        runPipeline(layers, tiledir, cubedir, minresolution, maxresolution, shapefile, chunksize, debug)
+    else:
+        if parallelism == 'slurm':
+            jobs = submitSLURMjobArray(commands, jobs, debug = debug) # one array task per layer
+            jobs = checkSLURMjobs(jobs, debug = True)
+        # stack datasets together i.e. create datacube
+        stackcmd = '''python stacklayers.py %s %s %d %d %s --parallelism %s \
+        --verbose''' %(tiledir, cubedir, minresolution, maxresolution, optparams, parallelism)
+        print(stackcmd)
+        os.system(stackcmd)
+    
+    elapsed = time.time() - start
+    logEvent('total', seconds = elapsed, minres = minresolution, maxres = maxresolution)
+    print('Elapsed time (createcube): %g seconds' %(elapsed))
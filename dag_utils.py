@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Dependency-driven scheduling of per-cell tasks. A task of a cell is started as
+soon as the tasks of its subcells are finished instead of waiting for whole
+resolution levels, either by a local process pool or by SLURM dependencies
+between subtree jobs
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import queue
+import subprocess
+
+from slurm_utils import *
+from local_utils import *
+
+
+def buildCellDAG(rddgs, minres, maxres, nw, se):
+    ''' Build the dependency graph of all cells of a region between minres and maxres
+
+        @type rddgs:    C{rhealpix_dggs.dggs.RHEALPixDGGS}
+        @param rddgs:   DGGS or cellindex_utils.CellIndex
+        @type nw:       C{list}
+        @param nw:      [lon, lat] of the north-west corner of the region
+        @type se:       C{list}
+        @param se:      [lon, lat] of the south-east corner of the region
+        @rtype:         C{tuple}
+        @return:        (cells, children): list of cells ordered from maxres to minres
+                        and dictionary with the names of the subcells of each cell
+                        that are part of the region
+    '''
+    cells = []
+    children = {}
+    finer = set()
+    for i in range(maxres, minres-1, -1):
+        grid = rddgs.cells_from_region(i, nw, se, plane=False)
+        level = set()
+        for row in grid:
+            for c in row:
+                cellstr = str(c)
+                level.add(cellstr)
+                if i == maxres:
+                    children[cellstr] = []
+                else:
+                    children[cellstr] = [str(cell) for cell in c.subcells() if str(cell) in finer]
+                cells.append(c)
+        finer = level
+    return cells, children
+
+
+def isTaskFailed(result):
+    ''' Returns True if the result of a task means that it failed: an exception
+    (None), the status 'failed' or the non-zero exit code of a command '''
+    if result is None or result == 'failed':
+        return True
+    return isinstance(result, int) and result != 0
+
+
+def runDAGLocal(pool, tasks, children, debug = False):
+    ''' Run tasks on a local process pool. The task of a cell is submitted once the
+    tasks of all its subcells have finished; subcells without a task count as
+    finished. If a task fails (see isTaskFailed()), the tasks of all its
+    ancestors fail without being run, like the jobs of submitDAGSLURM().
+
+        @type pool:     C{multiprocessing.Pool}
+        @param pool:    worker processes
+        @type tasks:    C{list}
+        @param tasks:   (cell name, function, arguments) tuples, ordered from maxres to minres
+        @type children: C{dict}
+        @param children: subcells of each cell, see buildCellDAG()
+        @rtype:         C{dict}
+        @return:        results of the tasks by cell name; None for failed tasks
+    '''
+    taskmap = {}
+    for cellstr, func, args in tasks:
+        taskmap[cellstr] = (func, args)
+    parents = {}
+    waiting = {}
+    for cellstr in taskmap:
+        childtasks = [child for child in children.get(cellstr, []) if child in taskmap]
+        waiting[cellstr] = len(childtasks)
+        for child in childtasks:
+            parents[child] = cellstr
+
+    finished = queue.Queue()
+    def submit(cellstr):
+        func, args = taskmap[cellstr]
+        pool.apply_async(timedCall, (func, args),
+                         callback = lambda result: finished.put((cellstr, result, None)),
+                         error_callback = lambda err: finished.put((cellstr, None, err)))
+        if debug: print('submitted task of %s' %(cellstr))
+
+    start = time.time()
+    for cellstr, func, args in tasks:
+        if waiting[cellstr] == 0:
+            submit(cellstr)
+    results = {}
+    workers = {}
+    failed = 0
+    cancelled = set() # ancestors of failed tasks
+    while len(results) < len(taskmap):
+        cellstr, result, err = finished.get()
+        if err is not None:
+            print('Task of %s failed: %s' %(cellstr, err))
+            results[cellstr] = None
+        else:
+            pid, elapsed, results[cellstr] = result
+            addWorkerTime(workers, pid, elapsed)
+        if isTaskFailed(results[cellstr]):
+            failed += 1
+            ancestor = parents.get(cellstr)
+            while ancestor is not None and ancestor not in cancelled:
+                if debug: print('cancelled task of %s' %(ancestor))
+                cancelled.add(ancestor)
+                results[ancestor] = None
+                ancestor = parents.get(ancestor)
+        parent = parents.get(cellstr)
+        if parent is not None:
+            waiting[parent] -= 1
+            if waiting[parent] == 0 and parent not in cancelled:
+                submit(parent)
+    if cancelled: print('%d tasks cancelled after failed subcells' %(len(cancelled)))
+    reportThroughput(workers, len(taskmap), failed, time.time() - start)
+    return results
+
+
+def getDAGSplit(cells, subtrees):
+    ''' Return the coarsest resolution with at least subtrees of the given cells
+    (or the finest resolution of the cells if none has that many) '''
+    counts = {}
+    for cellstr in cells:
+        counts[len(cellstr) - 1] = counts.get(len(cellstr) - 1, 0) + 1
+    for res in sorted(counts):
+        if counts[res] >= subtrees:
+            return res
+    return max(counts)
+
+
+def submitDAGSLURM(cells, children, cellcmd, joblist, subtrees = 100, debug = False):
+    ''' Submit the tasks of cells as SLURM jobs. The graph is split at the coarsest
+    resolution with at least subtrees cells (see getDAGSplit()); all tasks in the
+    subtree of a cell of that resolution are run by one job, which creates them
+    in a single process (cellcmd --celllist). Every cell above the split gets its
+    own job that depends (afterok) on the jobs of its subcells, so SLURM starts it
+    as soon as these are finished. If a job fails, the jobs depending on it are
+    cancelled.
+
+        @type cells:    C{list}
+        @param cells:   names of the cells with a task, ordered from maxres to minres
+        @type children: C{dict}
+        @param children: subcells of each cell, see buildCellDAG()
+        @type cellcmd:  C{str}
+        @param cellcmd: command that creates the tiles of the cells given by --cell or --celllist
+        @type subtrees: C{int}
+        @param subtrees: minimum number of subtree jobs
+        @rtype:         C{tuple}
+        @return:        (list of jobs, dictionary with the job of every cell)
+    '''
+    celljobs = {}
+    if not cells:
+        return joblist, celljobs
+    splitres = getDAGSplit(cells, subtrees)
+    roots = []
+    subtreecells = {} # cells of every subtree, subcells before their parents
+    for cellstr in cells:
+        if len(cellstr) - 1 < splitres: continue
+        root = cellstr[:splitres+1]
+        if root not in subtreecells:
+            roots.append(root)
+            subtreecells[root] = []
+        subtreecells[root].append(cellstr)
+    for root in roots:
+        celllist = writeJobFile('\n'.join(subtreecells[root]), prefix = 'cells_', suffix = '.txt')
+        try:
+            joblist = submitSLURMjob('%s --celllist %s' %(cellcmd, celllist), joblist, debug = debug)
+        except (subprocess.CalledProcessError, OSError):
+            os.remove(celllist)
+            raise
+        addJobManifest(joblist[-1], celllist) # deleted once the job has finished
+        for cellstr in subtreecells[root]:
+            celljobs[cellstr] = joblist[-1]
+    above = 0
+    for cellstr in cells:
+        if len(cellstr) - 1 >= splitres: continue
+        dependencies = sorted(set([celljobs[child] for child in children.get(cellstr, []) if child in celljobs]))
+        options = []
+        if dependencies:
+            options = ['--dependency=afterok:%s' %(':'.join(dependencies)), '--kill-on-invalid-dep=yes']
+        joblist = submitSLURMjob('%s --cell %s' %(cellcmd, cellstr), joblist, options, debug = debug)
+        celljobs[cellstr] = joblist[-1]
+        above += 1
+    print('%d cells submitted as %d subtree jobs at resolution %d and %d jobs above' %(len(cells), len(roots), splitres, above))
+    return joblist, celljobs
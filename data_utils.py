@@ -1,116 +1,448 @@
-#!/usr/bin/env python
-"""
-GDAL,OGR and rHEALPix related custom data utilities
-
-"""
-# This file is part of scenzgrid-py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>
-
-import os
-import sys
-import time
-import argparse
-
-import ogr
-from osgeo import gdal, ogr, osr
-from gdalconst import *
-
-
-def getExtent(gt,cols,rows):
-    ''' Return list of corner coordinates from a geotransform
-
-        @type gt:   C{tuple/list}
-        @param gt: geotransform
-        @type cols:   C{int}
-        @param cols: number of columns in the dataset
-        @type rows:   C{int}
-        @param rows: number of rows in the dataset
-        @rtype:    C{[float,...,float]}
-        @return:   coordinates of each corner
-    '''
-    ext=[]
-    xarr=[0,cols]
-    yarr=[0,rows]
-
-    for px in xarr:
-        for py in yarr:
-            x=gt[0]+(px*gt[1])+(py*gt[2])
-            y=gt[3]+(px*gt[4])+(py*gt[5])
-            ext.append([x,y])
-            # print(x,y)
-        yarr.reverse()
-    return ext
-
-def reprojectCoords(coords,src_srs,tgt_srs):
-    ''' Reproject a list of x,y coordinates.
-
-        @type geom:     C{tuple/list}
-        @param geom:    List of [[x,y],...[x,y]] coordinates
-        @type src_srs:  C{osr.SpatialReference}
-        @param src_srs: OSR SpatialReference object
-        @type tgt_srs:  C{osr.SpatialReference}
-        @param tgt_srs: OSR SpatialReference object
-        @rtype:         C{tuple/list}
-        @return:        List of transformed [[x,y],...[x,y]] coordinates
-    '''
-    trans_coords=[]
-    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
-
-
-def getFilePath(cell):
-    ''' Create a scenzgrid file path out of the name of a single
-    rHEALPix cell '''
-    cellstr = str(cell)
-    tmpstr = cellstr
-    face = cellstr[0]
-    tmpstr = cellstr[1:]
-    filepath = face
-    level = len(cellstr)-2
-    noiter = level // 3
-    for i in range(noiter):  
-        filepath = os.path.join(filepath, tmpstr[0:3])
-        tmpstr = tmpstr[3 :]
-    if len(cellstr) == 1:
-        filepath = face + ".kea"
-    else:
-        filepath = os.path.join(filepath, tmpstr + ".kea")
-    return filepath
-
-
-def isEmpty(filename):
-    ''' Returns True if a raster tile does not contain any valid data
-    As side effect, statistics are calculated for the file '''
-    src_ds = gdal.Open(filename, GA_Update )
-    empty = True
-    for band in range(1, src_ds.RasterCount+1):
-        stats =   src_ds.GetRasterBand(1).GetStatistics(0,1)
-        # print(stats[2], '\n')
-        if str(stats[2]) == 'nan':
-            print('Empty band detected.')
-        else:
-            empty = False
-    if empty: print('Empty tile detected.')
-    src_ds = None
-
-    return empty
-
-
-
+#!/usr/bin/env python
+"""
+GDAL,OGR and rHEALPix related custom data utilities
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import sys
+import time
+import argparse
+import numpy
+
+import ogr
+from osgeo import gdal, ogr, osr
+from gdalconst import *
+
+from rhealpix_dggs.dggs import RHEALPixDGGS, Cell
+from rhealpix_dggs.ellipsoids import Ellipsoid
+
+try: # optional, speeds up the selection of cells by geometry
+    from shapely.geometry import box
+    from shapely.strtree import STRtree
+except ImportError:
+    STRtree = None
+
+# parameters of the 'standard' DGGS based on WGS84 and center meridian at 52 deg
+N_SQUARE = 1
+S_SQUARE = 3
+SEMI_MAJOR_AXIS = 6378137
+CENTRAL_MERIDIAN = 52
+
+
+def getExtent(gt,cols,rows):
+    ''' Return list of corner coordinates from a geotransform
+
+        @type gt:   C{tuple/list}
+        @param gt: geotransform
+        @type cols:   C{int}
+        @param cols: number of columns in the dataset
+        @type rows:   C{int}
+        @param rows: number of rows in the dataset
+        @rtype:    C{[float,...,float]}
+        @return:   coordinates of each corner
+    '''
+    ext=[]
+    xarr=[0,cols]
+    yarr=[0,rows]
+
+    for px in xarr:
+        for py in yarr:
+            x=gt[0]+(px*gt[1])+(py*gt[2])
+            y=gt[3]+(px*gt[4])+(py*gt[5])
+            ext.append([x,y])
+            # print(x,y)
+        yarr.reverse()
+    return ext
+
+def reprojectCoords(coords,src_srs,tgt_srs):
+    ''' Reproject a list of x,y coordinates.
+
+        @type geom:     C{tuple/list}
+        @param geom:    List of [[x,y],...[x,y]] coordinates
+        @type src_srs:  C{osr.SpatialReference}
+        @param src_srs: OSR SpatialReference object
+        @type tgt_srs:  C{osr.SpatialReference}
+        @param tgt_srs: OSR SpatialReference object
+        @rtype:         C{tuple/list}
+        @return:        List of transformed [[x,y],...[x,y]] coordinates
+    '''
+    trans_coords=[]
+    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
+    for x,y in coords:
+        x,y,z = transform.TransformPoint(x,y)
+        trans_coords.append([x,y])
+    return trans_coords
+
+
+def getLonLatExtent(infile, steps = 20):
+    ''' Return the north-west and south-east corners [lon, lat] of the extent
+    of a raster file. The edges are sampled at steps points each, so that the
+    extent also contains curved edges of projected rasters. '''
+    ds = gdal.Open(infile, GA_ReadOnly)
+    gt = ds.GetGeoTransform()
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    src_srs = getSpatialReference(ds.GetProjection())
+    ds = None
+    coords = []
+    for k in range(steps+1):
+        f = k / float(steps)
+        for px, py in [(f*cols, 0), (f*cols, rows), (0, f*rows), (cols, f*rows)]:
+            coords.append([gt[0] + px*gt[1] + py*gt[2], gt[3] + px*gt[4] + py*gt[5]])
+    if not src_srs.IsGeographic():
+        coords = reprojectCoords(coords, src_srs, getSpatialReference(src_srs.CloneGeogCS().ExportToWkt()))
+    lons = [x for x, y in coords]
+    lats = [y for x, y in coords]
+    return [min(lons), max(lats)], [max(lons), min(lats)]
+
+
+def getFilePath(cell):
+    ''' Create a scenzgrid file path out of the name of a single
+    rHEALPix cell '''
+    cellstr = str(cell)
+    tmpstr = cellstr
+    face = cellstr[0]
+    tmpstr = cellstr[1:]
+    filepath = face
+    level = len(cellstr)-2
+    noiter = level // 3
+    for i in range(noiter):  
+        filepath = os.path.join(filepath, tmpstr[0:3])
+        tmpstr = tmpstr[3 :]
+    if len(cellstr) == 1:
+        filepath = face + ".kea"
+    else:
+        filepath = os.path.join(filepath, tmpstr + ".kea")
+    return filepath
+
+
+def getCellFromTilePath(filepath):
+    ''' Return the name of the cell of a tile path created with getFilePath(),
+    also if the path is prefixed by the directory of the layer '''
+    parts = os.path.normpath(filepath).split(os.sep)
+    name = parts[-1]
+    if name.endswith('.kea'): name = name[:-len('.kea')]
+    if len(parts) == 1 or not name.isdigit():
+        return name
+    k = len(parts) - 2
+    while k > 0 and len(parts[k]) == 3 and parts[k].isdigit():
+        name = parts[k] + name
+        k -= 1
+    return parts[k] + name
+
+
+def getStandardDGGS():
+    ''' Return the 'standard' rHEALPix DGGS used for all scenzgrid data sets '''
+    E = Ellipsoid(lon_0 = CENTRAL_MERIDIAN)
+    return RHEALPixDGGS(ellipsoid = E, north_square=N_SQUARE, south_square=S_SQUARE, N_side=3)
+
+
+def getStandardProj4():
+    ''' Return the proj4 string of the 'standard' rHEALPix projection '''
+    return "+proj=rhealpix +lon_0=%f +a=%f +ellps=WGS84 +north_square=%d +south_square=%d +towgs84=0,0,0 +wktext" \
+        %(CENTRAL_MERIDIAN, SEMI_MAJOR_AXIS, N_SQUARE, S_SQUARE)
+
+
+def getCell(rddgs, cellstr):
+    ''' Return the rHEALPix cell object for the name of a cell, e.g. 'S102033' '''
+    return Cell(rddgs, tuple([cellstr[0]] + [int(d) for d in cellstr[1:]]))
+
+
+def getCellBounds(cell):
+    ''' Return (xmin, ymin, xmax, ymax) of a rHEALPix cell in plane coordinates '''
+    vertices = cell.vertices()
+    return (vertices[0][0], vertices[2][1], vertices[1][0], vertices[0][1])
+
+
+def getSubcellPaths(cell, outfileroot):
+    ''' Return the file paths of the tiles of all subcells of a cell; the tiles
+    do not necessarily exist '''
+    return [os.path.join(outfileroot, getFilePath(subcell)) for subcell in cell.subcells()]
+
+
+def getSpatialReference(srs):
+    ''' Return an osr.SpatialReference from WKT, a proj4 string or an EPSG code.
+    Coordinates are always handled in x/y (lon/lat) order. '''
+    sr = osr.SpatialReference()
+    sr.SetFromUserInput(srs)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return sr
+
+
+def getFootprint(infile, t_srs, maxsize = 512, nodata = None):
+    ''' Return the polygon covering all valid pixels of a raster file in the
+    target coordinate system. The valid-data mask of every band is reduced
+    block by block to a coarse raster: a coarse pixel is valid if any pixel of
+    its block is valid, so narrow strips of valid data (scene edges, slivers)
+    are kept. The polygon is grown by one coarse pixel so that no valid data
+    is lost.
+
+        @type infile:   C{str}
+        @param infile:  raster file
+        @type t_srs:    C{str}
+        @param t_srs:   target coordinate system, e.g. the rHEALPix proj4 string
+        @type maxsize:  C{int}
+        @param maxsize: maximum number of rows/columns of the coarse raster
+        @type nodata:   C{int/float}
+        @param nodata:  nodata value; defaults to the one of each band
+        @rtype:         C{ogr.Geometry}
+        @return:        footprint or None if the raster contains no valid data
+    '''
+    src_ds = gdal.Open(infile, GA_ReadOnly)
+    cols = src_ds.RasterXSize
+    rows = src_ds.RasterYSize
+    factor = max(1, -(-max(cols, rows) // maxsize)) # pixels per coarse pixel and direction
+    xsize = -(-cols // factor)
+    ysize = -(-rows // factor)
+    valid = numpy.zeros((ysize, xsize), dtype = bool)
+    for band in range(1, src_ds.RasterCount+1):
+        rasterband = src_ds.GetRasterBand(band)
+        if nodata is None: bandnodata = rasterband.GetNoDataValue()
+        else: bandnodata = nodata
+        for row in range(ysize): # one strip of blocks at a time
+            yoff = row * factor
+            array = rasterband.ReadAsArray(0, yoff, cols, min(factor, rows - yoff))
+            stripvalid = numpy.zeros((array.shape[0], xsize * factor), dtype = bool)
+            stripvalid[:, :cols] = getValidMask(array, bandnodata)
+            valid[row] |= stripvalid.reshape(array.shape[0], xsize, factor).any(axis = (0, 2))
+    if not valid.any():
+        return None
+
+    # polygonize the mask
+    srcgt = src_ds.GetGeoTransform()
+    gt = (srcgt[0], srcgt[1] * factor, srcgt[2] * factor, srcgt[3], srcgt[4] * factor, srcgt[5] * factor)
+    mask_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(gt)
+    mask_ds.SetProjection(src_ds.GetProjection())
+    maskband = mask_ds.GetRasterBand(1)
+    maskband.WriteArray(valid.astype(numpy.uint8))
+    src_srs = getSpatialReference(src_ds.GetProjection())
+    vector_ds = ogr.GetDriverByName('Memory').CreateDataSource('footprint')
+    layer = vector_ds.CreateLayer('footprint', srs = src_srs)
+    gdal.Polygonize(maskband, maskband, layer, -1)
+    footprint = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in layer:
+        footprint.AddGeometry(feature.GetGeometryRef())
+    pixelsize = max(abs(gt[1]), abs(gt[5]))
+    footprint = footprint.UnionCascaded().Buffer(pixelsize)
+
+    # densify so that the outline follows the curvature of the target projection
+    footprint.Segmentize(pixelsize * 4)
+    footprint.Transform(osr.CoordinateTransformation(src_srs, getSpatialReference(t_srs)))
+    return footprint
+
+
+def getCellPolygon(cell):
+    ''' Return the outline of a rHEALPix cell in plane coordinates as polygon '''
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in cell.vertices():
+        ring.AddPoint_2D(x, y)
+    ring.CloseRings()
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    return polygon
+
+
+def getAOI(shapefile, t_srs):
+    ''' Read the area of interest from a shapefile
+
+        @type shapefile: C{str}
+        @param shapefile: polygon shapefile; lat/long is assumed if it has no projection
+        @type t_srs:    C{str}
+        @param t_srs:   target coordinate system, e.g. the rHEALPix proj4 string
+        @rtype:         C{tuple}
+        @return:        (nw, se, aoi): corners of the extent in lat/long and the
+                        union of all polygons in the target coordinate system
+    '''
+    inDriver = ogr.GetDriverByName("ESRI Shapefile")
+    inDataSource = inDriver.Open(shapefile, 0)
+    if inDataSource is None:
+        raise IOError('Could not open the shapefile: %s' %(shapefile))
+    inLayer = inDataSource.GetLayer()
+    ext = inLayer.GetExtent()
+    nw = [ext[0], ext[3]]
+    se = [ext[1], ext[2]]
+    src_srs = inLayer.GetSpatialRef()
+    if src_srs is None: src_srs = getSpatialReference('EPSG:4326')
+    elif hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'): src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    aoi = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in inLayer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None: continue
+        if geometry.GetGeometryType() in [ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D]:
+            for part in range(geometry.GetGeometryCount()):
+                aoi.AddGeometry(geometry.GetGeometryRef(part))
+        else:
+            aoi.AddGeometry(geometry)
+    # densify so that the outline follows the curvature of the target projection
+    aoi.Segmentize(0.1)
+    aoi.Transform(osr.CoordinateTransformation(src_srs, getSpatialReference(t_srs)))
+    return nw, se, aoi
+
+
+class GeometryIndex(object):
+    """
+    Spatial index over the parts of a (multi)polygon, e.g. the islands of a
+    coastline. Cells are only tested exactly against the parts whose bounding
+    boxes they touch. Uses a shapely STRtree if shapely is installed.
+    """
+
+    def __init__(self, geometry):
+        self.parts = []
+        if geometry.GetGeometryType() in [ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D]:
+            for part in range(geometry.GetGeometryCount()):
+                self.parts.append(geometry.GetGeometryRef(part).Clone())
+        else:
+            self.parts.append(geometry.Clone())
+        # (xmin, ymin, xmax, ymax) of the parts
+        self.envelopes = [(e[0], e[2], e[1], e[3]) for e in [part.GetEnvelope() for part in self.parts]]
+        self.tree = None
+        if STRtree is not None and len(self.parts) > 1:
+            self.boxes = [box(*envelope) for envelope in self.envelopes]
+            self.tree = STRtree(self.boxes)
+            self.boxids = dict([(id(b), j) for j, b in enumerate(self.boxes)])
+
+    def candidates(self, bounds):
+        ''' Return the parts whose bounding boxes intersect bounds (xmin, ymin, xmax, ymax) '''
+        if self.tree is not None:
+            result = self.tree.query(box(*bounds))
+            # shapely >= 2 returns indices, older versions the geometries
+            indices = [j if not hasattr(j, 'geom_type') else self.boxids[id(j)] for j in result]
+            return [self.parts[j] for j in sorted(indices)]
+        return [self.parts[j] for j in range(len(self.parts))
+                if self.envelopes[j][0] <= bounds[2] and self.envelopes[j][2] >= bounds[0] and
+                   self.envelopes[j][1] <= bounds[3] and self.envelopes[j][3] >= bounds[1]]
+
+    def intersects(self, polygon, bounds):
+        ''' Returns True if polygon (with the given bounds) intersects the geometry '''
+        for part in self.candidates(bounds):
+            if part.Intersects(polygon):
+                return True
+        return False
+
+    def contains(self, polygon, bounds):
+        ''' Returns True if polygon lies completely within a single part of the geometry '''
+        for part in self.candidates(bounds):
+            if part.Contains(polygon):
+                return True
+        return False
+
+
+def getCellsOutsideGeometry(rddgs, minres, maxres, nw, se, geometry, name = 'geometry'):
+    ''' Return the names of all cells of a region between minres and maxres that do
+    not intersect a geometry in plane coordinates and print the number of
+    skipped cells per resolution. The resolutions are processed from coarse to
+    fine: subcells of cells outside the geometry are skipped and subcells of
+    cells completely inside are kept without testing them again. '''
+    skipcells = set()
+    insidecells = set()
+    if geometry is not None: index = GeometryIndex(geometry)
+    for i in range(minres, maxres+1):
+        grid = rddgs.cells_from_region(i, nw, se, plane=False)
+        total = 0
+        skipped = 0
+        for row in grid:
+            for c in row:
+                total += 1
+                cellstr = str(c)
+                if i > minres and cellstr[:-1] in skipcells:
+                    outside = True
+                elif i > minres and cellstr[:-1] in insidecells:
+                    outside = False
+                    insidecells.add(cellstr)
+                elif geometry is None:
+                    outside = True
+                else:
+                    polygon = getCellPolygon(c)
+                    bounds = getCellBounds(c)
+                    outside = not index.intersects(polygon, bounds)
+                    if not outside and index.contains(polygon, bounds): insidecells.add(cellstr)
+                if outside:
+                    skipcells.add(cellstr)
+                    skipped += 1
+        print('Resolution %d: %d of %d cells skipped (outside of %s)' %(i, skipped, total, name))
+    return skipcells
+
+
+def getCellsOutsideFootprint(rddgs, minres, maxres, nw, se, footprint):
+    ''' Return the names of all cells of a region between minres and maxres that do
+    not intersect the footprint, see getCellsOutsideGeometry() '''
+    return getCellsOutsideGeometry(rddgs, minres, maxres, nw, se, footprint, 'footprint')
+
+
+def getValidMask(array, nodata):
+    ''' Return a boolean array that is True for all pixels holding valid data '''
+    if nodata is None:
+        valid = numpy.ones(array.shape, dtype = bool)
+    else:
+        valid = array != nodata
+    if array.dtype.kind == 'f':
+        valid &= ~numpy.isnan(array)
+    return valid
+
+
+def isEmptyArray(array, nodata):
+    ''' Returns True if an array (e.g. a tile straight after warping) does not
+    contain any valid data '''
+    if array.ndim == 2:
+        array = array[numpy.newaxis, :, :]
+    for band in array: # stop at the first band with valid data
+        if getValidMask(band, nodata).any():
+            return False
+    return True
+
+
+def isEmptyDataset(src_ds):
+    ''' Returns True if an open raster dataset does not contain any valid data.
+    The bands are read block by block and the check stops at the first block
+    with a valid pixel, so only empty tiles are read completely. '''
+    xblock, yblock = src_ds.GetRasterBand(1).GetBlockSize()
+    for band in range(1, src_ds.RasterCount+1):
+        rasterband = src_ds.GetRasterBand(band)
+        nodata = rasterband.GetNoDataValue()
+        for yoff in range(0, src_ds.RasterYSize, yblock):
+            ysize = min(yblock, src_ds.RasterYSize - yoff)
+            for xoff in range(0, src_ds.RasterXSize, xblock):
+                xsize = min(xblock, src_ds.RasterXSize - xoff)
+                block = rasterband.ReadAsArray(xoff, yoff, xsize, ysize)
+                if getValidMask(block, nodata).any():
+                    return False
+    return True
+
+
+def isEmpty(filename):
+    ''' Returns True if a raster tile does not contain any valid data.
+    The tile is opened read-only; statistics are no longer calculated as side
+    effect, see computeStatistics() '''
+    src_ds = gdal.Open(filename, GA_ReadOnly)
+    empty = isEmptyDataset(src_ds)
+    if empty: print('Empty tile detected.')
+    src_ds = None
+
+    return empty
+
+
+def computeStatistics(filename):
+    ''' Calculate and store the statistics of all bands of a raster file '''
+    src_ds = gdal.Open(filename, GA_Update)
+    for band in range(1, src_ds.RasterCount+1):
+        src_ds.GetRasterBand(band).GetStatistics(0,1)
+    src_ds = None
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Structured instrumentation of the pipeline scripts. Events such as the
+warping, empty check or stacking of a cell, SLURM submissions and queue
+waits are appended as JSON lines to the file named by the environment
+variable SCENZGRID_EVENTS, which is inherited by local workers and SLURM jobs.
+Without it nothing is recorded. See summariseevents.py for reports.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import socket
+import contextlib
+
+EVENTS_VARIABLE = 'SCENZGRID_EVENTS'
+
+
+def enableEvents(filename):
+    ''' Record the events of this process and of all processes started by it
+    (local workers, commands, SLURM jobs) in filename '''
+    os.environ[EVENTS_VARIABLE] = os.path.abspath(filename)
+
+
+def eventsEnabled():
+    ''' Returns True if events are recorded '''
+    return bool(os.environ.get(EVENTS_VARIABLE))
+
+
+def logEvent(stage, cell = None, seconds = None, **fields):
+    ''' Append one event to the event file
+
+        @type stage:    C{str}
+        @param stage:   e.g. 'enumerate', 'warp', 'emptycheck', 'delete', 'stack',
+                        'submit', 'queue', 'run'
+        @type cell:     C{str}
+        @param cell:    name of the cell the event belongs to
+        @type seconds:  C{float}
+        @param seconds: duration of the stage
+        @param fields:  further values, e.g. status, bytesread, byteswritten, job
+    '''
+    filename = os.environ.get(EVENTS_VARIABLE)
+    if not filename:
+        return
+    event = {'time': time.time(), 'stage': stage, 'host': socket.gethostname(), 'pid': os.getpid(),
+             'script': os.path.basename(sys.argv[0])}
+    if cell is not None:
+        event['cell'] = str(cell)
+        event['res'] = len(str(cell)) - 1
+    if seconds is not None: event['seconds'] = seconds
+    event.update(fields)
+    # a single write of one line in append mode, so that concurrent writers do not interleave
+    line = json.dumps(event, sort_keys=True) + '\n'
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def timedStage(stage, cell = None, **fields):
+    ''' Context manager that records the duration of a stage as event. The
+    yielded dictionary can be filled with further fields, e.g. the status. '''
+    if not eventsEnabled():
+        yield {}
+        return
+    start = time.time()
+    extra = dict(fields)
+    try:
+        yield extra
+    finally:
+        logEvent(stage, cell, time.time() - start, **extra)
+
+
+def getFileSize(filenames):
+    ''' Return the total size in bytes of the existing files (or directories,
+    e.g. Zarr arrays) of a list '''
+    if isinstance(filenames, str): filenames = [filenames]
+    size = 0
+    for filename in filenames:
+        if not filename: continue
+        if os.path.isfile(filename):
+            size += os.path.getsize(filename)
+        elif os.path.isdir(filename):
+            for root, dirs, files in os.walk(filename):
+                size += sum([os.path.getsize(os.path.join(root, name)) for name in files])
+    return size
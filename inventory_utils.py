@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Inventory of a directory of rHEALPix tiled layers. The directory is walked
+once to record which cells every layer has, together with the size and
+modification time of each tile and the band descriptions of the layer, so
+that stacking does not have to probe the file system for every cell and layer
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import glob
+import tempfile
+
+from osgeo import gdal
+from gdalconst import *
+
+from data_utils import *
+from manifest_utils import MANIFEST_NAME, getStatsFingerprint
+
+INVENTORY_NAME = 'inventory.json'
+
+
+def getCellFromPath(filepath):
+    ''' Return the name of the cell of a tile path relative to the layer
+    directory; the inverse of getFilePath() '''
+    parts = filepath.replace(os.sep, '/').split('/')
+    name = parts[-1]
+    if name.endswith('.kea'): name = name[:-len('.kea')]
+    return ''.join(parts[:-1]) + name
+
+
+def getLayerStamp(layerroot):
+    ''' Return the modification time of the tiling manifest of a layer, which
+    changes whenever tilerasterlayer.py updates the layer; None if the layer
+    has no manifest '''
+    manifestfile = os.path.join(layerroot, MANIFEST_NAME)
+    if os.path.exists(manifestfile):
+        return os.stat(manifestfile).st_mtime
+    return None
+
+
+def scanLayer(layerroot, debug = False):
+    ''' Walk the directory of one tiled layer
+
+        @type layerroot: C{str}
+        @param layerroot: directory of the layer
+        @rtype:         C{dict}
+        @return:        {'stamp': see getLayerStamp(), 'bands': band descriptions,
+                        'cells': {cell name: [size, mtime]}}
+    '''
+    stamp = getLayerStamp(layerroot)
+    cells = {}
+    firsttile = None
+    for root, dirs, files in os.walk(layerroot):
+        dirs.sort()
+        for filename in files:
+            if not filename.endswith('.kea'): continue
+            filepath = os.path.join(root, filename)
+            stat = os.stat(filepath)
+            cells[getCellFromPath(os.path.relpath(filepath, layerroot))] = [stat.st_size, int(stat.st_mtime)]
+            if firsttile is None: firsttile = filepath
+    # all tiles of a layer are warped from the same input and have the same bands
+    bands = []
+    if firsttile is not None:
+        src_ds = gdal.Open(firsttile, GA_ReadOnly)
+        if src_ds is not None:
+            bands = [src_ds.GetRasterBand(b).GetDescription() for b in range(1, src_ds.RasterCount+1)]
+            src_ds = None
+    if debug: print('%s: %d tiles, %d bands' %(layerroot, len(cells), len(bands)))
+    return {'stamp': stamp, 'bands': bands, 'cells': cells}
+
+
+def loadInventory(indir):
+    ''' Read the inventory of a directory of tiled layers; returns an empty
+    inventory if there is none yet '''
+    filename = os.path.join(indir, INVENTORY_NAME)
+    if not os.path.exists(filename):
+        return {'layers': {}}
+    with open(filename, mode='r', encoding='utf-8') as infile:
+        return json.load(infile)
+
+
+def saveInventory(indir, inventory):
+    ''' Write the inventory of a directory of tiled layers atomically '''
+    filename = os.path.join(indir, INVENTORY_NAME)
+    tmpname = '%s.%d.tmp' %(filename, os.getpid())
+    with open(tmpname, mode='w', encoding='utf-8') as outfile:
+        json.dump(inventory, outfile, separators=(',', ':'), sort_keys=True)
+    os.replace(tmpname, filename)
+
+
+def updateInventory(indir, inventory = None, rescan = False, debug = False):
+    ''' Bring the inventory of a directory of tiled layers up to date. Only new
+    layers and layers whose tiling manifest changed are walked again; layers
+    without a manifest are only walked when they are new or if rescan is set.
+    Layers that no longer exist are removed.
+
+        @type indir:    C{str}
+        @param indir:   directory with one subdirectory per tiled layer
+        @type inventory: C{dict}
+        @param inventory: inventory to update; read from indir if None
+        @rtype:         C{dict}
+        @return:        the updated inventory
+    '''
+    if inventory is None: inventory = loadInventory(indir)
+    layers = inventory['layers']
+    layerroots = [layerroot for layerroot in glob.glob(os.path.join(indir, '*')) if os.path.isdir(layerroot)]
+    layernames = [os.path.basename(layerroot) for layerroot in layerroots]
+    for layername in list(layers):
+        if layername not in layernames:
+            if debug: print('Layer %s removed from inventory' %(layername))
+            del layers[layername]
+    scanned = 0
+    for layerroot, layername in zip(layerroots, layernames):
+        if layername in layers and not rescan:
+            stamp = getLayerStamp(layerroot)
+            if stamp is None or stamp == layers[layername]['stamp']: continue
+        layers[layername] = scanLayer(layerroot, debug)
+        scanned += 1
+    print('Inventory of %s: %d layers, %d scanned' %(indir, len(layers), scanned))
+    return inventory
+
+
+def getCellLayers(inventory, indir, cells = None):
+    ''' Invert the inventory: return for every cell (or only for the cells in
+    cells) the list of (layer name, tile, size, mtime) tuples of the layers
+    that have a tile for it, in the order of the layer names '''
+    celllayers = {}
+    for layername in sorted(inventory['layers']):
+        layer = inventory['layers'][layername]
+        if cells is None: layercells = layer['cells']
+        else: layercells = [cellstr for cellstr in cells if cellstr in layer['cells']]
+        for cellstr in layercells:
+            size, mtime = layer['cells'][cellstr]
+            if cellstr not in celllayers: celllayers[cellstr] = []
+            celllayers[cellstr].append((layername, os.path.join(indir, layername, getFilePath(cellstr)), size, mtime))
+    return celllayers
+
+
+def getCellInputs(inventory, celllayers, cellstr):
+    ''' Return the inputs of the stack of a cell as list of
+    (layer name, tile, band descriptions) tuples; see stacktile.stackCell() '''
+    return [(layername, filepath, inventory['layers'][layername]['bands'])
+            for layername, filepath, size, mtime in celllayers.get(cellstr, [])]
+
+
+def saveCellInputs(inputs, outdir):
+    ''' Write the inputs of the cells of one stacking job, {cell name: see
+    getCellInputs()}, to a new file in outdir and return its name, so that the
+    job does not have to load and invert the whole inventory '''
+    if not os.path.exists(outdir): os.makedirs(outdir)
+    fd, filename = tempfile.mkstemp(prefix = 'inputs_', suffix = '.json', dir = outdir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as outfile:
+        json.dump(inputs, outfile, separators=(',', ':'))
+    return filename
+
+
+def loadCellInputs(filename):
+    ''' Read the inputs of a stacking job written by saveCellInputs() '''
+    with open(filename, mode='r', encoding='utf-8') as infile:
+        inputs = json.load(infile)
+    return dict([(cellstr, [tuple(entry) for entry in inputs[cellstr]]) for cellstr in inputs])
+
+
+def getCellFingerprint(celllayers, cellstr):
+    ''' Return the fingerprint of the tiles of a cell without touching the
+    file system; identical to getFingerprint() of the tiles '''
+    return getStatsFingerprint([(filepath, size, mtime) for layername, filepath, size, mtime in celllayers.get(cellstr, [])])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Basic tools for running jobs such as GDAL calls or python scripts on a pool of
+local worker processes. Mirrors the interface of slurm_utils for machines
+without a scheduler.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import multiprocessing
+
+
+def createLocalPool(workers = None, initializer = None, initargs = ()):
+    """
+    Function that creates a pool of worker processes. If no number of workers is
+    given, one worker per CPU is started.
+    """
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    return multiprocessing.Pool(processes = workers, initializer = initializer, initargs = initargs)
+
+def runCommand(commandstring):
+    """
+    Runs a command string in a worker process, the local equivalent of a SLURM job.
+    """
+    return os.system(commandstring)
+
+def timedCall(func, args):
+    """
+    Runs func(*args) and returns the worker's process ID and the run time
+    together with the result.
+    """
+    start = time.time()
+    result = func(*args)
+    return (os.getpid(), time.time() - start, result)
+
+def submitLocalJob(pool, func, args, joblist, debug = False):
+    """
+    Function that hands func(*args) to the pool and adds the pending result to a
+    list of jobs.
+    """
+    job = pool.apply_async(timedCall, (func, args))
+    joblist.append((job, time.time()))
+    if debug:
+        print('submitted %s%s' %(func.__name__, str(args)))
+    return joblist
+
+def collectLocalJobs(joblist, debug = False):
+    """
+    Waits until all jobs that were so far submitted are finished, reports the
+    throughput of each worker and returns the results of the jobs in the order
+    they were submitted (None for failed jobs)
+    """
+    if not joblist:
+        return []
+    if debug:
+        print('%d jobs in queue' %(len(joblist)))
+    first = min([submitted for job, submitted in joblist])
+    workers = {}
+    failed = 0
+    results = []
+    for job, submitted in joblist:
+        try:
+            pid, elapsed, result = job.get()
+        except Exception as err:
+            print('Job failed: %s' %(err))
+            failed += 1
+            results.append(None)
+            continue
+        addWorkerTime(workers, pid, elapsed)
+        results.append(result)
+    reportThroughput(workers, len(joblist), failed, time.time() - first)
+    return results
+
+def checkLocalJobs(joblist, debug = False):
+    """
+    Waits until all jobs that were so far submitted are finished, reports the
+    throughput of each worker and afterwards empties list of jobs
+    """
+    collectLocalJobs(joblist, debug)
+    joblist = []
+    return joblist
+
+def addWorkerTime(workers, pid, elapsed):
+    """
+    Adds a finished job to the per-worker statistics {pid: [jobs, busy seconds]}
+    """
+    if pid not in workers:
+        workers[pid] = [0, 0.0]
+    workers[pid][0] += 1
+    workers[pid][1] += elapsed
+
+def reportThroughput(workers, njobs, failed, wall):
+    """
+    Prints the number of jobs and the throughput of every worker
+    """
+    print('%d jobs finished in %g seconds (%d failed)' %(njobs, wall, failed))
+    for pid in sorted(workers):
+        count, busy = workers[pid]
+        if busy > 0:
+            rate = count / busy
+        else:
+            rate = float('inf')
+        print('worker %d: %d jobs, %g seconds busy, %g jobs/s' %(pid, count, busy, rate))
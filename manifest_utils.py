@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Tile manifest that records per cell how and from what a tile was created, so
+that interrupted or repeated runs only recompute missing, failed or stale cells
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import hashlib
+import shutil
+
+MANIFEST_NAME = 'manifest.json'
+
+# states of a cell that do not need to be recomputed
+FINAL_STATES = ['done', 'empty']
+
+
+def getFingerprint(filenames):
+    ''' Return a short fingerprint of a list of files based on their absolute
+    paths, sizes and modification times '''
+    stats = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        stats.append((filename, stat.st_size, stat.st_mtime))
+    return getStatsFingerprint(stats)
+
+
+def getStatsFingerprint(stats):
+    ''' Return the fingerprint of a list of (filename, size, mtime) tuples that
+    were read before, e.g. from a layer inventory; see getFingerprint() '''
+    md5 = hashlib.md5()
+    for filename, size, mtime in stats:
+        md5.update(('%s %d %d\n' %(os.path.abspath(filename), size, int(mtime))).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def loadManifest(outdir):
+    ''' Read the manifest of an output directory; returns an empty manifest if
+    there is none yet '''
+    filename = os.path.join(outdir, MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return {'cells': {}}
+    with open(filename, mode='r', encoding='utf-8') as infile:
+        manifest = json.load(infile)
+    if 'cells' not in manifest:
+        manifest['cells'] = {}
+    return manifest
+
+
+def saveManifest(outdir, manifest):
+    ''' Write the manifest of an output directory. The file is replaced
+    atomically, so an interrupted run never leaves a truncated manifest. '''
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    filename = os.path.join(outdir, MANIFEST_NAME)
+    tmpname = '%s.%d.tmp' %(filename, os.getpid())
+    with open(tmpname, mode='w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(tmpname, filename)
+
+
+def recordCell(manifest, cellstr, fingerprint, params, status):
+    ''' Record the result of creating the tile of a cell
+
+        @type manifest:     C{dict}
+        @param manifest:    manifest, see loadManifest()
+        @type cellstr:      C{str}
+        @param cellstr:     name of the cell
+        @type fingerprint:  C{str}
+        @param fingerprint: fingerprint of the input data, see getFingerprint()
+        @type params:       C{dict}
+        @param params:      parameters the tile was created with
+        @type status:       C{str}
+        @param status:      'done', 'empty' or 'failed'
+    '''
+    manifest['cells'][cellstr] = {'fingerprint': fingerprint, 'params': params,
+                                  'status': status, 'timestamp': time.time()}
+
+
+def needsUpdate(manifest, cellstr, fingerprint, params, filepath = None):
+    ''' Returns True if the tile of a cell is missing, failed or was created from
+    other input data or with other parameters. If filepath is given, cells
+    recorded as done whose tile has disappeared are recomputed as well. '''
+    entry = manifest['cells'].get(cellstr)
+    if entry is None:
+        return True
+    if entry.get('status') not in FINAL_STATES:
+        return True
+    if entry.get('fingerprint') != fingerprint or entry.get('params') != params:
+        return True
+    if filepath and entry.get('status') == 'done' and not os.path.exists(filepath):
+        return True
+    return False
+
+
+def hasData(manifest, cellstr):
+    ''' Returns True if the manifest records an existing tile for a cell '''
+    entry = manifest['cells'].get(cellstr)
+    return entry is not None and entry.get('status') == 'done'
+
+
+def getTileStatus(filepath, succeeded = True):
+    ''' Derive the status of a cell from its tile after an external command
+    (gdalwarp, SLURM job) has finished. A command that failed, e.g. a job killed
+    at its time limit, may have left an incomplete tile, which is deleted; the
+    existence of a tile is only trusted after a successful command. '''
+    if not succeeded:
+        if os.path.isdir(filepath): shutil.rmtree(filepath) # e.g. a Zarr array
+        elif os.path.exists(filepath): os.remove(filepath)
+        return 'failed'
+    if os.path.exists(filepath):
+        return 'done'
+    return 'empty'
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+Tiling of a collection of input rasters (e.g. adjacent Landsat scenes) into a
+single layer. The footprints of the sources are indexed once; every tile is
+only warped from the sources that intersect its cell, and overlapping valid
+pixels are resolved by a rule (first, last or maxvalid).
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import numpy
+
+from osgeo import gdal, ogr
+from gdalconst import *
+
+from data_utils import *
+from warp_utils import *
+from instrument_utils import *
+
+# rules for pixels that are valid in several sources: the first or last source
+# in the order of the input list wins, or the one with the largest mean of the
+# valid bands of the pixel
+OVERLAP_RULES = ['first', 'last', 'maxvalid']
+# footprints of the sources, written next to the tiles for single-cell jobs
+MOSAIC_INDEX_NAME = 'sources.json'
+
+
+def readSourceList(listfile):
+    ''' Return the input rasters of a mosaic, one per line of listfile '''
+    with open(listfile, mode='r', encoding='utf-8') as sourcefile:
+        return [line.strip() for line in sourcefile if line.strip()]
+
+
+class SourceIndex(object):
+    """
+    Index over the valid-data footprints of all sources in target (rHEALPix
+    plane) coordinates. Cells are tested against the bounding boxes of all
+    footprints at once and only exactly against those they touch.
+    """
+
+    def __init__(self, infiles, t_srs, footprints = None, debug = False):
+        self.infiles = list(infiles)
+        if footprints is None:
+            footprints = []
+            for infile in self.infiles:
+                footprint = getFootprint(infile, t_srs)
+                if debug: print('Footprint of %s: %s' %(infile, 'empty' if footprint is None else 'done'))
+                footprints.append(None if footprint is None else footprint.ExportToWkt())
+        self.wkts = footprints
+        self.setup()
+
+    def setup(self):
+        ''' Create the geometries and the (sources, 4) array of their envelopes '''
+        self.footprints = [None if wkt is None else ogr.CreateGeometryFromWkt(wkt) for wkt in self.wkts]
+        self.envelopes = numpy.full((len(self.footprints), 4), numpy.nan)
+        for k in range(len(self.footprints)):
+            if self.footprints[k] is None: continue
+            e = self.footprints[k].GetEnvelope()
+            self.envelopes[k] = (e[0], e[2], e[1], e[3])
+
+    def __getstate__(self):
+        # geometries can not be pickled; worker processes rebuild them from WKT
+        return {'infiles': self.infiles, 'wkts': self.wkts}
+
+    def __setstate__(self, state):
+        self.infiles = state['infiles']
+        self.wkts = state['wkts']
+        self.setup()
+
+    def getSources(self, bounds):
+        ''' Return the indices of the sources whose footprints intersect
+        bounds (xmin, ymin, xmax, ymax), in the order of the input list '''
+        e = self.envelopes
+        with numpy.errstate(invalid = 'ignore'): # sources without valid data
+            candidates = numpy.nonzero((e[:, 0] <= bounds[2]) & (e[:, 2] >= bounds[0]) &
+                                       (e[:, 1] <= bounds[3]) & (e[:, 3] >= bounds[1]))[0]
+        if len(candidates) == 0:
+            return []
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in [(bounds[0], bounds[3]), (bounds[2], bounds[3]), (bounds[2], bounds[1]), (bounds[0], bounds[1])]:
+            ring.AddPoint_2D(x, y)
+        ring.CloseRings()
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        return [k for k in candidates if self.footprints[k].Intersects(polygon)]
+
+    def getUnion(self):
+        ''' Return the union of all footprints, e.g. for getCellsOutsideFootprint() '''
+        union = ogr.Geometry(ogr.wkbMultiPolygon)
+        for footprint in self.footprints:
+            if footprint is None: continue
+            if footprint.GetGeometryType() in [ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D]:
+                for part in range(footprint.GetGeometryCount()):
+                    union.AddGeometry(footprint.GetGeometryRef(part))
+            else:
+                union.AddGeometry(footprint)
+        if union.GetGeometryCount() == 0:
+            return None
+        return union.UnionCascaded()
+
+    def save(self, filename):
+        ''' Write the footprints to a JSON file (atomically, as single-cell jobs may read it) '''
+        tmpfile = filename + '.tmp%d' %(os.getpid())
+        with open(tmpfile, mode='w', encoding='utf-8') as outfile:
+            json.dump({'infiles': self.infiles, 'footprints': self.wkts,
+                       'stamps': [os.path.getmtime(infile) for infile in self.infiles]}, outfile)
+        os.replace(tmpfile, filename)
+
+
+def getSourceIndex(infiles, t_srs, outfileroot, debug = False):
+    ''' Return the SourceIndex of a mosaic. The footprints are reused from the
+    index file in outfileroot if it was written for the same (unchanged)
+    sources, otherwise they are computed and the file is written. '''
+    filename = os.path.join(outfileroot, MOSAIC_INDEX_NAME)
+    if os.path.exists(filename):
+        with open(filename, mode='r', encoding='utf-8') as infile:
+            saved = json.load(infile)
+        if saved['infiles'] == list(infiles) and \
+           saved['stamps'] == [os.path.getmtime(source) for source in infiles]:
+            return SourceIndex(infiles, t_srs, saved['footprints'], debug)
+    index = SourceIndex(infiles, t_srs, debug = debug)
+    if not os.path.exists(outfileroot): os.makedirs(outfileroot)
+    index.save(filename)
+    return index
+
+
+def getValidMean(array, valid):
+    ''' Return the mean of the valid bands of every pixel of an array of shape
+    (bands, ysize, xsize); -inf for pixels without valid bands '''
+    count = valid.sum(axis = 0)
+    total = numpy.where(valid, array, 0).astype(numpy.float64).sum(axis = 0)
+    return numpy.where(count > 0, total / numpy.maximum(count, 1), -numpy.inf)
+
+
+class MosaicWarper(object):
+    """
+    Warps the tile of a cell from all sources that intersect it and merges
+    them according to an overlap rule. Every source gets its own TileWarper,
+    which is only created when a cell first needs the source.
+    """
+
+    def __init__(self, index, t_srs, dstnodata, tilesize = 729, blocksize = 243, resample = 'cubic',
+                 rule = 'first', debug = False, overviews = False, profile = None):
+        if rule not in OVERLAP_RULES:
+            raise ValueError('Unknown overlap rule: %s' %(rule))
+        self.index = index
+        self.t_srs = t_srs
+        self.dstnodata = dstnodata
+        self.tilesize = tilesize
+        self.blocksize = blocksize
+        self.resample = resample
+        self.rule = rule
+        self.debug = debug
+        self.overviews = overviews
+        self.profile = profile
+        self.warpers = {}
+
+    def getWarper(self, k):
+        ''' Return the TileWarper of source k '''
+        if k not in self.warpers:
+            infile = self.index.infiles[k]
+            src_ds = gdal.Open(infile, GA_ReadOnly)
+            s_srs = src_ds.GetProjection()
+            src_ds = None
+            self.warpers[k] = TileWarper(infile, s_srs, self.t_srs, self.dstnodata, self.tilesize,
+                                         self.blocksize, self.resample, self.debug, self.overviews, self.profile)
+        return self.warpers[k]
+
+    def warpArray(self, bounds):
+        ''' Warp the tile with the given bounds from the intersecting sources
+
+            @rtype:     C{tuple}
+            @return:    (array of shape (bands, tilesize, tilesize) or None if no
+                        source intersects, number of warped sources, True if warping failed)
+        '''
+        sources = self.index.getSources(bounds)
+        if self.rule == 'last': sources = sources[::-1]
+        result = None
+        warped = 0
+        for k in sources:
+            array = self.getWarper(k).warpArray(bounds)
+            warped += 1
+            if array is None:
+                return None, warped, True
+            # pixels are taken with all their bands from one source, so that no
+            # spectrum is combined from several sources
+            valid = getValidMask(array, self.dstnodata)
+            pixelvalid = valid.any(axis = 0)
+            if self.rule == 'maxvalid': score = getValidMean(array, valid)
+            if result is None:
+                result = array
+                filled = pixelvalid
+                if self.rule == 'maxvalid': best = score
+                self.first = k
+            else:
+                if self.rule == 'maxvalid': take = pixelvalid & (~filled | (score > best))
+                else: take = pixelvalid & ~filled
+                result[:, take] = array[:, take]
+                if self.rule == 'maxvalid': best[take] = score[take]
+                filled |= pixelvalid
+            if self.rule != 'maxvalid' and filled.all():
+                break # the remaining sources are hidden completely
+        return result, warped, False
+
+    def writeTile(self, filepath, array, bounds):
+        ''' Write a merged tile with the data type and band names of the first source '''
+        return self.getWarper(self.first).writeTile(filepath, array, bounds)
+
+    def close(self):
+        for k in self.warpers:
+            self.warpers[k].close()
+        self.warpers = {}
+
+
+def warpMosaicCell(mosaic, filepath, bounds):
+    ''' Create the tile of a single cell from all sources of a mosaic that
+    intersect it. The tile is only written if it contains valid data.
+
+        @type mosaic:   C{MosaicWarper}
+        @param mosaic:  warping engine of the mosaic
+        @rtype:         C{str}
+        @return:        'done', 'empty' or 'failed'
+    '''
+    cellstr = getCellFromTilePath(filepath)
+    with timedStage('warp', cellstr) as event:
+        array, warped, failed = mosaic.warpArray(bounds)
+        event['sources'] = warped
+        event['status'] = 'failed' if failed else 'done'
+    if failed:
+        return 'failed'
+    if array is None or isEmptyArray(array, mosaic.dstnodata):
+        if mosaic.debug: print('Empty tile detected: %s' %(filepath))
+        return 'empty'
+    with timedStage('write', cellstr) as event:
+        written = mosaic.writeTile(filepath, array, bounds)
+        if written: event['byteswritten'] = getFileSize(filepath)
+    if not written:
+        return 'failed'
+    return 'done'
+
+
+# MosaicWarper of the current worker process, see initMosaicWorker()
+_workermosaic = None
+
+def initMosaicWorker(warperargs, index, mosaicargs):
+    ''' Pool initializer that creates one MosaicWarper per worker process and
+    the TileWarper for the lower resolutions, see initWorkerWarper() '''
+    global _workermosaic
+    initWorkerWarper(*warperargs)
+    _workermosaic = MosaicWarper(index, *mosaicargs)
+
+def warpMosaicCellWorker(filepath, bounds):
+    ''' Create a single tile with the MosaicWarper of the current worker process,
+    see warpMosaicCell() '''
+    return warpMosaicCell(_workermosaic, filepath, bounds)
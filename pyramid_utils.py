@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Fused bottom-up creation of rHEALPix tile pyramids. Every parent tile is
+aggregated in memory from the tiles of its 3x3 subcells, so lower resolutions
+are never warped again from files on disk
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import numpy
+
+from data_utils import *
+from warp_utils import *
+from instrument_utils import *
+from manifest_utils import *
+
+# Weights of the separable 3x3 reductions that stand in for the gdalwarp kernels
+# when a tile is downsampled by a factor of 3. The kernels are evaluated at the
+# centres of the three subpixels, i.e. at -1/3, 0 and 1/3 output pixels.
+KERNELS = {
+    'average': [1., 1., 1.],
+    'bilinear': [2./3., 1., 2./3.],
+    'cubic': [7./9., 1., 7./9.], # cubic convolution (Keys, a = -0.5)
+}
+
+# gdalwarp resampling methods and their block reduction
+REDUCTIONS = {
+    'near': 'near',
+    'mode': 'mode',
+    'average': 'average',
+    'bilinear': 'bilinear',
+    'cubic': 'cubic',
+    'cubicspline': 'cubic',
+    'lanczos': 'cubic',
+    'min': 'min',
+    'max': 'max',
+}
+
+
+def castToType(array, dtype):
+    ''' Round and clip a float array so that it fits into an integer data type '''
+    if numpy.dtype(dtype).kind in 'iu':
+        info = numpy.iinfo(dtype)
+        array = numpy.clip(numpy.rint(array), info.min, info.max)
+    return array.astype(dtype)
+
+
+def aggregateBlocks(mosaic, method, nodata):
+    ''' Reduce every 3x3 block of pixels to a single pixel
+
+        @type mosaic:   C{numpy.ndarray}
+        @param mosaic:  array of shape (bands, 3*ysize, 3*xsize)
+        @type method:   C{str}
+        @param method:  gdalwarp resampling method, see REDUCTIONS
+        @type nodata:   C{int/float}
+        @param nodata:  nodata value; nodata pixels are ignored
+        @rtype:         C{numpy.ndarray}
+        @return:        array of shape (bands, ysize, xsize)
+    '''
+    bands, ysize, xsize = mosaic.shape
+    ny = ysize // 3
+    nx = xsize // 3
+    blocks = mosaic.reshape(bands, ny, 3, nx, 3)
+    if method not in REDUCTIONS:
+        print('No block reduction for resampling method %s. Using average' %(method))
+    method = REDUCTIONS.get(method, 'average')
+
+    if method == 'near': # the centre pixel is the nearest neighbour
+        return blocks[:, :, 1, :, 1].copy()
+
+    valid = getValidMask(blocks, nodata)
+    anyvalid = valid.any(axis = (2, 4))
+    if nodata is None: fill = 0
+    else: fill = nodata
+
+    if method == 'mode':
+        values = blocks.transpose(0, 1, 3, 2, 4).reshape(bands, ny, nx, 9)
+        valid = valid.transpose(0, 1, 3, 2, 4).reshape(bands, ny, nx, 9)
+        counts = numpy.zeros(values.shape, dtype = numpy.int8)
+        for k in range(9):
+            counts += (values == values[..., k:k+1]) & valid[..., k:k+1]
+        counts[~valid] = -1
+        index = numpy.argmax(counts, axis = -1)
+        result = numpy.take_along_axis(values, index[..., numpy.newaxis], axis = -1)[..., 0]
+        result[~anyvalid] = fill
+        return result
+
+    if method in ['min', 'max']:
+        values = blocks.astype(numpy.float64)
+        if method == 'min':
+            result = numpy.where(valid, values, numpy.inf).min(axis = (2, 4))
+        else:
+            result = numpy.where(valid, values, -numpy.inf).max(axis = (2, 4))
+    else:
+        kernel = numpy.array(KERNELS[method])
+        weights = numpy.outer(kernel, kernel).reshape(1, 1, 3, 1, 3)
+        validweights = valid * weights
+        total = (numpy.where(valid, blocks, 0).astype(numpy.float64) * weights).sum(axis = (2, 4))
+        weightsum = validweights.sum(axis = (2, 4))
+        result = total / numpy.where(anyvalid, weightsum, 1.)
+    result[~anyvalid] = fill
+    return castToType(result, mosaic.dtype)
+
+
+def mosaicChildren(children, bounds, tilesize, nodata):
+    ''' Combine the tiles of up to nine subcells into one array of three times
+    the tile size; missing subcells are filled with nodata
+
+        @type children:   C{list}
+        @param children:  list of (bounds, array) tuples of the subcells
+        @type bounds:     C{tuple/list}
+        @param bounds:    (xmin, ymin, xmax, ymax) of the parent cell
+        @rtype:           C{numpy.ndarray}
+        @return:          array of shape (bands, 3*tilesize, 3*tilesize)
+    '''
+    bands = children[0][1].shape[0]
+    dtype = children[0][1].dtype
+    if nodata is None: nodata = 0
+    mosaic = numpy.full((bands, 3*tilesize, 3*tilesize), nodata, dtype = dtype)
+    width = (bounds[2] - bounds[0]) / 3.
+    for childbounds, array in children:
+        col = int(round((childbounds[0] - bounds[0]) / width))
+        row = int(round((bounds[3] - childbounds[3]) / width))
+        mosaic[:, row*tilesize:(row+1)*tilesize, col*tilesize:(col+1)*tilesize] = array
+    return mosaic
+
+
+def getPyramidContext(rddgs, outfileroot, minres, maxres, nw, se, resample, excludelist = [], debug = False,
+                      skipcells = set()):
+    ''' Collect everything the depth-first walk needs to know about the region;
+    cells in skipcells are left out at all resolutions '''
+    levelcells = {}
+    topcells = []
+    for i in range(minres, maxres+1):
+        grid = rddgs.cells_from_region(i, nw, se, plane=False)
+        levelcells[i] = set([str(c) for row in grid for c in row]) - skipcells
+        if i == minres: topcells = [str(c) for row in grid for c in row if str(c) not in skipcells]
+    context = {'outfileroot': outfileroot, 'minres': minres, 'maxres': maxres,
+               'levelcells': levelcells, 'topcells': topcells, 'resample': resample,
+               'excludelist': set(excludelist), 'debug': debug, 'stale': None}
+    return context
+
+
+def setStaleCells(context, manifest, fingerprint, params):
+    ''' Restrict the walk to the cells that need to be updated according to the
+    manifest and to their ancestors, whose subcells change. Tiles of all other
+    cells are read from disk instead of being built. Returns the stale cells
+    of minres. '''
+    stale = set()
+    for i in context['levelcells']:
+        for cellstr in context['levelcells'][i]:
+            if cellstr in stale: continue
+            if needsUpdate(manifest, cellstr, fingerprint, params,
+                           os.path.join(context['outfileroot'], getFilePath(cellstr))):
+                for res in range(context['minres'], i+1):
+                    stale.add(cellstr[:res+1])
+    context['stale'] = stale
+    return [cellstr for cellstr in context['topcells'] if cellstr in stale]
+
+
+def getSplitResolution(context, topcells, workers):
+    ''' Return the coarsest resolution that has at least as many cells below
+    topcells as there are workers (at most maxres) and these cells. Their
+    subtrees are built by the workers, the levels above by the driver. '''
+    topset = set(topcells)
+    minres = context['minres']
+    for i in range(minres, context['maxres']+1):
+        cells = sorted([cellstr for cellstr in context['levelcells'][i] if cellstr[:minres+1] in topset])
+        if context['stale'] is not None: cells = [cellstr for cellstr in cells if cellstr in context['stale']]
+        if len(cells) >= workers:
+            break
+    return i, cells
+
+
+def buildPyramidCell(c, res, warper, context, statuses = None, built = None):
+    ''' Depth-first creation of the tile of cell c and of all its descendants.
+    The tile at maxres is warped from the source, all others are aggregated
+    from their subcells as soon as these are finished. Cells that are up to
+    date (see setStaleCells()) are read from disk together with their subtree.
+
+        @type c:          C{rhealpix_dggs.dggs.Cell}
+        @param c:         rHEALPix cell
+        @type res:        C{int}
+        @param res:       resolution of the cell
+        @type warper:     C{warp_utils.TileWarper}
+        @param warper:    warping engine with the opened source dataset
+        @type context:    C{dict}
+        @param context:   see getPyramidContext()
+        @type statuses:   C{dict}
+        @param statuses:  'done' or 'empty' for every visited cell, updated in place
+        @type built:      C{dict}
+        @param built:     tiles (or None) of cells whose subtrees were built already,
+                          e.g. by workers; these cells are not visited again
+        @rtype:           C{numpy.ndarray}
+        @return:          the tile or None if it contains no valid data
+    '''
+    cellstr = str(c)
+    if built is not None and cellstr in built:
+        return built.pop(cellstr)
+    bounds = getCellBounds(c)
+    filepath = os.path.join(context['outfileroot'], getFilePath(c))
+    if context['stale'] is not None and cellstr not in context['stale']:
+        if not os.path.exists(filepath): # recorded as empty
+            return None
+        with timedStage('read', cellstr):
+            array = warper.readTile(filepath)
+        if array is not None:
+            return array
+        print('Could not read %s. Building it again' %(filepath))
+    if res == context['maxres']:
+        if cellstr in context['excludelist']:
+            return None
+        with timedStage('warp', cellstr):
+            array = warper.warpArray(bounds)
+    else:
+        children = []
+        for cell in c.subcells():
+            if str(cell) in context['levelcells'][res+1]:
+                subarray = buildPyramidCell(cell, res+1, warper, context, statuses, built)
+                if subarray is not None:
+                    children.append((getCellBounds(cell), subarray))
+        if children:
+            with timedStage('aggregate', cellstr, inputs = len(children)):
+                mosaic = mosaicChildren(children, bounds, warper.tilesize, warper.dstnodata)
+                children = None
+                array = aggregateBlocks(mosaic, context['resample'], warper.dstnodata)
+                mosaic = None
+        else:
+            array = None
+    with timedStage('emptycheck', cellstr) as event:
+        empty = array is None or isEmptyArray(array, warper.dstnodata)
+        event['status'] = 'empty' if empty else 'done'
+    if empty:
+        if context['debug']: print('Empty tile detected: %s' %(cellstr))
+        if os.path.exists(filepath): os.remove(filepath) # tile of an earlier run
+        if statuses is not None: statuses[cellstr] = 'empty'
+        return None
+    if not os.path.exists(os.path.dirname(filepath)):
+        if context['debug']: print('now will create %s' %(os.path.dirname(filepath)))
+        try:
+            os.makedirs(os.path.dirname(filepath))
+        except OSError: # created by another worker in the meantime
+            pass
+    with timedStage('write', cellstr) as event:
+        warper.writeTile(filepath, array, bounds)
+        event['byteswritten'] = getFileSize(filepath)
+    if statuses is not None: statuses[cellstr] = 'done'
+    return array
+
+
+def buildFusedPyramid(rddgs, warper, context, topcells = None, built = None):
+    ''' Create the pyramid of the region (or of the subtrees of topcells only) in
+    one process. Returns the status of every visited cell. '''
+    if topcells is None: topcells = context['topcells']
+    statuses = {}
+    for cellstr in topcells:
+        buildPyramidCell(getCell(rddgs, cellstr), context['minres'], warper, context, statuses, built)
+    return statuses
+
+
+# state of the current worker process, see initPyramidWorker()
+_pyramidworker = {}
+
+def initPyramidWorker(warperargs, context):
+    ''' Pool initializer that sets up one TileWarper and DGGS per worker process '''
+    _pyramidworker['warper'] = TileWarper(*warperargs)
+    _pyramidworker['rddgs'] = getStandardDGGS()
+    _pyramidworker['context'] = context
+
+def buildPyramidWorker(cellstr):
+    ''' Create the subtree of one cell (of the split resolution, see
+    getSplitResolution()) in a worker process and return the status of every
+    visited cell and the tile of the cell, which the driver aggregates further '''
+    statuses = {}
+    c = getCell(_pyramidworker['rddgs'], cellstr)
+    array = buildPyramidCell(c, len(cellstr) - 1, _pyramidworker['warper'],
+                             _pyramidworker['context'], statuses)
+    return statuses, array
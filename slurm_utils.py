@@ -1,96 +1,380 @@
-#!/usr/bin/env python
-"""
-Basic tools for submitting jobs such as GDAL calls or python scripts on a SLURM-based
-system. Developed on the NeSI Pan Cluster
-https://wiki.auckland.ac.nz/display/CERES/NeSI+Pan+Cluster
-
-"""
-# This file is part of scenzgrid.py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import os
-import subprocess
-import time
-import sys
-
-
-def submitSLURMjob(commandstring, joblist, debug = False):
-    """
-    Function that writes a job file for SLURM, submits it and adds its ID to a list
-    of jobs.
-    """
-    template = open('template.sl')
-    templatestr = template.read()
-    template.close()
-    jobstr = templatestr + commandstring
-    outfile = open('jobfile.sl', 'w')
-    outfile.write(jobstr + '\n')
-    outfile.close()
-    outputstring = subprocess.check_output(['sbatch', 'jobfile.sl']).decode("utf-8")
-    if debug:
-        print('outputstring >>>')
-        print(outputstring)
-        print('<<< outputstring')
-    #job = outputstring.split(' ')[3].strip("\"") # we only need the job id
-    job = outputstring.split(' ')[3].rstrip()
-    joblist.append(job)
-    if debug:
-        print(job)
-    return joblist
-
-def checkSLURMjobs(joblist, timestep = 1, debug = False):
-    """
-    Checks if all jobs that were so far submitted are finished and afterwards
-    empties list of jobs
-    """
-    if debug:
-        print('%d jobs in queue' %(len(joblist)))
-        for job in joblist:
-            print(job)
-    finished = False
-    for job in joblist:
-        if debug:
-            print('current job: %s' %(job))
-        #status = os.system('squeue -j %s \| grep %s' %(job, job)).split()[4]
-        '''output = subprocess.check_output(['squeue', '-j', job])
-        tokens = output.split()
-        status = str(tokens[12], encoding='UTF-8')'''
-        status = 'PD' # just to get the loop started
-        #print('status = >>%s<<' %(status)) 
-        while status == 'PD' or status == 'R' or status == 'CG' or status == 'S':            
-            if debug:
-                print('%s Status: %s; not finished yet' %(job, status))
-            #status = os.system('squeue -j %s \| grep %s' %(job, job)).split()[4]
-            try: 
-                output = subprocess.check_output(['squeue', '-j', job])
-                tokens = output.split()
-                status = str(tokens[12], encoding='UTF-8')
-                #print(status)
-            except (subprocess.CalledProcessError, IndexError):
-                #print("All current jobs finished")
-                #finished = True
-                break
-            time.sleep(timestep)
-        #if finished: break
-        print('%s will now be removed from list' %job)
-    joblist = []
-    return joblist
-
-
-
-
-
+#!/usr/bin/env python
+"""
+Basic tools for submitting jobs such as GDAL calls or python scripts on a SLURM-based
+system. Developed on the NeSI Pan Cluster
+https://wiki.auckland.ac.nz/display/CERES/NeSI+Pan+Cluster
+
+"""
+# This file is part of scenzgrid.py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import getpass
+import subprocess
+import tempfile
+import time
+import sys
+
+from instrument_utils import *
+
+
+def readTemplate(templatefile = 'template.sl'):
+    """
+    Returns the header of the SLURM job files (account, time limit, modules etc.)
+    """
+    template = open(templatefile)
+    templatestr = template.read()
+    template.close()
+    return templatestr
+
+def writeJobFile(jobstr, prefix = 'jobfile_', suffix = '.sl', jobdir = None):
+    """
+    Writes a file with a unique name to the job directory (default: current
+    directory) so that several drivers can share one working directory
+    """
+    if jobdir is None: jobdir = os.getcwd()
+    fd, filename = tempfile.mkstemp(prefix = prefix, suffix = suffix, dir = jobdir)
+    outfile = os.fdopen(fd, 'w')
+    outfile.write(jobstr + '\n')
+    outfile.close()
+    return filename
+
+def sbatch(jobfile, options = [], debug = False):
+    """
+    Submits a job file and returns the job ID
+    """
+    start = time.time()
+    outputstring = subprocess.check_output(['sbatch'] + options + [jobfile]).decode("utf-8")
+    seconds = time.time() - start
+    if debug:
+        print('outputstring >>>')
+        print(outputstring)
+        print('<<< outputstring')
+    #job = outputstring.split(' ')[3].strip("\"") # we only need the job id
+    job = outputstring.split(' ')[3].rstrip()
+    if debug:
+        print(job)
+    logEvent('submit', seconds = seconds, job = job)
+    return job
+
+def submitSLURMjob(commandstring, joblist, options = [], debug = False):
+    """
+    Function that writes a job file for SLURM, submits it and adds its ID to a list
+    of jobs. Additional sbatch options such as dependencies can be given as a list.
+    """
+    jobfile = writeJobFile(readTemplate() + commandstring)
+    job = sbatch(jobfile, options, debug = debug)
+    os.remove(jobfile) # sbatch keeps its own copy of the job script
+    joblist.append(job)
+    return joblist
+
+# task manifests of submitted job arrays (and other files read by jobs), removed
+# once the job has finished
+_jobmanifests = {}
+
+def addJobManifest(job, manifest):
+    """
+    Registers a file that a job reads, e.g. the list of cells it creates; the
+    file is deleted once the job has finished, see removeJobManifest()
+    """
+    _jobmanifests[job] = manifest
+
+def removeJobManifest(job):
+    """
+    Deletes the task manifest of a job array after the array has finished
+    """
+    manifest = _jobmanifests.pop(job, None)
+    if manifest is not None and os.path.exists(manifest):
+        os.remove(manifest)
+
+def submitSLURMjobArray(commands, joblist, bundlesize = 1, maxtasks = None, debug = False):
+    """
+    Function that writes all commands to a task manifest and submits them as a
+    single SLURM job array. Every array task runs a bundle of bundlesize
+    consecutive commands of the manifest. The ID of the array is added to the
+    list of jobs; the manifest is deleted when pollSLURMjobs() sees the
+    array finish.
+    """
+    if not commands:
+        return joblist
+    if bundlesize < 1: bundlesize = 1
+    manifest = writeJobFile('\n'.join([cmd.replace('\n', ' ') for cmd in commands]),
+                            prefix = 'manifest_', suffix = '.txt')
+    ntasks = (len(commands) + bundlesize - 1) // bundlesize
+    taskstr = '''
+MANIFEST=%s
+FIRST=$(( SLURM_ARRAY_TASK_ID * %d + 1 ))
+LAST=$(( FIRST + %d - 1 ))
+STATUS=0
+while IFS= read -r -u 3 cmd; do
+    eval "$cmd" || STATUS=1
+done 3< <(sed -n "${FIRST},${LAST}p" "$MANIFEST")
+exit $STATUS''' %(manifest, bundlesize, bundlesize)
+    jobfile = writeJobFile(readTemplate() + taskstr)
+    arraystr = '0-%d' %(ntasks - 1)
+    if maxtasks: arraystr = arraystr + '%%%d' %(maxtasks)
+    try:
+        job = sbatch(jobfile, ['--array=%s' %(arraystr)], debug = debug)
+    except (subprocess.CalledProcessError, OSError):
+        os.remove(manifest)
+        raise
+    finally:
+        os.remove(jobfile)
+    addJobManifest(job, manifest)
+    if debug:
+        print('%d commands submitted as job array %s with %d tasks (manifest: %s)' %(len(commands), job, ntasks, manifest))
+    joblist.append(job)
+    return joblist
+
+# SLURM job states after which a job will not change anymore
+TERMINAL_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED', 'NODE_FAIL', 'OUT_OF_MEMORY',
+                   'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'REVOKED']
+
+# states counted as success: without accounting a finished job is UNKNOWN, and
+# its tiles are then judged by the files it left behind
+SUCCESS_STATES = ['COMPLETED', 'UNKNOWN']
+
+def isJobSuccessful(state):
+    """
+    Returns True if a terminal job state counts as success, see SUCCESS_STATES
+    """
+    return state in SUCCESS_STATES
+
+def getBaseJob(jobid):
+    """
+    Returns the ID of the job (array) a squeue/sacct job ID such as 123_4 or
+    123_[5-9] belongs to
+    """
+    return jobid.split('_')[0].split('.')[0]
+
+def querySqueue(debug = False):
+    """
+    Returns the states of all queued and running jobs of the current user as a
+    dictionary {job: [state, ...]}, using a single squeue call. Tasks of a job
+    array are collected under the ID of the array.
+    """
+    output = subprocess.check_output(['squeue', '-h', '-r', '-u', getpass.getuser(),
+                                      '-o', '%i %T']).decode("utf-8")
+    active = {}
+    for line in output.splitlines():
+        tokens = line.split()
+        if len(tokens) < 2: continue
+        active.setdefault(getBaseJob(tokens[0]), []).append(tokens[1])
+    if debug: print('%d of our jobs known to squeue' %(len(active)))
+    return active
+
+def querySacct(joblist):
+    """
+    Returns the final state of each job in joblist using a single sacct call.
+    The state of a job array is COMPLETED only if all of its tasks completed,
+    otherwise it is the state of the first task that did not. Returns None if
+    accounting is not available.
+    """
+    try:
+        output = subprocess.check_output(['sacct', '-n', '-X', '-P', '-o', 'JobID,State',
+                                          '-j', ','.join(joblist)]).decode("utf-8")
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    states = {}
+    for line in output.splitlines():
+        tokens = line.split('|')
+        if len(tokens) < 2: continue
+        job = getBaseJob(tokens[0])
+        state = tokens[1].split(' ')[0] # e.g. 'CANCELLED by 1234'
+        if job not in states or states[job] == 'COMPLETED':
+            states[job] = state
+        elif state not in TERMINAL_STATES:
+            states[job] = state # some tasks have not finished yet
+    return states
+
+def getArrayTasks(jobid):
+    """
+    Returns the task IDs of a squeue/sacct job ID such as 123_4, 123_[5-9] or
+    123_[1,3,5-7%2] as a list; empty for jobs that are not tasks of an array
+    """
+    if '_' not in jobid:
+        return []
+    taskstr = jobid.split('_', 1)[1].split('.')[0].strip('[]').split('%')[0]
+    tasks = []
+    for part in taskstr.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            tasks.extend(range(int(first), int(last) + 1))
+        elif part.isdigit():
+            tasks.append(int(part))
+    return tasks
+
+def querySacctTasks(job):
+    """
+    Returns the final state of every task of a job array as a dictionary
+    {task: state} using a single sacct call. Returns None if accounting is not
+    available.
+    """
+    try:
+        output = subprocess.check_output(['sacct', '-n', '-X', '-P', '-o', 'JobID,State',
+                                          '-j', job]).decode("utf-8")
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    states = {}
+    for line in output.splitlines():
+        tokens = line.split('|')
+        if len(tokens) < 2: continue
+        for task in getArrayTasks(tokens[0]): # tasks that never started are listed as ranges
+            states[task] = tokens[1].split(' ')[0]
+    return states
+
+def getCommandStates(job, state, ncommands, bundlesize = 1):
+    """
+    Returns the state of every command of a finished job array (see
+    submitSLURMjobArray()) as a list, i.e. the state of the array task that
+    ran the bundle containing the command. The tasks are only queried if the
+    array as a whole did not succeed; tasks unknown to sacct keep the state of
+    the array.
+    """
+    if bundlesize < 1: bundlesize = 1
+    taskstates = {}
+    if not isJobSuccessful(state):
+        taskstates = querySacctTasks(job) or {}
+    return [taskstates.get(k // bundlesize, state) for k in range(ncommands)]
+
+def parseSacctTime(timestr):
+    """
+    Converts a sacct time stamp such as 2014-06-30T12:00:00 into seconds since
+    the epoch; None for Unknown or None
+    """
+    try:
+        return time.mktime(time.strptime(timestr, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+def logSacctTimes(joblist):
+    """
+    Records the queue wait (submit to start) and the run time (start to end) of
+    every job and array task in joblist as 'queue' and 'run' events, using a
+    single sacct call
+    """
+    try:
+        output = subprocess.check_output(['sacct', '-n', '-X', '-P', '-o', 'JobID,State,Submit,Start,End,NodeList',
+                                          '-j', ','.join(joblist)]).decode("utf-8")
+    except (subprocess.CalledProcessError, OSError):
+        return
+    for line in output.splitlines():
+        tokens = line.split('|')
+        if len(tokens) < 6: continue
+        submit, start, end = [parseSacctTime(t) for t in tokens[2:5]]
+        state = tokens[1].split(' ')[0]
+        if submit is not None and start is not None:
+            logEvent('queue', seconds = start - submit, job = tokens[0], node = tokens[5])
+        if start is not None and end is not None:
+            logEvent('run', seconds = end - start, job = tokens[0], state = state, node = tokens[5])
+
+def pollSLURMjobs(joblist, missing = None, debug = False):
+    """
+    Checks once which jobs in joblist have reached a terminal state such as
+    COMPLETED, FAILED or TIMEOUT and returns them as list of (job, state),
+    using one squeue call (and one sacct call for jobs that have left the
+    queue). missing counts for every job how often it was not (yet) known to
+    sacct; after three rounds its state is reported as UNKNOWN. Raises
+    subprocess.CalledProcessError or OSError if squeue fails.
+    """
+    if missing is None: missing = {}
+    active = querySqueue(debug = debug)
+    finished = [job for job in joblist if job not in active]
+    states = {}
+    if finished:
+        states = querySacct(finished)
+    results = []
+    for job in finished:
+        if states is None: # no accounting, we only know the job has left the queue
+            state = 'UNKNOWN'
+        else:
+            state = states.get(job)
+            if state is None:
+                missing[job] = missing.get(job, 0) + 1
+                if missing[job] < 3: continue
+                state = 'UNKNOWN'
+            elif state not in TERMINAL_STATES:
+                continue # sacct lags behind squeue
+        results.append((job, state))
+    for job, state in results:
+        removeJobManifest(job)
+    if results and eventsEnabled():
+        logSacctTimes([job for job, state in results])
+    return results
+
+def monitorSLURMjobs(joblist, timestep = 1, maxtimestep = 60, debug = False):
+    """
+    Generator that watches all jobs in joblist and yields (job, state) for each
+    job as soon as it has reached a terminal state, see pollSLURMjobs(). The
+    polling interval grows from timestep up to maxtimestep while nothing
+    finishes and drops back once a job has finished. Jobs whose final state
+    cannot be determined are reported as UNKNOWN.
+    """
+    pending = list(joblist)
+    missing = {} # jobs that left the queue but are not (yet) known to sacct
+    delay = timestep
+    first = True
+    while pending:
+        if not first:
+            time.sleep(delay)
+        first = False
+        try:
+            results = pollSLURMjobs(pending, missing, debug = debug)
+        except (subprocess.CalledProcessError, OSError) as err:
+            print('squeue failed: %s' %(err))
+            delay = min(delay * 2, maxtimestep)
+            continue
+        for job, state in results:
+            pending.remove(job)
+            if debug: print('%s finished with state %s' %(job, state))
+            yield (job, state)
+        if results:
+            delay = timestep
+        else:
+            delay = min(delay * 1.5, maxtimestep)
+        if debug and pending: print('%d jobs not finished yet' %(len(pending)))
+
+def getSLURMjobStates(joblist, timestep = 1, debug = False):
+    """
+    Waits until all jobs in joblist are finished and returns their terminal
+    states as a dictionary {job: state}
+    """
+    states = {}
+    for job, state in monitorSLURMjobs(joblist, timestep, debug = debug):
+        states[job] = state
+    return states
+
+def checkSLURMjobs(joblist, timestep = 1, debug = False):
+    """
+    Checks if all jobs that were so far submitted are finished, reports jobs
+    that did not complete successfully and afterwards empties list of jobs
+    """
+    if debug:
+        print('%d jobs in queue' %(len(joblist)))
+        for job in joblist:
+            print(job)
+    failed = []
+    for job, state in monitorSLURMjobs(joblist, timestep, debug = debug):
+        if state != 'COMPLETED':
+            print('%s finished with state %s' %(job, state))
+        if not isJobSuccessful(state):
+            failed.append(job)
+        print('%s will now be removed from list' %job)
+    if failed:
+        print('%d of %d jobs did not complete: %s' %(len(failed), len(joblist), ' '.join(failed)))
+    joblist = []
+    return joblist
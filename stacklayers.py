@@ -1,153 +1,340 @@
-#!/usr/bin/env python
-"""
-Combines n rHEALPix-tiled layers into one (thereby creating a data cube)
-
-"""
-# This file is part of scenzgrid-py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import os
-import sys
-import time
-import numpy
-import shutil
-import argparse
-import glob
-
-import osgeo.gdal as gdal
-from osgeo import ogr
-from rios import applier
-
-from rhealpix_dggs.dggs import *
-from rhealpix_dggs.ellipsoids import *
-
-from slurm_utils import *
-from data_utils import *
-
-
-
-if __name__ == '__main__':
-    start = time.time()
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("indir", type = str, help="Specify the input directory including rHEALPix tiled datasets.")
-    parser.add_argument("outdir", type = str, help="Specify the output directory.")
-    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
-    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")
-    parser.add_argument("-g", "--globalex", help="Create global coverage output (default: False).", action ="store_true")
-    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
-    parser.add_argument("-p", "--parallelism", help="Choice of no (default) or slurm")
-    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
-
-    args = parser.parse_args()
-
-    if args.indir == None:
-        print("Error: no input file specified")
-        sys.exit()
-    indir = args.indir    
-
-    if args.outdir == None:
-        print("Error: no output directory specified")
-        sys.exit()
-    outfileroot = args.outdir
-
-    if args.minres == None:
-        print("Error: minres not specified")
-        sys.exit()
-    minresolution = int(args.minres)
-
-    if args.maxres == None:
-        print("Error: yres not specified")
-        sys.exit()
-    maxresolution = int(args.maxres)
-
-    if args.globalex:
-        globalextent = True
-    else:
-        globalextent = False
-    
-    if args.shapefile:
-        shapefile = str(args.shapefile)
-    else:
-        shapefile = None
-
-    if args.parallelism == 'slurm':
-        parallelism = args.parallelism
-    else:
-        parallelism = None
-
-    if args.verbose:
-        debug = True
-    else:
-        debug = False
-
-    # 'wipe clean' and create new data cube directory
-    if os.path.exists(outfileroot):
-        shutil.rmtree(outfileroot)
-        os.makedirs(outfileroot)
-
-    # create 'standard' DGGS based on WGS84 and center meridian at 52 deg and corresponding WKT string
-    n_square = 1
-    s_square = 3
-    a = 6378137
-    central_meridian = 52
-    E = Ellipsoid(lon_0 = central_meridian)
-    rddgs = RHEALPixDGGS(ellipsoid = E, north_square=n_square, south_square=s_square, N_side=3)
-    
-    if globalextent:
-        nw = [-180, 90]
-        se = [180, -90]
-    elif shapefile:
-        # Get a Layer's Extent; shapefile has to use lat/long
-        inShapefile = shapefile
-        inDriver = ogr.GetDriverByName("ESRI Shapefile")
-        inDataSource = inDriver.Open(inShapefile, 0)
-        inLayer = inDataSource.GetLayer()
-        ext = inLayer.GetExtent()
-        nw = [ext[0], ext[3]]
-        se = [ext[1], ext[2]]
-    else: # use NZ coastline as default
-        inShapefile = '/projects/landcare00031/data/AOIs/nzcoast.shp'
-        inDriver = ogr.GetDriverByName("ESRI Shapefile")
-        inDataSource = inDriver.Open(inShapefile, 0)
-        inLayer = inDataSource.GetLayer()
-        ext = inLayer.GetExtent()
-        nw = [ext[0], ext[3]]
-        se = [ext[1], ext[2]]
-        
-    if parallelism == 'slurm': jobs = []  # initialize job list
-
-    for i in range(maxresolution,minresolution-1,-1): # iterate over resolutions and create grids
-        grid = rddgs.cells_from_region(i, nw, se, plane=False)
-        for row in grid:
-            for c in row:
-                cmd = "python stacktile.py %s %s %s" %(c, indir, outfileroot)
-                if debug: print(cmd)
-                if parallelism == 'slurm':
-                    if debug: print('Command will be submitted to SLURM')
-                    jobs = submitSLURMjob(cmd, jobs)
-                else:
-                    if debug: print('Command will use serial processing')
-                    os.system(cmd)
-            if parallelism == 'slurm': jobs = checkSLURMjobs(jobs, debug = True)
-    
-    elapsed = time.time() - start
-    print('Elapsed time (stacklayers): %g seconds' %(elapsed))
-        
-
-
-
+#!/usr/bin/env python
+"""
+Combines n rHEALPix-tiled layers into one (thereby creating a data cube)
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import numpy
+import shutil
+import argparse
+import glob
+
+import osgeo.gdal as gdal
+from osgeo import ogr
+from rios import applier
+
+from rhealpix_dggs.dggs import *
+from rhealpix_dggs.ellipsoids import *
+
+from slurm_utils import *
+from local_utils import *
+from data_utils import *
+from cellindex_utils import *
+from cellarray_utils import *
+from manifest_utils import *
+from stacktile import *
+from inventory_utils import *
+from instrument_utils import *
+
+
+
+if __name__ == '__main__':
+    start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("indir", type = str, help="Specify the input directory including rHEALPix tiled datasets.")
+    parser.add_argument("outdir", type = str, help="Specify the output directory.")
+    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
+    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")
+    parser.add_argument("-g", "--globalex", help="Create global coverage output (default: False).", action ="store_true")
+    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
+    parser.add_argument("--extentonly", help="Use all cells within the extent of the shapefile instead of only those intersecting its polygons (default: False).", action ="store_true")
+    parser.add_argument("-p", "--parallelism", help="Choice of no (default), local or slurm")
+    parser.add_argument("-k", "--bundlesize", type = int, help="Number of commands run by each task of a SLURM job array (default: 1)")
+    parser.add_argument("-n", "--chunksize", type = int, help="Number of cells stacked by one process or command (default: 50)")
+    parser.add_argument("-w", "--workers", type = int, help="Number of worker processes for local parallelism (default: number of CPUs)")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+    parser.add_argument("--cellindex", help="Supply cell index (see buildcellindex.py) to look up the cells of the region")
+    parser.add_argument("-d", "--dag", help="Do not wait for each resolution to finish; stacks of different cells do not depend on each other (default: False).", action ="store_true")
+    parser.add_argument("--virtual", help="Create a virtual cube of VRT files referencing the tiles instead of copying them (default: False).", action ="store_true")
+    parser.add_argument("--zarr", help="Write the cube as chunked Zarr arrays that new layers are appended to instead of KEA files (default: False).", action ="store_true")
+    parser.add_argument("--rescan", help="Walk all layer directories again instead of only new or updated layers (default: False).", action ="store_true")
+    parser.add_argument("--clean", help="Delete the whole data cube instead of only updating missing, failed or outdated stacks (default: False).", action ="store_true")
+    parser.add_argument("--events", help="Append timing events of every cell and stage as JSON lines to this file, see summariseevents.py")
+
+    args = parser.parse_args()
+
+    if args.indir == None:
+        print("Error: no input file specified")
+        sys.exit()
+    indir = args.indir    
+
+    if args.outdir == None:
+        print("Error: no output directory specified")
+        sys.exit()
+    outfileroot = args.outdir
+
+    if args.minres == None:
+        print("Error: minres not specified")
+        sys.exit()
+    minresolution = int(args.minres)
+
+    if args.maxres == None:
+        print("Error: yres not specified")
+        sys.exit()
+    maxresolution = int(args.maxres)
+
+    if args.globalex:
+        globalextent = True
+    else:
+        globalextent = False
+    
+    if args.shapefile:
+        shapefile = str(args.shapefile)
+    else:
+        shapefile = None
+
+    if args.extentonly:
+        extentonly = True
+    else:
+        extentonly = False
+
+    if args.parallelism in ['slurm', 'local']:
+        parallelism = args.parallelism
+    else:
+        parallelism = None
+
+    if args.workers:
+        workers = int(args.workers)
+    else:
+        workers = None
+
+    if args.bundlesize:
+        bundlesize = int(args.bundlesize)
+    else:
+        bundlesize = 1
+
+    if args.chunksize:
+        chunksize = int(args.chunksize)
+    else:
+        chunksize = 50
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False
+
+    if args.cellindex:
+        cellindexfile = str(args.cellindex)
+    else:
+        cellindexfile = None
+
+    if args.dag:
+        dag = True
+    else:
+        dag = False
+
+    if args.virtual:
+        virtual = True
+    else:
+        virtual = False
+
+    if args.zarr and args.virtual:
+        print("Error: --zarr and --virtual can not be combined")
+        sys.exit()
+    if args.zarr:
+        zarrcube = True
+        checkZarr()
+    else:
+        zarrcube = False
+
+    if args.rescan:
+        rescan = True
+    else:
+        rescan = False
+
+    if args.clean:
+        clean = True
+    else:
+        clean = False
+
+    if args.events:
+        enableEvents(args.events) # inherited by workers and SLURM jobs
+
+    # 'wipe clean' and create new data cube directory if requested
+    if clean and os.path.exists(outfileroot):
+        shutil.rmtree(outfileroot)
+        os.makedirs(outfileroot)
+
+    # create 'standard' DGGS based on WGS84 and center meridian at 52 deg and corresponding WKT string
+    rddgs = getStandardDGGS()
+    regions = getRegionSource(rddgs, cellindexfile, debug) # cells of the region are read from the cell index if one is given
+    
+    aoi = None
+    if globalextent:
+        nw = [-180, 90]
+        se = [180, -90]
+    else:
+        if shapefile:
+            inShapefile = shapefile
+        else: # use NZ coastline as default
+            inShapefile = '/projects/landcare00031/data/AOIs/nzcoast.shp'
+        # Get a Layer's Extent and polygons; shapefile has to use lat/long
+        nw, se, aoi = getAOI(inShapefile, getStandardProj4())
+        if extentonly: aoi = None
+
+    skipcells = set()
+    if aoi is not None:
+        # cells outside the polygons of the shapefile are not stacked
+        skipcells = getCellsOutsideGeometry(regions, minresolution, maxresolution, nw, se, aoi, 'AOI')
+        
+    if parallelism: jobs = []  # initialize job list
+    if parallelism == 'slurm': commands = [] # commands of the current resolution, submitted as one job array
+    if parallelism == 'local': pool = createLocalPool(workers)
+
+    # stacks are only created again if the tiles of their cell changed since the last run
+    manifest = loadManifest(outfileroot)
+    params = {'virtual': virtual, 'zarr': zarrcube}
+    # one walk over the tiled layers (only new or updated ones) instead of probing every layer for every cell
+    with timedStage('inventory') as event:
+        inventory = updateInventory(indir, rescan = rescan, debug = debug)
+        saveInventory(indir, inventory)
+        event['layers'] = len(inventory['layers'])
+    celllayers = getCellLayers(inventory, indir)
+    stackcells = [] # (cell, file, fingerprint) of all stacks created in this run
+    chunk = [] # cells that are not yet dispatched
+    commandcells = [] # cells of every command in commands, see getCellSuccess()
+    statuses = {} # status of every cell stacked by the local pool or serially
+
+    def getChunkInputs(chunk):
+        """
+        Returns the inputs of the cells of a chunk from the layer inventory
+        """
+        return dict([(cellstr, getCellInputs(inventory, celllayers, cellstr)) for cellstr in chunk])
+
+    def dispatchChunk(chunk):
+        """
+        Hands a chunk of cells to SLURM, the local process pool or stacks them
+        serially; every chunk is stacked in a single process
+        """
+        if not chunk: return []
+        if parallelism == 'slurm':
+            # the inputs of the chunk are handed over in a file, see saveCellInputs()
+            cmd = "python stacktile.py --inputs %s %s %s %s" %(saveCellInputs(getChunkInputs(chunk), outfileroot),
+                                                              ','.join(chunk), indir, outfileroot)
+            if virtual: cmd = cmd + ' --virtual'
+            if zarrcube: cmd = cmd + ' --zarr'
+            if debug: print(cmd)
+            commands.append(cmd)
+            commandcells.append(chunk)
+        elif parallelism == 'local':
+            submitLocalJob(pool, stackCells, (chunk, indir, outfileroot, None, debug, getChunkInputs(chunk), virtual, False, zarrcube), jobs)
+        else:
+            statuses.update(stackCells(chunk, indir, outfileroot, None, debug, getChunkInputs(chunk), virtual, False, zarrcube))
+        return []
+
+    def getCellSuccess(jobs, states):
+        """
+        Returns for every cell of the submitted commands whether the array task
+        that stacked it succeeded, see getCommandStates()
+        """
+        succeeded = {}
+        if jobs:
+            taskstates = getCommandStates(jobs[0], states.get(jobs[0]), len(commandcells), bundlesize)
+            for j in range(len(commandcells)):
+                for cellstr in commandcells[j]:
+                    succeeded[cellstr] = isJobSuccessful(taskstates[j])
+        del commandcells[:]
+        return succeeded
+
+    def recordStacks(stackcells, succeeded = None):
+        """
+        Records the status of the stacks created so far; succeeded tells for
+        every cell whether its SLURM task succeeded, otherwise the statuses
+        returned by stackCells() are used
+        """
+        if parallelism == 'local':
+            for result in collectLocalJobs(jobs, debug = debug):
+                if result: statuses.update(result)
+            del jobs[:]
+        for cellstr, outputfile, fingerprint in stackcells:
+            if parallelism == 'slurm': status = getTileStatus(outputfile, succeeded.get(cellstr, False))
+            else: status = statuses.get(cellstr, 'failed')
+            recordCell(manifest, cellstr, fingerprint, params, status)
+        saveManifest(outfileroot, manifest)
+        return []
+
+    for i in range(maxresolution,minresolution-1,-1): # iterate over resolutions and create grids
+        with timedStage('enumerate', res = i) as event:
+            grid = regions.cells_from_region(i, nw, se, plane=False)
+            event['cells'] = sum([len(row) for row in grid])
+        cells = [c for row in grid for c in row if str(c) not in skipcells]
+        # stack paths of the whole resolution at once, see getStackPath() and getZarrPath()
+        codes = encodeCells(cells)
+        keafiles = getFilePaths(codes, outfileroot).tolist()
+        zarrpaths = [path[:-len('.kea')] for path in getFilePaths(codes, os.path.join(outfileroot, ZARR_NAME)).tolist()]
+        for k in range(len(cells)):
+            c = cells[k]
+            stackfiles = [keafiles[k], keafiles[k][:-len('.kea')] + '.vrt']
+            if zarrcube: outputfile = zarrpaths[k] # the array is appended to, not replaced
+            elif virtual: outputfile = stackfiles[1]
+            else: outputfile = stackfiles[0]
+            existing = [stackfile for stackfile in stackfiles if os.path.exists(stackfile)] # physical or virtual stacks
+            if str(c) not in celllayers:
+                if existing or os.path.isdir(zarrpaths[k]): # all tiles of this cell were removed
+                    for stackfile in existing: os.remove(stackfile)
+                    if os.path.isdir(zarrpaths[k]): shutil.rmtree(zarrpaths[k])
+                    recordCell(manifest, str(c), None, params, 'empty')
+                continue
+            fingerprint = getCellFingerprint(celllayers, str(c))
+            if existing and not zarrcube: stackfile = existing[0] # virtual stacks may have been materialised since
+            else: stackfile = outputfile
+            if not needsUpdate(manifest, str(c), fingerprint, params, stackfile): continue
+            if existing:
+                with timedStage('delete', str(c)):
+                    for stackfile in existing: os.remove(stackfile) # outdated (physical or virtual) stack
+            stackcells.append((str(c), outputfile, fingerprint))
+            chunk.append(str(c))
+            if len(chunk) >= chunksize: chunk = dispatchChunk(chunk)
+        if dag: continue # all resolutions are submitted at once
+        chunk = dispatchChunk(chunk)
+        print('Resolution %d: %d stacks to update' %(i, len(stackcells)))
+        if parallelism == 'slurm':
+            jobs = submitSLURMjobArray(commands, jobs, bundlesize, debug = debug)
+            commands = []
+            states = getSLURMjobStates(jobs, debug = debug)
+            stackcells = recordStacks(stackcells, getCellSuccess(jobs, states))
+            jobs = []
+        else:
+            stackcells = recordStacks(stackcells) # finish resolution before going on
+
+    if dag:
+        chunk = dispatchChunk(chunk)
+        if parallelism == 'slurm':
+            jobs = submitSLURMjobArray(commands, jobs, bundlesize, debug = debug)
+            states = getSLURMjobStates(jobs, debug = debug)
+            stackcells = recordStacks(stackcells, getCellSuccess(jobs, states))
+        else:
+            stackcells = recordStacks(stackcells)
+
+    if parallelism == 'local':
+        pool.close()
+        pool.join()
+    saveManifest(outfileroot, manifest)
+    
+    elapsed = time.time() - start
+    logEvent('total', seconds = elapsed, minres = minresolution, maxres = maxresolution)
+    print('Elapsed time (stacklayers): %g seconds' %(elapsed))
+        
+
+
+
@@ -1,126 +1,417 @@
-#!/usr/bin/env python
-"""
-Stacks all tiles of one specific rHEALPix cell
-
-"""
-# This file is part of scenzgrid-py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import os
-import sys
-import numpy
-import argparse
-import glob
-
-import osgeo.gdal as gdal
-from osgeo import ogr
-from rios import applier
-
-from data_utils import *
-
-def doStack(info, inputs, outputs):
-    """
-    Called from RIOS. Stacks the input files
-    """
-    outputs.outimage = numpy.vstack(inputs.imgs)
-
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("cell", type = str, help="Name of rHEALPix cell.")
-    parser.add_argument("indir", type = str, help="Specify the input directory including rHEALPix tiled datasets.")
-    parser.add_argument("outdir", type = str, help="Specify the output directory.")
-    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
-
-    args = parser.parse_args()
-
-    if args.cell == None:
-        print("Error: no cell specified")
-        sys.exit()
-    c = args.cell
-
-    if args.indir == None:
-        print("Error: no input file specified")
-        sys.exit()
-    indir = args.indir
-
-    if args.outdir == None:
-        print("Error: no output directory specified")
-        sys.exit()
-    outfileroot = args.outdir
-
-    if args.verbose:
-        debug = True
-    else:
-        debug = False    
-   
-    layerroots = glob.glob(os.path.join(indir, '*'))
-    inputfiles = []
-    layernames = []
-    for layer in layerroots: # create list of file names for given grid
-        if debug: print(c)
-        filepath = os.path.join(layer, getFilePath(c))
-        if os.path.exists(filepath):
-            inputfiles.append(filepath)
-            layernames.append(layer.split('/')[-1])
-    if not inputfiles == []: #check if any tiles are available for this file
-        outputfile = os.path.join(outfileroot, getFilePath(c))
-        if debug: print(outputfile)
-        if not os.path.exists(os.path.dirname(outputfile)):
-            if debug: print('now will create %s' %(os.path.dirname(outputfile)))
-            try:
-                os.makedirs(os.path.dirname(outputfile))
-            except:
-                print("Unexpected Error while creating directory")            
-        infiles = applier.FilenameAssociations()
-        infiles.imgs = inputfiles      
-        outfiles = applier.FilenameAssociations()
-        outfiles.outimage = outputfile
-        controls = applier.ApplierControls()
-        controls.setWindowXsize(243)
-        controls.setWindowYsize(243)
-        controls.setCreationOptions(["IMAGEBLOCKSIZE=243"])
-        applier.apply(doStack, infiles, outfiles, controls = controls)
-        # now the band names have to be set
-        dst_ds = gdal.Open(outputfile, gdal.GA_Update)
-        # Check that the image has been opened.
-        if not dst_ds is None:
-            allbandcount = 0
-            for j in range(len(inputfiles)):
-                beforebandcount = allbandcount
-                src_ds = gdal.Open(inputfiles[j], GA_ReadOnly )
-                if not src_ds is None:
-                    for currentbandcount in range(1, src_ds.RasterCount+1):
-                        band = src_ds.GetRasterBand(currentbandcount)
-                        bandname = band.GetDescription()
-                        outbandname = layernames[j] + ' ' + bandname                                                 
-                        # Get the image band
-                        imgBand = dst_ds.GetRasterBand(beforebandcount+currentbandcount)
-                        # Check the image band was available.
-                        if not imgBand is None:
-                            # Set the image band name.
-                            imgBand.SetDescription(outbandname)
-                        else:
-                            print ("Could not open the image band: ", band)                                                 
-                        if debug: print('band %d is named %s' %(beforebandcount+currentbandcount, outbandname))
-                        allbandcount += 1
-                    src_ds = None
-                else:
-                    print("Could not open the input image file: ", inputfiles[j])
-            dst_ds = None
-        else:
-            print ("Could not open the output image file: ", outputfile) 
+#!/usr/bin/env python
+"""
+Stacks all tiles of one specific rHEALPix cell
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import numpy
+import argparse
+import glob
+from xml.sax.saxutils import escape
+
+import osgeo.gdal as gdal
+from osgeo import gdal_array
+from osgeo import ogr
+from rios import applier
+
+from data_utils import *
+from inventory_utils import *
+from zarr_utils import *
+from instrument_utils import *
+
+def doStack(info, inputs, outputs):
+    """
+    Called from RIOS. Stacks the input files
+    """
+    outputs.outimage = numpy.vstack(inputs.imgs)
+
+def getLayerRoots(indir):
+    """
+    Returns the directories of all tiled layers in indir
+    """
+    return [layer for layer in glob.glob(os.path.join(indir, '*')) if os.path.isdir(layer)]
+
+def setBandNames(outputfile, inputfiles, layernames, debug = False, bandnames = None):
+    """
+    Names the bands of a stacked file after the layers and bands of the input
+    files. If the band descriptions of the input files are known (bandnames),
+    the input files are not opened again.
+    """
+    if bandnames is not None:
+        dst_ds = gdal.Open(outputfile, gdal.GA_Update)
+        if dst_ds is None:
+            print ("Could not open the output image file: ", outputfile)
+            return
+        allbandcount = 0
+        for j in range(len(inputfiles)):
+            for bandname in bandnames[j]:
+                allbandcount += 1
+                outbandname = layernames[j] + ' ' + bandname
+                imgBand = dst_ds.GetRasterBand(allbandcount)
+                if not imgBand is None:
+                    imgBand.SetDescription(outbandname)
+                else:
+                    print ("Could not open the image band: ", allbandcount)
+                if debug: print('band %d is named %s' %(allbandcount, outbandname))
+        dst_ds = None
+        return
+    dst_ds = gdal.Open(outputfile, gdal.GA_Update)
+    # Check that the image has been opened.
+    if not dst_ds is None:
+        allbandcount = 0
+        for j in range(len(inputfiles)):
+            beforebandcount = allbandcount
+            src_ds = gdal.Open(inputfiles[j], GA_ReadOnly )
+            if not src_ds is None:
+                for currentbandcount in range(1, src_ds.RasterCount+1):
+                    band = src_ds.GetRasterBand(currentbandcount)
+                    bandname = band.GetDescription()
+                    outbandname = layernames[j] + ' ' + bandname                                                 
+                    # Get the image band
+                    imgBand = dst_ds.GetRasterBand(beforebandcount+currentbandcount)
+                    # Check the image band was available.
+                    if not imgBand is None:
+                        # Set the image band name.
+                        imgBand.SetDescription(outbandname)
+                    else:
+                        print ("Could not open the image band: ", band)                                                 
+                    if debug: print('band %d is named %s' %(beforebandcount+currentbandcount, outbandname))
+                    allbandcount += 1
+                src_ds = None
+            else:
+                print("Could not open the input image file: ", inputfiles[j])
+        dst_ds = None
+    else:
+        print ("Could not open the output image file: ", outputfile) 
+
+def getStackPath(outfileroot, c, virtual = False):
+    """
+    Returns the file of the stack of a cell; virtual stacks are VRT files
+    """
+    filepath = os.path.join(outfileroot, getFilePath(c))
+    if virtual: filepath = filepath[:-len('.kea')] + '.vrt'
+    return filepath
+
+def writeVirtualStack(outputfile, inputfiles, layernames, debug = False, bandnames = None):
+    """
+    Writes a VRT file that references the bands of the input files instead of
+    copying them. The bands are named like those of a physical stack.
+    Returns True if the file was written.
+    """
+    bands = []
+    xsize = ysize = None
+    for j in range(len(inputfiles)):
+        src_ds = gdal.Open(inputfiles[j], GA_ReadOnly)
+        if src_ds is None:
+            print("Could not open the input image file: ", inputfiles[j])
+            return False
+        if xsize is None: # all tiles of a cell share the same grid
+            xsize = src_ds.RasterXSize
+            ysize = src_ds.RasterYSize
+            geotransform = src_ds.GetGeoTransform()
+            projection = src_ds.GetProjection()
+        for b in range(1, src_ds.RasterCount+1):
+            band = src_ds.GetRasterBand(b)
+            if bandnames is not None: bandname = bandnames[j][b-1]
+            else: bandname = band.GetDescription()
+            blockxsize, blockysize = band.GetBlockSize()
+            bands.append((os.path.abspath(inputfiles[j]), b, layernames[j] + ' ' + bandname,
+                          gdal.GetDataTypeName(band.DataType), band.GetNoDataValue(), blockxsize, blockysize))
+        src_ds = None
+    lines = ['<VRTDataset rasterXSize="%d" rasterYSize="%d">' %(xsize, ysize),
+             '  <SRS>%s</SRS>' %(escape(projection)),
+             '  <GeoTransform>%s</GeoTransform>' %(', '.join([repr(v) for v in geotransform]))]
+    for j in range(len(bands)):
+        filepath, b, outbandname, datatype, nodata, blockxsize, blockysize = bands[j]
+        if debug: print('band %d is named %s' %(j+1, outbandname))
+        lines.append('  <VRTRasterBand dataType="%s" band="%d">' %(datatype, j+1))
+        lines.append('    <Description>%s</Description>' %(escape(outbandname)))
+        if nodata is not None: lines.append('    <NoDataValue>%s</NoDataValue>' %(repr(nodata)))
+        lines.append('    <SimpleSource>')
+        lines.append('      <SourceFilename relativeToVRT="0">%s</SourceFilename>' %(escape(filepath)))
+        lines.append('      <SourceBand>%d</SourceBand>' %(b))
+        lines.append('      <SourceProperties RasterXSize="%d" RasterYSize="%d" DataType="%s" BlockXSize="%d" BlockYSize="%d" />'
+                     %(xsize, ysize, datatype, blockxsize, blockysize))
+        lines.append('      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d" />' %(xsize, ysize))
+        lines.append('      <DstRect xOff="0" yOff="0" xSize="%d" ySize="%d" />' %(xsize, ysize))
+        lines.append('    </SimpleSource>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+    with open(outputfile, mode='w', encoding='utf-8') as vrtfile:
+        vrtfile.write('\n'.join(lines) + '\n')
+    return True
+
+def materialiseStack(vrtfile, debug = False):
+    """
+    Turns a virtual stack into a physical KEA stack next to it and removes the
+    VRT file. Returns True if the KEA file was written.
+    """
+    outputfile = vrtfile[:-len('.vrt')] + '.kea'
+    if debug: print('materialising %s' %(outputfile))
+    dst_ds = gdal.Translate(outputfile, vrtfile, format = 'KEA', creationOptions = ["IMAGEBLOCKSIZE=243"])
+    if dst_ds is None:
+        print("Could not create the output image file: ", outputfile)
+        return False
+    dst_ds = None
+    os.remove(vrtfile)
+    return True
+
+def writeDirectStack(outputfile, inputfiles, layernames, debug = False, bandnames = None, blocksize = 243):
+    """
+    Stacks the input files in a single pass without RIOS. Every input is opened
+    once, the output is created with all band descriptions and nodata values
+    set and the blocks of all inputs are read straight into their bands of one
+    preallocated block buffer. Returns True if the file was written.
+    """
+    src, bands = readInputBands(inputfiles, layernames, bandnames)
+    if src is None:
+        return False
+    # same data type as the numpy.vstack of the RIOS stack
+    dtype = numpy.result_type(*[band[4] for band in bands])
+    xsize = src[0].RasterXSize
+    ysize = src[0].RasterYSize
+    dst_ds = gdal.GetDriverByName('KEA').Create(outputfile, xsize, ysize, len(bands),
+                                                gdal_array.NumericTypeCodeToGDALTypeCode(dtype),
+                                                ["IMAGEBLOCKSIZE=%d" %(blocksize)])
+    if dst_ds is None:
+        print("Could not create the output image file: ", outputfile)
+        return False
+    dst_ds.SetGeoTransform(src[0].GetGeoTransform())
+    dst_ds.SetProjection(src[0].GetProjection())
+    for k in range(len(bands)):
+        j, b, outbandname, nodata = bands[k][:4]
+        dstband = dst_ds.GetRasterBand(k+1)
+        dstband.SetDescription(outbandname)
+        if nodata is not None: dstband.SetNoDataValue(nodata)
+        if debug: print('band %d is named %s' %(k+1, outbandname))
+
+    buffer = numpy.empty((len(bands), blocksize, blocksize), dtype = dtype)
+    for yoff in range(0, ysize, blocksize):
+        ywin = min(blocksize, ysize - yoff)
+        for xoff in range(0, xsize, blocksize):
+            xwin = min(blocksize, xsize - xoff)
+            for k in range(len(bands)):
+                j, b = bands[k][:2]
+                block = buffer[k, :ywin, :xwin]
+                src[j].GetRasterBand(b).ReadAsArray(xoff, yoff, xwin, ywin, buf_obj = block)
+                dst_ds.GetRasterBand(k+1).WriteArray(block, xoff, yoff)
+    dst_ds = None
+    src = None
+    return True
+
+def getStackControls():
+    """
+    Returns the RIOS controls used for all stacks
+    """
+    controls = applier.ApplierControls()
+    controls.setWindowXsize(243)
+    controls.setWindowYsize(243)
+    controls.setCreationOptions(["IMAGEBLOCKSIZE=243"])
+    return controls
+
+def stackCell(c, indir, outfileroot, layerroots = None, controls = None, debug = False, inputs = None,
+              virtual = False, rios = False, zarrcube = False):
+    """
+    Stacks all tiles of one rHEALPix cell into a single file. layerroots and
+    controls can be passed in to reuse them for many cells. If the tiles of
+    the cell are known from the layer inventory, they are passed as inputs,
+    a list of (layer name, tile, band descriptions) tuples, and no layer
+    directory is probed. A virtual stack is a VRT file referencing the tiles.
+    If zarrcube is set, the cell is written to (or appended to) its array in
+    the Zarr cube, otherwise physical stacks are written by writeDirectStack()
+    unless rios is set.
+    Returns 'done', 'empty' (no tiles for this cell) or 'failed'.
+    """
+    inputfiles = []
+    layernames = []
+    bandnames = None
+    if inputs is not None:
+        inputfiles = [filepath for layername, filepath, bands in inputs]
+        layernames = [layername for layername, filepath, bands in inputs]
+        bandnames = [bands for layername, filepath, bands in inputs]
+    else:
+        if layerroots is None: layerroots = getLayerRoots(indir)
+        for layer in layerroots: # create list of file names for given grid
+            if debug: print(c)
+            filepath = os.path.join(layer, getFilePath(c))
+            if os.path.exists(filepath):
+                inputfiles.append(filepath)
+                layernames.append(layer.split('/')[-1])
+    if inputfiles == []: #check if any tiles are available for this file
+        return 'empty'
+    if zarrcube: outputfile = getZarrPath(outfileroot, c)
+    else: outputfile = getStackPath(outfileroot, c, virtual)
+    if debug: print(outputfile)
+    if not os.path.exists(os.path.dirname(outputfile)):
+        if debug: print('now will create %s' %(os.path.dirname(outputfile)))
+        try:
+            os.makedirs(os.path.dirname(outputfile))
+        except OSError: # created by another process in the meantime
+            pass
+    if zarrcube:
+        try:
+            if writeZarrStack(outputfile, inputfiles, layernames, debug, bandnames): return 'done'
+        except Exception as err:
+            print('Stacking failed for %s: %s' %(str(c), err))
+        return 'failed'
+    if virtual:
+        if writeVirtualStack(outputfile, inputfiles, layernames, debug, bandnames): return 'done'
+        return 'failed'
+    if not rios:
+        try:
+            if writeDirectStack(outputfile, inputfiles, layernames, debug, bandnames): return 'done'
+        except Exception as err:
+            print('Stacking failed for %s: %s' %(str(c), err))
+        return 'failed'
+    if controls is None: controls = getStackControls()
+    infiles = applier.FilenameAssociations()
+    infiles.imgs = inputfiles      
+    outfiles = applier.FilenameAssociations()
+    outfiles.outimage = outputfile
+    try:
+        applier.apply(doStack, infiles, outfiles, controls = controls)
+    except Exception as err:
+        print('Stacking failed for %s: %s' %(str(c), err))
+        return 'failed'
+    # now the band names have to be set
+    setBandNames(outputfile, inputfiles, layernames, debug, bandnames)
+    return 'done'
+
+def stackCells(cells, indir, outfileroot, layerroots = None, debug = False, inputs = None, virtual = False,
+               rios = False, zarrcube = False):
+    """
+    Stacks many cells in one process; the layer directories are only listed
+    once. inputs optionally maps every cell name to its inputs from the layer
+    inventory, see stackCell(). Returns the status of every cell.
+    """
+    if layerroots is None and inputs is None: layerroots = getLayerRoots(indir)
+    controls = None
+    if rios: controls = getStackControls()
+    statuses = {}
+    for c in cells:
+        if inputs is not None: cellinputs = inputs.get(str(c), [])
+        else: cellinputs = None
+        start = time.time()
+        statuses[str(c)] = stackCell(c, indir, outfileroot, layerroots, controls, debug, cellinputs, virtual, rios,
+                                     zarrcube)
+        if eventsEnabled():
+            seconds = time.time() - start
+            if cellinputs is not None: inputfiles = [filepath for layername, filepath, bands in cellinputs]
+            else: inputfiles = [os.path.join(layer, getFilePath(c)) for layer in layerroots
+                                if os.path.exists(os.path.join(layer, getFilePath(c)))]
+            if zarrcube: outputfile = getZarrPath(outfileroot, c)
+            else: outputfile = getStackPath(outfileroot, c, virtual)
+            if virtual: bytesread = 0 # a VRT only references its tiles
+            else: bytesread = getFileSize(inputfiles)
+            logEvent('stack', str(c), seconds, status = statuses[str(c)], inputs = len(inputfiles),
+                     bytesread = bytesread, byteswritten = getFileSize(outputfile))
+    return statuses
+
+def readCellList(cellarg):
+    """
+    Returns the cell names given on the command line: a single name, names
+    separated by commas or a file with one name per line
+    """
+    if os.path.isfile(cellarg):
+        with open(cellarg, mode='r', encoding='utf-8') as cellfile:
+            return [line.strip() for line in cellfile if line.strip()]
+    return [cellstr for cellstr in cellarg.split(',') if cellstr]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cell", type = str, help="Name of rHEALPix cell, several names separated by commas or a file with one name per line.")
+    parser.add_argument("indir", type = str, help="Specify the input directory including rHEALPix tiled datasets.")
+    parser.add_argument("outdir", type = str, help="Specify the output directory.")
+    parser.add_argument("-i", "--inventory", help="Look up the tiles of the cells in the layer inventory of indir instead of probing every layer (default: False).", action ="store_true")
+    parser.add_argument("--inputs", help="Read the tiles of the cells from this file written by the driver (see inventory_utils.saveCellInputs()) and delete it afterwards")
+    parser.add_argument("--virtual", help="Write VRT files referencing the tiles instead of copying them (default: False).", action ="store_true")
+    parser.add_argument("--zarr", help="Write the cells into the chunked Zarr cube of outdir instead of KEA files (default: False).", action ="store_true")
+    parser.add_argument("--rios", help="Stack with RIOS instead of the single-pass GDAL stacking (default: False).", action ="store_true")
+    parser.add_argument("--materialise", help="Convert existing virtual stacks of the cells into KEA files (default: False).", action ="store_true")
+    parser.add_argument("--events", help="Append timing events of every cell as JSON lines to this file, see summariseevents.py")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+
+    args = parser.parse_args()
+
+    if args.cell == None:
+        print("Error: no cell specified")
+        sys.exit()
+    cells = readCellList(args.cell)
+
+    if args.indir == None:
+        print("Error: no input file specified")
+        sys.exit()
+    indir = args.indir
+
+    if args.outdir == None:
+        print("Error: no output directory specified")
+        sys.exit()
+    outfileroot = args.outdir
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False    
+
+    if args.virtual:
+        virtual = True
+    else:
+        virtual = False
+
+    if args.zarr:
+        zarrcube = True
+        checkZarr()
+    else:
+        zarrcube = False
+
+    if args.rios:
+        rios = True
+    else:
+        rios = False
+
+    if args.events:
+        enableEvents(args.events)
+
+    if args.materialise:
+        failed = [cellstr for cellstr in cells if os.path.exists(getStackPath(outfileroot, cellstr, True)) and
+                  not materialiseStack(getStackPath(outfileroot, cellstr, True), debug)]
+        if failed:
+            print('Materialising failed for %d of %d cells: %s' %(len(failed), len(cells), ' '.join(failed)))
+            sys.exit(1)
+        sys.exit()
+
+    inputs = None
+    if args.inputs:
+        inputs = loadCellInputs(args.inputs)
+    elif args.inventory:
+        inventory = loadInventory(indir)
+        celllayers = getCellLayers(inventory, indir, cells) # only the requested cells are inverted
+        inputs = dict([(cellstr, getCellInputs(inventory, celllayers, cellstr)) for cellstr in cells])
+   
+    statuses = stackCells(cells, indir, outfileroot, debug = debug, inputs = inputs, virtual = virtual, rios = rios,
+                          zarrcube = zarrcube)
+    if args.inputs: os.remove(args.inputs) # a job that is run again gets a new file
+    failed = [cellstr for cellstr in cells if statuses[cellstr] == 'failed']
+    if failed:
+        print('Stacking failed for %d of %d cells: %s' %(len(failed), len(cells), ' '.join(failed)))
+        sys.exit(1)
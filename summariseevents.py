@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Summarises the timing events written by the pipeline scripts with --events:
+totals and percentiles of every stage per resolution, read and written bytes
+and the slowest cells
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+import numpy
+import argparse
+
+PERCENTILES = [50, 90, 99]
+
+
+def loadEvents(filenames):
+    """
+    Returns the events of all event files; incomplete lines (e.g. of a job that
+    was killed while writing) are skipped
+    """
+    events = []
+    for filename in filenames:
+        with open(filename, mode='r', encoding='utf-8') as eventfile:
+            for line in eventfile:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return events
+
+
+def summariseEvents(events):
+    """
+    Returns {stage: {resolution: summary}} for all timed events. A summary
+    holds the number of events, the total, percentiles and maximum of their
+    duration, the bytes read and written and the number of events per status.
+    Events without cell (e.g. SLURM jobs) are collected under resolution 'all'.
+    """
+    groups = {}
+    for event in events:
+        if 'seconds' not in event: continue
+        res = event.get('res', 'all')
+        groups.setdefault(event['stage'], {}).setdefault(res, []).append(event)
+    summary = {}
+    for stage in groups:
+        summary[stage] = {}
+        for res in groups[stage]:
+            seconds = numpy.array([event['seconds'] for event in groups[stage][res]])
+            statuses = {}
+            for event in groups[stage][res]:
+                if 'status' in event: statuses[event['status']] = statuses.get(event['status'], 0) + 1
+            result = {'count': len(seconds), 'seconds': float(seconds.sum()), 'max': float(seconds.max()),
+                      'bytesread': sum([event.get('bytesread', 0) for event in groups[stage][res]]),
+                      'byteswritten': sum([event.get('byteswritten', 0) for event in groups[stage][res]]),
+                      'statuses': statuses}
+            for q in PERCENTILES:
+                result['p%d' %(q)] = float(numpy.percentile(seconds, q))
+            summary[stage][res] = result
+    return summary
+
+
+def getSlowestCells(events, number = 10):
+    """
+    Returns (seconds, cell, {stage: seconds}) of the number cells that took
+    longest over all of their stages
+    """
+    cells = {}
+    for event in events:
+        if 'cell' not in event or 'seconds' not in event: continue
+        stages = cells.setdefault(event['cell'], {})
+        stages[event['stage']] = stages.get(event['stage'], 0) + event['seconds']
+    slowest = sorted([(sum(stages.values()), cellstr, stages) for cellstr, stages in cells.items()],
+                     key = lambda item: item[0], reverse = True)
+    return slowest[:number]
+
+
+def sortResolutions(resolutions):
+    """
+    Returns the resolutions in ascending order followed by 'all'
+    """
+    return sorted([res for res in resolutions if res != 'all']) + [res for res in resolutions if res == 'all']
+
+
+def printSummary(summary, slowest):
+    """
+    Prints the summary as table
+    """
+    print('%-12s %4s %8s %11s %9s %9s %9s %9s %10s %10s' %('stage', 'res', 'count', 'total [s]', 'p50', 'p90',
+                                                         'p99', 'max', 'read [MB]', 'write [MB]'))
+    for stage in sorted(summary):
+        for res in sortResolutions(summary[stage].keys()):
+            result = summary[stage][res]
+            print('%-12s %4s %8d %11.1f %9.3f %9.3f %9.3f %9.3f %10.1f %10.1f'
+                  %(stage, res, result['count'], result['seconds'], result['p50'], result['p90'], result['p99'],
+                    result['max'], result['bytesread'] / 1048576., result['byteswritten'] / 1048576.))
+    if slowest:
+        print('\nSlowest cells:')
+        for seconds, cellstr, stages in slowest:
+            print('%-16s %9.3f s  (%s)' %(cellstr, seconds,
+                                         ', '.join(['%s %.3f' %(stage, stages[stage]) for stage in sorted(stages)])))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("eventfiles", nargs = '+', help="Event files written with --events.")
+    parser.add_argument("-s", "--stage", help="Only summarise this stage, e.g. warp or stack")
+    parser.add_argument("-n", "--slowest", type = int, help="Number of slowest cells to report (default: 10)")
+    parser.add_argument("-o", "--outfile", help="Write the summary to a JSON file")
+
+    args = parser.parse_args()
+
+    if args.slowest is not None:
+        number = int(args.slowest)
+    else:
+        number = 10
+
+    events = loadEvents(args.eventfiles)
+    if args.stage:
+        events = [event for event in events if event.get('stage') == args.stage]
+    if not events:
+        print("Error: no events found")
+        sys.exit(1)
+
+    summary = summariseEvents(events)
+    slowest = getSlowestCells(events, number)
+    printSummary(summary, slowest)
+    if args.outfile:
+        results = {'stages': dict([(stage, dict([(str(res), summary[stage][res]) for res in summary[stage]]))
+                                   for stage in summary]),
+                   'slowest': [{'cell': cellstr, 'seconds': seconds, 'stages': stages}
+                               for seconds, cellstr, stages in slowest]}
+        with open(args.outfile, mode='w', encoding='utf-8') as outfile:
+            json.dump(results, outfile, indent=1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Tests of the vectorised cell codes, see cellarray_utils.py
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+
+import numpy
+import pytest
+
+# cellarray_utils imports data_utils, which needs GDAL and rhealpix_dggs
+pytest.importorskip('osgeo')
+pytest.importorskip('rhealpix_dggs')
+
+from cellarray_utils import *
+
+
+def getRandomCells(number = 500, maxres = 12, seed = 52):
+    ''' Return random cell names of all resolutions up to maxres '''
+    generator = random.Random(seed)
+    names = list(FACES)
+    for k in range(number):
+        res = generator.randint(1, maxres)
+        names.append(generator.choice(FACES) + ''.join([str(generator.randint(0, 8)) for r in range(res)]))
+    return names
+
+
+def test_encode_decode_round_trip():
+    names = getRandomCells()
+    codes = encodeCells(names)
+    assert decodeCells(codes).tolist() == names
+    assert getResolutions(codes).tolist() == [len(name) - 1 for name in names]
+
+
+def test_codes_of_known_cells():
+    assert encodeCells(['N', 'S']).tolist() == [1, 6]
+    assert encodeCells(['R7']).tolist() == [5 * 9 + 7]
+    assert encodeCells(['O80']).tolist() == [(2 * 9 + 8) * 9]
+
+
+@pytest.mark.parametrize('outfileroot', [None, os.path.join('tiles', 'flats')])
+def test_file_paths_match_getFilePath(outfileroot):
+    names = getRandomCells()
+    paths = getFilePaths(encodeCells(names), outfileroot).tolist()
+    for name, path in zip(names, paths):
+        expected = getFilePath(name)
+        if outfileroot is not None: expected = os.path.join(outfileroot, expected)
+        assert path == expected
+        assert getCellFromTilePath(path) == name
+
+
+def test_file_paths_of_an_empty_array():
+    assert len(getFilePaths(numpy.array([], dtype = numpy.int64))) == 0
+
+
+def test_parents_and_children():
+    names = [name for name in getRandomCells() if len(name) > 1]
+    codes = encodeCells(names)
+    assert decodeCells(getParents(codes)).tolist() == [name[:-1] for name in names]
+    children = getChildren(codes)
+    assert children.shape == (len(names), 9)
+    for k in range(len(names)):
+        assert decodeCells(children[k]).tolist() == [names[k] + str(digit) for digit in range(9)]
+
+
+def test_face_row_col_round_trip():
+    codes = encodeCells(getRandomCells())
+    faces, rows, cols, resolutions = getFaceRowCol(codes)
+    assert (fromFaceRowCol(faces, rows, cols, resolutions) == codes).all()
+    # subcell digits count row by row from the upper left corner
+    faces, rows, cols, resolutions = getFaceRowCol(encodeCells(['P5', 'P48']))
+    assert rows.tolist() == [1, 5] and cols.tolist() == [2, 5]
+
+
+def test_plane_bounds():
+    # faces of 9 x 9 units next to each other
+    facebounds = numpy.array([[9. * k, 0., 9. * (k + 1), 9.] for k in range(len(FACES))])
+    bounds = getPlaneBounds(encodeCells(['N', 'N0', 'N8', 'N48', 'O4']), facebounds)
+    assert bounds.tolist() == [[0., 0., 9., 9.], [0., 6., 3., 9.], [6., 0., 9., 3.],
+                               [5., 3., 6., 4.], [12., 3., 15., 6.]]
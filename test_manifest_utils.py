@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Tests of the tile manifest, see manifest_utils.py
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+from manifest_utils import *
+
+PARAMS = {'resample': 'cubic', 'tilesize': 729, 'blocksize': 243, 'nodata': 0}
+
+
+def writeFile(filename, content = 'tile'):
+    ''' Create a small file standing in for a tile '''
+    with open(filename, mode='w', encoding='utf-8') as outfile:
+        outfile.write(content)
+    return filename
+
+
+def test_fingerprint_follows_size_and_mtime(tmp_path):
+    infile = writeFile(str(tmp_path / 'input.kea'))
+    fingerprint = getFingerprint([infile])
+    assert getFingerprint([infile]) == fingerprint
+    stat = os.stat(infile)
+    assert getStatsFingerprint([(infile, stat.st_size, stat.st_mtime)]) == fingerprint
+    os.utime(infile, (stat.st_atime, stat.st_mtime + 10))
+    assert getFingerprint([infile]) != fingerprint
+    writeFile(infile, 'a larger tile')
+    assert getStatsFingerprint([(infile, stat.st_size, stat.st_mtime)]) == fingerprint
+
+
+def test_manifest_round_trip(tmp_path):
+    outdir = str(tmp_path / 'layer')
+    assert loadManifest(outdir) == {'cells': {}}
+    manifest = loadManifest(outdir)
+    recordCell(manifest, 'R78', 'abc', PARAMS, 'done')
+    saveManifest(outdir, manifest)
+    assert os.listdir(outdir) == [MANIFEST_NAME] # no temporary file is left behind
+    loaded = loadManifest(outdir)
+    assert loaded['cells']['R78']['status'] == 'done'
+    assert loaded['cells']['R78']['params'] == PARAMS
+
+
+@pytest.mark.parametrize('status, fingerprint, params, exists, expected', [
+    (None, 'abc', PARAMS, False, True),                         # never created
+    ('done', 'abc', PARAMS, True, False),                       # up to date
+    ('empty', 'abc', PARAMS, False, False),                     # up to date without tile
+    ('failed', 'abc', PARAMS, False, True),                     # failed
+    ('failed', 'abc', PARAMS, True, True),                      # failed with a left-over tile
+    ('done', 'abc', PARAMS, False, True),                       # tile disappeared
+    ('done', 'xyz', PARAMS, True, True),                        # input changed
+    ('empty', 'xyz', PARAMS, False, True),
+    ('done', 'abc', dict(PARAMS, resample = 'near'), True, True), # other parameters
+])
+def test_needs_update(tmp_path, status, fingerprint, params, exists, expected):
+    filepath = str(tmp_path / 'R78.kea')
+    if exists: writeFile(filepath)
+    manifest = {'cells': {}}
+    if status is not None:
+        recordCell(manifest, 'R78', 'abc', PARAMS, status)
+    assert needsUpdate(manifest, 'R78', fingerprint, params, filepath) == expected
+
+
+def test_needs_update_without_filepath():
+    manifest = {'cells': {}}
+    recordCell(manifest, 'R78', 'abc', PARAMS, 'done')
+    assert not needsUpdate(manifest, 'R78', 'abc', PARAMS)
+    assert hasData(manifest, 'R78')
+    recordCell(manifest, 'R78', 'abc', PARAMS, 'empty')
+    assert not hasData(manifest, 'R78')
+    assert not hasData(manifest, 'R79')
+
+
+def test_tile_status_after_success(tmp_path):
+    filepath = str(tmp_path / 'R78.kea')
+    assert getTileStatus(filepath, True) == 'empty'
+    writeFile(filepath)
+    assert getTileStatus(filepath, True) == 'done'
+    assert os.path.exists(filepath)
+
+
+def test_tile_status_after_failure_deletes_partial_tiles(tmp_path):
+    filepath = str(tmp_path / 'R78.kea')
+    assert getTileStatus(filepath, False) == 'failed'
+    writeFile(filepath)
+    assert getTileStatus(filepath, False) == 'failed'
+    assert not os.path.exists(filepath)
+    zarrpath = tmp_path / 'R78'
+    zarrpath.mkdir()
+    writeFile(str(zarrpath / '.zarray'))
+    assert getTileStatus(str(zarrpath), False) == 'failed'
+    assert not zarrpath.exists()
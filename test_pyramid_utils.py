@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Tests of the in-memory 3x3 aggregation of the fused pyramid, see pyramid_utils.py
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+# pyramid_utils imports data_utils and warp_utils, which need GDAL and rhealpix_dggs
+pytest.importorskip('osgeo')
+pytest.importorskip('rhealpix_dggs')
+
+from pyramid_utils import *
+
+NODATA = -1
+
+# a 3x3 block with a nodata pixel in the centre
+BLOCK = [[1, 2, 3],
+         [4, NODATA, 6],
+         [7, 8, 9]]
+
+
+def toMosaic(block, dtype = numpy.float32):
+    ''' Return a single band array of shape (1, 3*ysize, 3*xsize) '''
+    return numpy.array(block, dtype = dtype)[numpy.newaxis, :, :]
+
+
+@pytest.mark.parametrize('method, expected', [
+    ('average', 5.),  # 40 / 8 valid pixels
+    ('bilinear', 5.), # symmetric weights around the missing centre
+    ('cubic', 5.),
+    ('min', 1.),
+    ('max', 9.),
+])
+def test_reductions_ignore_nodata(method, expected):
+    result = aggregateBlocks(toMosaic(BLOCK), method, NODATA)
+    assert result.shape == (1, 1, 1)
+    assert result[0, 0, 0] == pytest.approx(expected)
+
+
+def test_kernel_weights():
+    # only the centre (weight 1) and the upper left corner (weight (7/9)^2) are valid
+    block = [[9, NODATA, NODATA], [NODATA, 3, NODATA], [NODATA, NODATA, NODATA]]
+    result = aggregateBlocks(toMosaic(block), 'cubic', NODATA)
+    assert result[0, 0, 0] == pytest.approx((9 * 49. / 81. + 3) / (49. / 81. + 1))
+    result = aggregateBlocks(toMosaic(block), 'bilinear', NODATA)
+    assert result[0, 0, 0] == pytest.approx((9 * 4. / 9. + 3) / (4. / 9. + 1))
+
+
+def test_nearest_takes_the_centre():
+    block = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert aggregateBlocks(toMosaic(block), 'near', NODATA)[0, 0, 0] == 5
+
+
+def test_mode_counts_valid_pixels_only():
+    block = [[1, 1, 2], [2, 2, NODATA], [3, NODATA, NODATA]]
+    assert aggregateBlocks(toMosaic(block), 'mode', NODATA)[0, 0, 0] == 2
+
+
+@pytest.mark.parametrize('method', ['average', 'cubic', 'mode', 'min', 'max'])
+def test_empty_blocks_stay_nodata(method):
+    block = numpy.full((3, 3), NODATA)
+    assert aggregateBlocks(toMosaic(block), method, NODATA)[0, 0, 0] == NODATA
+
+
+def test_several_blocks_and_bands():
+    mosaic = numpy.zeros((2, 3, 6), dtype = numpy.float32)
+    mosaic[0, :, :3] = 1
+    mosaic[0, :, 3:] = 2
+    mosaic[1] = 4
+    mosaic[1, 1, 4] = NODATA
+    result = aggregateBlocks(mosaic, 'average', NODATA)
+    assert result.shape == (2, 1, 2)
+    assert result.tolist() == [[[1., 2.]], [[4., 4.]]]
+
+
+def test_integer_results_are_rounded():
+    block = [[1, 2, 2], [2, 2, 2], [2, 2, 2]] # mean 17/9
+    result = aggregateBlocks(toMosaic(block, numpy.uint8), 'average', 0)
+    assert result.dtype == numpy.uint8
+    assert result[0, 0, 0] == 2
+
+
+def test_without_nodata_all_pixels_count():
+    result = aggregateBlocks(toMosaic(BLOCK), 'average', None)
+    assert result[0, 0, 0] == pytest.approx(39. / 9.)
+
+
+def test_unknown_methods_average():
+    assert aggregateBlocks(toMosaic(BLOCK), 'gauss', NODATA)[0, 0, 0] == pytest.approx(5.)
+
+
+def test_cast_to_type():
+    array = numpy.array([-3., 2.6, 300.])
+    assert castToType(array, numpy.uint8).tolist() == [0, 3, 255]
+    assert castToType(array, numpy.int16).tolist() == [-3, 3, 300]
+    assert castToType(array, numpy.float32).dtype == numpy.float32
+
+
+def test_mosaic_children():
+    bounds = (0., 0., 9., 9.)
+    children = [((0., 6., 3., 9.), numpy.full((1, 1, 1), 5.)),  # upper left
+                ((6., 0., 9., 3.), numpy.full((1, 1, 1), 7.))]  # lower right
+    mosaic = mosaicChildren(children, bounds, 1, NODATA)
+    expected = numpy.full((1, 3, 3), NODATA, dtype = float)
+    expected[0, 0, 0] = 5
+    expected[0, 2, 2] = 7
+    assert (mosaic == expected).all()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Tests of the job array states, see slurm_utils.py
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+import slurm_utils
+from slurm_utils import *
+
+
+@pytest.mark.parametrize('jobid, tasks', [
+    ('123', []),
+    ('123_4', [4]),
+    ('123_4.batch', [4]),
+    ('123_[5-9]', [5, 6, 7, 8, 9]),
+    ('123_[1,3,5-7%2]', [1, 3, 5, 6, 7]),
+])
+def test_array_tasks(jobid, tasks):
+    assert getArrayTasks(jobid) == tasks
+    assert getBaseJob(jobid) == '123'
+
+
+def test_successful_states():
+    assert isJobSuccessful('COMPLETED')
+    assert isJobSuccessful('UNKNOWN') # no accounting, judged by the files
+    for state in ['FAILED', 'TIMEOUT', 'CANCELLED', 'OUT_OF_MEMORY', None]:
+        assert not isJobSuccessful(state)
+
+
+def test_command_states_of_a_completed_array(monkeypatch):
+    def querySacctTasks(job):
+        raise AssertionError('tasks of a completed array are not queried')
+    monkeypatch.setattr(slurm_utils, 'querySacctTasks', querySacctTasks)
+    assert getCommandStates('123', 'COMPLETED', 3, 2) == ['COMPLETED'] * 3
+
+
+def test_command_states_follow_their_bundle(monkeypatch):
+    # task 1 timed out, task 2 never started and is unknown to sacct
+    monkeypatch.setattr(slurm_utils, 'querySacctTasks', lambda job: {0: 'COMPLETED', 1: 'TIMEOUT', 3: 'COMPLETED'})
+    states = getCommandStates('123', 'TIMEOUT', 7, 2)
+    assert states == ['COMPLETED', 'COMPLETED', 'TIMEOUT', 'TIMEOUT', 'TIMEOUT', 'TIMEOUT', 'COMPLETED']
+
+
+def test_command_states_without_accounting(monkeypatch):
+    monkeypatch.setattr(slurm_utils, 'querySacctTasks', lambda job: None)
+    assert getCommandStates('123', 'FAILED', 2) == ['FAILED', 'FAILED']
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Tests of the summary of timing events, see summariseevents.py
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+from summariseevents import *
+
+EVENTS = [
+    {'stage': 'warp', 'cell': 'R78', 'res': 1, 'seconds': 2., 'status': 'done', 'byteswritten': 100},
+    {'stage': 'warp', 'cell': 'R77', 'res': 1, 'seconds': 4., 'status': 'empty'},
+    {'stage': 'warp', 'cell': 'R7', 'res': 0, 'seconds': 1., 'status': 'done', 'bytesread': 50},
+    {'stage': 'write', 'cell': 'R78', 'res': 1, 'seconds': 3.},
+    {'stage': 'queue', 'job': '123_4', 'seconds': 10.},
+    {'stage': 'submit', 'job': '123'}, # not timed
+]
+
+
+def test_load_events_skips_incomplete_lines(tmp_path):
+    eventfile = tmp_path / 'events.jsonl'
+    lines = [json.dumps(event) for event in EVENTS[:2]] + ['{"stage": "warp", "sec']
+    eventfile.write_text('\n'.join(lines), encoding = 'utf-8')
+    assert loadEvents([str(eventfile)]) == EVENTS[:2]
+
+
+def test_summary_by_stage_and_resolution():
+    summary = summariseEvents(EVENTS)
+    assert sorted(summary) == ['queue', 'warp', 'write']
+    warp = summary['warp'][1]
+    assert warp['count'] == 2
+    assert warp['seconds'] == pytest.approx(6.)
+    assert warp['max'] == pytest.approx(4.)
+    assert warp['p50'] == pytest.approx(3.)
+    assert warp['statuses'] == {'done': 1, 'empty': 1}
+    assert warp['byteswritten'] == 100 and warp['bytesread'] == 0
+    assert summary['warp'][0]['bytesread'] == 50
+    assert summary['queue']['all']['count'] == 1 # events without cell
+
+
+def test_slowest_cells_sum_their_stages():
+    slowest = getSlowestCells(EVENTS, 2)
+    assert [(seconds, cellstr) for seconds, cellstr, stages in slowest] == [(5., 'R78'), (4., 'R77')]
+    assert slowest[0][2] == {'warp': 2., 'write': 3.}
+
+
+def test_resolutions_are_sorted_before_all():
+    assert sortResolutions(['all', 3, 0, 12]) == [0, 3, 12, 'all']
@@ -1,243 +1,775 @@
-#!/usr/bin/env python
-"""
-Creates a tiled dataset based on rhealpix DGGS and projection
-
-"""
-# This file is part of scenzgrid-py
-# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
-# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import os
-import sys
-import shutil
-import subprocess
-import time
-import argparse
-
-from osgeo import gdal, osr, ogr
-from gdalconst import *
-
-from rios import fileinfo
-
-from rhealpix_dggs.dggs import *
-from rhealpix_dggs.ellipsoids import *
-
-from slurm_utils import *
-from data_utils import *
-
-if __name__ == '__main__':
-    
-    start = time.time()
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("infile", type = str, help="Specify the input kea file.")
-    parser.add_argument("outdir", type = str, help="Specify the output directory.")
-    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
-    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")
-    parser.add_argument("-p", "--parallelism", help="Choice of no (default) or slurm")
-    parser.add_argument("-r", "--resamplingmethod", type = str, help="Specify the resampling method (default: cubic")
-    parser.add_argument("-t", "--tilesize", type = int, help="Specify the output tile size (default: 729)")
-    parser.add_argument("-b", "--blocksize", type = int, help="Specify the output block size (default: 243)")
-    parser.add_argument("-g", "--globalex", help="Create global coverage output (default: False).", action ="store_true")
-    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
-    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
-    parser.add_argument("-e", "--excludelist", help="Supply file with list of tiles to be excluded (has to match maxres).")
-    
-    args = parser.parse_args()
-
-    if args.infile == None:
-        print("Error: no input file specified")
-        sys.exit()
-    infile = args.infile
-
-    if args.outdir == None:
-        print("Error: no output directory specified")
-        sys.exit()
-    outfileroot = args.outdir
-
-    if args.minres == None:
-        print("Error: minres not specified")
-        sys.exit()
-    minresolution = int(args.minres)
-
-    if args.maxres == None:
-        print("Error: yres not specified")
-        sys.exit()
-    maxresolution = int(args.maxres)
-
-    if args.parallelism == 'slurm':
-        parallelism = args.parallelism
-    else:
-        parallelism = None
-
-    if args.resamplingmethod:
-        resample = args.resamplingmethod
-    else:
-        resample = 'cubic'
-
-    if args.tilesize:
-        tilesize = int(args.tilesize)
-    else:
-        tilesize = 729
-
-    if args.blocksize:
-        blocksize = int(args.blocksize)
-    else:
-        blocksize = 243
-
-    if args.globalex:
-        globalextent = True
-    else:
-        globalextent = False
-
-    if args.shapefile:
-        shapefile = str(args.shapefile)
-    else:
-        shapefile = None
-
-    if args.verbose:
-        debug = True
-    else:
-        debug = False
-
-    excludelist = []
-    if args.excludelist:        
-        # read in list with excluded tiles, e.g. ocean area
-        with open(args.excludelist, mode='r', encoding='utf-8') as excludefile:
-            for line in excludefile:
-                excludelist.append(line.rstrip())
-        print(excludelist)
-    else:
-        excludelist = []
-
-    if os.path.exists(outfileroot): # delete existing files if necessary
-        shutil.rmtree(outfileroot)
-        os.makedirs(outfileroot)
-
-    if parallelism == 'slurm': jobs = [] # initialize job list
-  
-    # get extent and input crs from raster file
-    ds = gdal.Open(infile)
-    gt = ds.GetGeoTransform()
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-    ext = getExtent(gt,cols,rows)
-    src_srs=osr.SpatialReference()
-    prj = ds.GetProjection()
-    src_srs.ImportFromWkt(prj)
-    s_srs = 'EPSG:%s' %(src_srs.GetAuthorityCode('projcs'))
-    if s_srs == 'EPSG:None': s_srs = 'EPSG:%s' %(src_srs.GetAuthorityCode('GEOGCS'))
-    if s_srs == 'EPSG:None': s_srs = 'EPSG:4326' # If all fails assume geographic coordinates
-    if debug: print(s_srs)
-    # if necessary transform into lat/long
-    if s_srs != 'EPSG:4326':
-        tgt_srs = src_srs.CloneGeogCS()
-        geo_ext=reprojectCoords(ext,src_srs,tgt_srs)
-        w = min(geo_ext[0][0], geo_ext[1][0])
-        e = max(geo_ext[2][0], geo_ext[3][0])
-        n = max(geo_ext[0][1], geo_ext[3][1])
-        s = min(geo_ext[1][1], geo_ext[2][1])
-        nw = [w, n]
-        se = [e, s]
-
-    # define output extent if different from input raster
-    if globalextent:
-        nw = [-180, 90]
-        se = [180, -90]
-    if shapefile:
-        # Get a Layer's Extent; shapefile has to use lat/long
-        inShapefile = shapefile
-        inDriver = ogr.GetDriverByName("ESRI Shapefile")
-        inDataSource = inDriver.Open(inShapefile, 0)
-        inLayer = inDataSource.GetLayer()
-        ext = inLayer.GetExtent()
-        nw = [ext[0], ext[3]]
-        se = [ext[1], ext[2]]
-     
-    if debug: print(nw)
-    if debug: print(se)
-
-    # get nodata value of input dataset; has to be set explicitely for gdalwarp
-    info = fileinfo.ImageInfo(infile)
-    dstnodata = info.nodataval
-    print(dstnodata[0])
-    if dstnodata[0] is None:
-        print("nodata value for input dataset not defined. Using 0")
-        dstnodata = [255]
-    
-    # create 'standard' DGGS based on WGS84 and center meridian at 52 deg and corresponding WKT string
-    n_square = 1
-    s_square = 3
-    a = 6378137
-    central_meridian = 52
-    E = Ellipsoid(lon_0 = central_meridian)
-    rddgs = RHEALPixDGGS(ellipsoid = E, north_square=n_square, south_square=s_square, N_side=3)
-    t_srs = "\'+proj=rhealpix +lon_0=%f +a=%f +ellps=WGS84 +north_square=%d +south_square=%d +towgs84=0,0,0 +wktext\'" %(central_meridian, a, n_square, s_square) # WKT string for rhealpix 
-
-    for i in range(maxresolution,minresolution-1,-1): # iterate over resolutions and create grids
-        grid = rddgs.cells_from_region(i, nw, se, plane=False)
-        for row in grid:
-            for c in row:
-                if debug: print(str(c))
-                filepath = os.path.join(outfileroot, getFilePath(c))
-                if debug: print(filepath)
-                if not os.path.exists(os.path.dirname(filepath)):
-                    if debug: print('now will create %s' %(os.path.dirname(filepath)))
-                    os.makedirs(os.path.dirname(filepath))                
-                # Extract coordinates needed for tiling
-                vertices = c.vertices()                
-                xmin=vertices[0][0]
-                ymin=vertices[2][1]
-                xmax=vertices[1][0]
-                ymax=vertices[0][1]                 
-                if i == maxresolution:  # grid with highest resolution is created from original data
-                    if str(c) not in excludelist:
-                        # Following parameters should to be used for global datasets (EPSG:4326): -wo "SAMPLE_STEPS=168" -wo "SAMPLE_GRID=YES"
-                        warpstring = 'gdalwarp -dstnodata %s -s_srs %s -t_srs %s -te %f %f %f %f -ts %d %d -r %s -co IMAGEBLOCKSIZE=%d -of kea %s %s' \
-                        %(int(dstnodata[0]), s_srs, t_srs,  xmin, ymin, xmax, ymax, tilesize, tilesize, resample, blocksize, infile, filepath)
-                    else: warpstring = False
-                else: #create lower resolution grids from higher ones by resampling
-                    subcellstr = ''
-                    for cell in c.subcells():
-                        appendstring = os.path.join(outfileroot, getFilePath(cell))
-                        if os.path.isfile(appendstring):
-                            subcellstr = subcellstr + ' ' + appendstring
-                    if not subcellstr:
-                        warpstring = False
-                    else:
-                        warpstring = 'gdalwarp -dstnodata %s -s_srs %s -t_srs %s -te %f %f %f %f -ts %d %d -r %s -co IMAGEBLOCKSIZE=%d -of kea %s %s' \
-                            %(dstnodata[0], t_srs, t_srs, xmin, ymin, xmax, ymax, tilesize, tilesize, resample, blocksize, subcellstr, filepath)
-                if debug: print(warpstring)
-                if warpstring: 
-                    if  parallelism == 'slurm':
-                        jobs = submitSLURMjob(warpstring, jobs)
-                    else: os.system(warpstring)
-
-        if parallelism == 'slurm': jobs = checkSLURMjobs(jobs, debug = True) # check if all tiles are created and only afterwards go on
-        # check if empty files were created
-        for row in grid:
-            for c in row:
-                if str(c) not in excludelist:
-                    filepath = os.path.join(outfileroot, getFilePath(c))
-                    if os.path.exists(filepath):
-                        if isEmpty(filepath): os.remove(filepath) # delete empty output files
-    elapsed = time.time() - start
-    print('Elapsed time: %g seconds' %(elapsed))
-
-
-
-
-
+#!/usr/bin/env python
+"""
+Creates a tiled dataset based on rhealpix DGGS and projection
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import subprocess
+import multiprocessing
+import time
+import numpy
+import argparse
+
+from osgeo import gdal, osr, ogr
+from gdalconst import *
+
+from rios import fileinfo
+
+from rhealpix_dggs.dggs import *
+from rhealpix_dggs.ellipsoids import *
+
+from slurm_utils import *
+from local_utils import *
+from data_utils import *
+from cellindex_utils import *
+from cellarray_utils import *
+from warp_utils import *
+from pyramid_utils import *
+from dag_utils import *
+from manifest_utils import *
+from instrument_utils import *
+from mosaic_utils import *
+
+if __name__ == '__main__':
+    
+    start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", type = str, help="Specify the input kea file.")
+    parser.add_argument("outdir", type = str, help="Specify the output directory.")
+    parser.add_argument("minres", type = int, help="Specify the minimum output grid resolution.")
+    parser.add_argument("maxres", type = int, help="Specify the maximum output grid resolution.")
+    parser.add_argument("-p", "--parallelism", help="Choice of no (default), local or slurm")
+    parser.add_argument("-k", "--bundlesize", type = int, help="Number of commands run by each task of a SLURM job array (default: 1)")
+    parser.add_argument("-w", "--workers", type = int, help="Number of worker processes for local parallelism (default: number of CPUs) or minimum number of subtree jobs for --dag with slurm (default: 100)")
+    parser.add_argument("-r", "--resamplingmethod", type = str, help="Specify the resampling method (default: cubic")
+    parser.add_argument("-t", "--tilesize", type = int, help="Specify the output tile size (default: 729)")
+    parser.add_argument("-b", "--blocksize", type = int, help="Specify the output block size (default: 243)")
+    parser.add_argument("-g", "--globalex", help="Create global coverage output (default: False).", action ="store_true")
+    parser.add_argument("-s", "--shapefile", help="Supply shapefile that defines output extent")
+    parser.add_argument("--extentonly", help="Use all cells within the extent of the shapefile instead of only those intersecting its polygons (default: False).", action ="store_true")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+    parser.add_argument("--cellindex", help="Supply cell index (see buildcellindex.py) to look up the cells of the region")
+    parser.add_argument("-e", "--excludelist", help="Supply file with list of tiles to be excluded (has to match maxres).")
+    parser.add_argument("-c", "--cmdwarp", help="Call gdalwarp for every tile instead of warping in-process (default: False).", action ="store_true")
+    parser.add_argument("-f", "--fusedpyramid", help="Aggregate lower resolutions in memory from their subcells (default: False).", action ="store_true")
+    parser.add_argument("-d", "--dag", help="Start every cell as soon as its subcells are finished instead of waiting for whole resolutions (default: False).", action ="store_true")
+    parser.add_argument("-o", "--overviews", help="Warp every resolution directly from the best matching overview of the input instead of from the tiles of the next higher resolution; internal overviews are built if the input has none (default: False).", action ="store_true")
+    parser.add_argument("--warpprofile", help="Warp performance profile: %s (default: default, i.e. the GDAL defaults); compare them with benchmark.py -b warpprofile" %(', '.join(sorted(WARP_PROFILES))))
+    parser.add_argument("--errorthreshold", type = float, help="Error threshold of the approximate transformer in pixels, 0 for exact transformation (overrides the profile)")
+    parser.add_argument("--warpmemory", type = int, help="Warp memory in MB (overrides the profile)")
+    parser.add_argument("--warpthreads", help="Number of warping threads per process or ALL_CPUS (overrides the profile)")
+    parser.add_argument("--cachemax", type = int, help="GDAL block cache in MB (overrides the profile)")
+    parser.add_argument("--samplesteps", type = int, help="Number of sample steps for the source window of a tile; enables SAMPLE_GRID (overrides the profile)")
+    parser.add_argument("--footprint", help="Skip cells that do not intersect the valid data of the input file (default: False).", action ="store_true")
+    parser.add_argument("--clean", help="Delete all existing tiles instead of only updating missing, failed or outdated ones (default: False).", action ="store_true")
+    parser.add_argument("--stats", help="Calculate statistics for all created tiles (default: False).", action ="store_true")
+    parser.add_argument("--cell", type = str, help="Only create the tile of this cell from the input file or existing subcell tiles.")
+    parser.add_argument("--celllist", help="Only create the tiles of the cells listed in this file (one per line, subcells before their parents) in one process.")
+    parser.add_argument("-a", "--addinput", nargs = 3, action = "append", metavar = ("INFILE", "OUTDIR", "RESAMPLING"), help="Tile a further input co-registered with infile into its own output directory with its own resampling method; can be repeated. Cells for which infile has no valid data are skipped for all inputs.")
+    parser.add_argument("--skipvalue", type = float, help="Treat cells in which infile only contains this value (e.g. a fully cloudy mask) as empty for all inputs")
+    parser.add_argument("-m", "--mosaic", help="infile is a text file listing one input raster per line; the rasters are mosaicked into one layer and every tile is only warped from the rasters intersecting its cell (default: False).", action ="store_true")
+    parser.add_argument("--overlap", type = str, help="Rule for pixels with valid data in several rasters of a mosaic: first, last (in the order of the list) or maxvalid (default: first)")
+    parser.add_argument("--events", help="Append timing events of every cell and stage as JSON lines to this file, see summariseevents.py")
+    
+    args = parser.parse_args()
+
+    if args.infile == None:
+        print("Error: no input file specified")
+        sys.exit()
+    infile = args.infile
+
+    if args.outdir == None:
+        print("Error: no output directory specified")
+        sys.exit()
+    outfileroot = args.outdir
+
+    if args.minres == None:
+        print("Error: minres not specified")
+        sys.exit()
+    minresolution = int(args.minres)
+
+    if args.maxres == None:
+        print("Error: yres not specified")
+        sys.exit()
+    maxresolution = int(args.maxres)
+
+    if args.parallelism in ['slurm', 'local']:
+        parallelism = args.parallelism
+    else:
+        parallelism = None
+
+    if args.workers:
+        workers = int(args.workers)
+    else:
+        workers = None
+
+    if args.bundlesize:
+        bundlesize = int(args.bundlesize)
+    else:
+        bundlesize = 1
+
+    if args.resamplingmethod:
+        resample = args.resamplingmethod
+    else:
+        resample = 'cubic'
+
+    if args.tilesize:
+        tilesize = int(args.tilesize)
+    else:
+        tilesize = 729
+
+    if args.blocksize:
+        blocksize = int(args.blocksize)
+    else:
+        blocksize = 243
+
+    if args.globalex:
+        globalextent = True
+    else:
+        globalextent = False
+
+    if args.shapefile:
+        shapefile = str(args.shapefile)
+    else:
+        shapefile = None
+
+    if args.extentonly:
+        extentonly = True
+    else:
+        extentonly = False
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False
+
+    if args.cellindex:
+        cellindexfile = str(args.cellindex)
+    else:
+        cellindexfile = None
+
+    if args.cmdwarp:
+        cmdwarp = True
+    else:
+        cmdwarp = False
+
+    if args.fusedpyramid:
+        fusedpyramid = True
+    else:
+        fusedpyramid = False
+    if fusedpyramid and parallelism == 'slurm':
+        print("Fused pyramid generation is not available with slurm. Warping every resolution instead")
+        fusedpyramid = False
+    if fusedpyramid and cmdwarp:
+        print("Fused pyramid generation warps in-process. Ignoring --cmdwarp")
+        cmdwarp = False
+
+    if args.dag and parallelism:
+        dag = True
+    else:
+        dag = False
+
+    if args.overviews:
+        overviews = True
+    else:
+        overviews = False
+    if overviews and fusedpyramid:
+        print("Every resolution is warped from the overviews of the input. Ignoring --fusedpyramid")
+        fusedpyramid = False
+    if overviews and dag:
+        print("Resolutions do not depend on each other with --overviews. Ignoring --dag")
+        dag = False
+
+    if args.warpprofile:
+        warpprofile = args.warpprofile
+    else:
+        warpprofile = 'default'
+    if warpprofile not in WARP_PROFILES:
+        print("Error: warp profile has to be one of %s" %(', '.join(sorted(WARP_PROFILES))))
+        sys.exit(1)
+    profile = getWarpProfile(warpprofile, errorthreshold = args.errorthreshold, warpmemory = args.warpmemory,
+                             threads = args.warpthreads, cachemax = args.cachemax, samplesteps = args.samplesteps)
+    if debug: print(profile)
+
+    if args.addinput:
+        addinputs = [tuple(addinput) for addinput in args.addinput]
+    else:
+        addinputs = []
+
+    if args.skipvalue is not None:
+        skipvalue = args.skipvalue
+    else:
+        skipvalue = None
+
+    if args.mosaic:
+        mosaicfiles = readSourceList(infile)
+        if not mosaicfiles:
+            print("Error: no input files listed in %s" %(infile))
+            sys.exit(1)
+        infile = mosaicfiles[0] # projection, nodata value and bands are taken from the first source
+        mosaic = True
+    else:
+        mosaicfiles = None
+        mosaic = False
+
+    if args.overlap:
+        overlap = args.overlap
+    else:
+        overlap = 'first'
+    if overlap not in OVERLAP_RULES:
+        print("Error: overlap rule has to be one of %s" %(', '.join(OVERLAP_RULES)))
+        sys.exit(1)
+
+    if mosaic and (addinputs or skipvalue is not None):
+        print("Error: --addinput and --skipvalue are not available for a mosaic")
+        sys.exit(1)
+
+    # several inputs (or a skip value) share one empty decision per cell, see warpCellInputs()
+    multiinput = bool(addinputs) or skipvalue is not None
+    if (multiinput or mosaic) and cmdwarp:
+        print("Several inputs are warped in-process. Ignoring --cmdwarp")
+        cmdwarp = False
+    if (multiinput or mosaic) and fusedpyramid:
+        print("Fused pyramid generation is not available for several inputs. Warping every resolution instead")
+        fusedpyramid = False
+    if (multiinput or mosaic) and dag:
+        print("Several inputs are tiled resolution by resolution. Ignoring --dag")
+        dag = False
+
+    if args.footprint:
+        footprint = True
+    else:
+        footprint = False
+
+    if args.clean:
+        clean = True
+    else:
+        clean = False
+
+    if args.stats:
+        stats = True
+    else:
+        stats = False
+
+    if args.cell:
+        cellnames = [args.cell]
+    elif args.celllist:
+        # e.g. a subtree of a dependency-driven SLURM run, see submitDAGSLURM()
+        with open(args.celllist, mode='r', encoding='utf-8') as cellfile:
+            cellnames = [line.strip() for line in cellfile if line.strip()]
+    else:
+        cellnames = None
+
+    if args.events:
+        enableEvents(args.events) # inherited by workers, commands and SLURM jobs
+
+    excludelist = []
+    if args.excludelist:        
+        # read in list with excluded tiles, e.g. ocean area
+        with open(args.excludelist, mode='r', encoding='utf-8') as excludefile:
+            for line in excludefile:
+                excludelist.append(line.rstrip())
+        print(excludelist)
+    else:
+        excludelist = []
+
+    if clean and not cellnames: # delete existing files if requested
+        for root in [outfileroot] + [addroot for addfile, addroot, addresample in addinputs]:
+            if os.path.exists(root):
+                shutil.rmtree(root)
+                os.makedirs(root)
+
+    if parallelism: jobs = [] # initialize job list
+    if parallelism == 'slurm': commands = [] # commands of the current resolution, submitted as one job array
+  
+    # get extent and input crs from raster file
+    ds = gdal.Open(infile)
+    gt = ds.GetGeoTransform()
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    ext = getExtent(gt,cols,rows)
+    src_srs=osr.SpatialReference()
+    prj = ds.GetProjection()
+    src_srs.ImportFromWkt(prj)
+    s_srs = 'EPSG:%s' %(src_srs.GetAuthorityCode('projcs'))
+    if s_srs == 'EPSG:None': s_srs = 'EPSG:%s' %(src_srs.GetAuthorityCode('GEOGCS'))
+    if s_srs == 'EPSG:None': s_srs = 'EPSG:4326' # If all fails assume geographic coordinates
+    if debug: print(s_srs)
+    # further inputs share the grid, the extent and the transformation of infile
+    for addfile, addroot, addresample in addinputs:
+        add_ds = gdal.Open(addfile)
+        add_srs = osr.SpatialReference()
+        if add_ds is not None: add_srs.ImportFromWkt(add_ds.GetProjection())
+        if add_ds is None or add_ds.GetGeoTransform() != gt or add_ds.RasterXSize != cols or \
+           add_ds.RasterYSize != rows or not add_srs.IsSame(src_srs):
+            print("Error: %s is not co-registered with %s" %(addfile, infile))
+            sys.exit(1)
+        add_ds = None
+    # if necessary transform into lat/long
+    if s_srs != 'EPSG:4326':
+        tgt_srs = src_srs.CloneGeogCS()
+        geo_ext=reprojectCoords(ext,src_srs,tgt_srs)
+        w = min(geo_ext[0][0], geo_ext[1][0])
+        e = max(geo_ext[2][0], geo_ext[3][0])
+        n = max(geo_ext[0][1], geo_ext[3][1])
+        s = min(geo_ext[1][1], geo_ext[2][1])
+        nw = [w, n]
+        se = [e, s]
+    if mosaic:
+        # the region covers all sources, which have to share the bands of the first one
+        for source in mosaicfiles:
+            source_ds = gdal.Open(source)
+            if source_ds is None or source_ds.RasterCount != ds.RasterCount:
+                print("Error: %s can not be mosaicked with %s" %(source, infile))
+                sys.exit(1)
+            source_ds = None
+        extents = [getLonLatExtent(source) for source in mosaicfiles]
+        nw = [min([e[0][0] for e in extents]), max([e[0][1] for e in extents])]
+        se = [max([e[1][0] for e in extents]), min([e[1][1] for e in extents])]
+
+    # define output extent if different from input raster
+    if globalextent:
+        nw = [-180, 90]
+        se = [180, -90]
+    aoi = None
+    if shapefile:
+        # Get a Layer's Extent and polygons; shapefile has to use lat/long
+        nw, se, aoi = getAOI(shapefile, getStandardProj4())
+        if extentonly: aoi = None
+     
+    if debug: print(nw)
+    if debug: print(se)
+
+    # get nodata value of input dataset; has to be set explicitely for gdalwarp
+    info = fileinfo.ImageInfo(infile)
+    dstnodata = info.nodataval
+    print(dstnodata[0])
+    if dstnodata[0] is None:
+        print("nodata value for input dataset not defined. Using 0")
+        dstnodata = [255]
+    
+    # create 'standard' DGGS based on WGS84 and center meridian at 52 deg and corresponding WKT string
+    rddgs = getStandardDGGS()
+    t_srs = getStandardProj4() # WKT string for rhealpix 
+
+    # (input, output directory, resampling, nodata) of all inputs; infile decides which cells are empty
+    layers = [(infile, outfileroot, resample, int(dstnodata[0]))]
+    for addfile, addroot, addresample in addinputs:
+        addnodata = fileinfo.ImageInfo(addfile).nodataval[0]
+        if addnodata is None:
+            print("nodata value for %s not defined. Using 255" %(addfile))
+            addnodata = 255
+        layers.append((addfile, addroot, addresample, int(addnodata)))
+
+    if overviews:
+        # built once by the driver; single-cell jobs only read them
+        if not cellnames:
+            if mosaic: sources = [(source, resample) for source in mosaicfiles]
+            else: sources = [(layerfile, layerresample) for layerfile, layerroot, layerresample, layernodata in layers]
+            for source, sourceresample in sources:
+                buildOverviews(source, sourceresample, tilesize, debug) # e.g. near for categorical masks
+        ovr_ds = gdal.Open(infile)
+        overviewfactors = getOverviewFactors(ovr_ds)
+        pixelsize = getGroundPixelSize(ovr_ds)
+        ovr_ds = None
+
+    if mosaic:
+        # footprints of all sources, reused from earlier runs and by single-cell jobs
+        mosaicindex = getSourceIndex(mosaicfiles, t_srs, outfileroot, debug)
+        mosaicargs = (t_srs, int(dstnodata[0]), tilesize, blocksize, resample, overlap, debug, overviews, profile)
+        print('Mosaic of %d input files (overlap: %s)' %(len(mosaicfiles), overlap))
+
+    # in-process warping engine; gdalwarp command strings are still used for SLURM jobs
+    warperargs = (infile, s_srs, t_srs, int(dstnodata[0]), tilesize, blocksize, resample, debug, overviews, profile)
+    warperargslist = [(layerfile, s_srs, t_srs, layernodata, tilesize, blocksize, layerresample, debug, overviews, profile)
+                      for layerfile, layerroot, layerresample, layernodata in layers]
+    if cellnames:
+        # create single tiles, e.g. the tasks of a dependency-driven run; the cells of
+        # a list are created in order in one process, subcells before their parents
+        if multiinput: warpers = [TileWarper(*layerargs) for layerargs in warperargslist]
+        elif not cmdwarp: warper = TileWarper(*warperargs)
+        if mosaic: mosaicwarper = MosaicWarper(mosaicindex, *mosaicargs)
+        failed = set() # failed cells and their ancestors, which are not created
+        for cellname in cellnames:
+            if cellname in failed:
+                print('%s: failed (subcells failed)' %(cellname))
+                continue
+            c = getCell(rddgs, cellname)
+            filepaths = [os.path.join(layerroot, getFilePath(c)) for layerfile, layerroot, layerresample, layernodata in layers]
+            filepath = filepaths[0]
+            for layerpath in filepaths:
+                if not os.path.exists(os.path.dirname(layerpath)):
+                    try:
+                        os.makedirs(os.path.dirname(layerpath))
+                    except OSError: # created by another task in the meantime
+                        pass
+            bounds = getCellBounds(c)
+            if len(cellname) - 1 == maxresolution:
+                if cellname in excludelist: continue
+                subcellfiles = None
+            elif overviews:
+                subcellfiles = None # warped from an overview of the input
+            else:
+                subcellfiles = getSubcellPaths(c, outfileroot)
+            if cmdwarp:
+                status = 'empty'
+                if subcellfiles is None:
+                    if overviews: overview = selectOverview(overviewfactors, pixelsize, bounds, tilesize)
+                    else: overview = None
+                    warpstring = getWarpString(infile, filepath, bounds, s_srs, t_srs, int(dstnodata[0]),
+                                               tilesize, blocksize, resample, overview, profile)
+                else:
+                    srcfiles = [f for f in subcellfiles if os.path.isfile(f)]
+                    warpstring = False
+                    if srcfiles:
+                        warpstring = getWarpString(' '.join(srcfiles), filepath, bounds, t_srs, t_srs, dstnodata[0],
+                                                   tilesize, blocksize, resample, profile = profile)
+                if warpstring:
+                    if debug: print(warpstring)
+                    with timedStage('warp', cellname) as event:
+                        commandfailed = (os.system(warpstring) != 0)
+                        event['byteswritten'] = getFileSize(filepath)
+                    if commandfailed: status = getTileStatus(filepath, False) # deletes an incomplete tile
+                    elif os.path.exists(filepath):
+                        with timedStage('emptycheck', cellname):
+                            empty = isEmpty(filepath)
+                        if empty: os.remove(filepath) # delete empty output files
+                        else: status = 'done'
+            elif mosaic and subcellfiles is None:
+                status = warpMosaicCell(mosaicwarper, filepath, bounds)
+            elif multiinput:
+                if subcellfiles is not None:
+                    subcellfiles = [getSubcellPaths(c, layerroot) for layerfile, layerroot, layerresample, layernodata in layers]
+                statuses = warpCellInputs(warpers, filepaths, bounds, subcellfiles, skipvalue)
+                if 'failed' in statuses: status = 'failed'
+                else: status = statuses[0]
+            else:
+                status = warpCell(warper, filepath, bounds, subcellfiles)
+            print('%s: %s' %(cellname, status))
+            if status == 'failed':
+                for res in range(len(cellname) - 1):
+                    failed.add(cellname[:res+1])
+                failed.add(cellname)
+        if multiinput:
+            for layerwarper in warpers: layerwarper.close()
+        elif not cmdwarp: warper.close()
+        if mosaic: mosaicwarper.close()
+        if failed: sys.exit(1)
+        sys.exit()
+
+    # cells of the region are read from the cell index if one is given
+    regions = getRegionSource(rddgs, cellindexfile, debug)
+
+    skipcells = set()
+    if footprint:
+        # cells that do not intersect the valid data of the input file(s) are never warped
+        if mosaic: validdata = mosaicindex.getUnion()
+        else: validdata = getFootprint(infile, t_srs)
+        skipcells = getCellsOutsideFootprint(regions, minresolution, maxresolution, nw, se, validdata)
+    if aoi is not None:
+        # cells outside the polygons of the shapefile are neither warped nor aggregated
+        skipcells |= getCellsOutsideGeometry(regions, minresolution, maxresolution, nw, se, aoi, 'AOI')
+
+    # tiles that are up to date according to the manifest are not created again
+    manifest = loadManifest(outfileroot)
+    fingerprint = getFingerprint(mosaicfiles if mosaic else [infile])
+    params = {'resample': resample, 'tilesize': tilesize, 'blocksize': blocksize, 'nodata': int(dstnodata[0])}
+    if mosaic: params['overlap'] = overlap
+    if overviews: params['overviews'] = True
+    # every further input has its own manifest in its output directory
+    manifests = [manifest] + [loadManifest(layerroot) for layerfile, layerroot, layerresample, layernodata in layers[1:]]
+    fingerprints = [fingerprint] + [getFingerprint([layerfile]) for layerfile, layerroot, layerresample, layernodata in layers[1:]]
+    paramslist = [params] + [{'resample': layerresample, 'tilesize': tilesize, 'blocksize': blocksize, 'nodata': layernodata}
+                             for layerfile, layerroot, layerresample, layernodata in layers[1:]]
+    if overviews:
+        for layerparams in paramslist[1:]: layerparams['overviews'] = True
+    # settings of the profile that change the warped pixels; the others only change the speed
+    for key in ['errorthreshold', 'samplesteps']:
+        if profile[key] is not None:
+            for layerparams in paramslist: layerparams[key] = profile[key]
+
+    # command that creates a single cell, used for SLURM jobs of single cells
+    cellcmd = 'python tilerasterlayer.py %s %s %d %d --resamplingmethod %s --tilesize %d --blocksize %d' \
+        %(args.infile, outfileroot, minresolution, maxresolution, resample, tilesize, blocksize)
+    if args.excludelist: cellcmd = cellcmd + ' --excludelist %s' %(args.excludelist)
+    if cmdwarp: cellcmd = cellcmd + ' --cmdwarp'
+    if overviews: cellcmd = cellcmd + ' --overviews'
+    if warpprofile != 'default': cellcmd = cellcmd + ' --warpprofile %s' %(warpprofile)
+    for option, value in [('--errorthreshold', args.errorthreshold), ('--warpmemory', args.warpmemory),
+                          ('--warpthreads', args.warpthreads), ('--cachemax', args.cachemax),
+                          ('--samplesteps', args.samplesteps)]:
+        if value is not None: cellcmd = cellcmd + ' %s %s' %(option, value)
+    for addfile, addroot, addresample in addinputs: cellcmd = cellcmd + ' --addinput %s %s %s' %(addfile, addroot, addresample)
+    if skipvalue is not None: cellcmd = cellcmd + ' --skipvalue %s' %(repr(skipvalue))
+    if mosaic: cellcmd = cellcmd + ' --mosaic --overlap %s' %(overlap)
+    if debug: cellcmd = cellcmd + ' --verbose'
+
+    if fusedpyramid:
+        context = getPyramidContext(regions, outfileroot, minresolution, maxresolution, nw, se, resample, excludelist, debug, skipcells)
+        # only missing, failed or stale cells and their ancestors are built again;
+        # the tiles of up-to-date subcells are read from disk
+        topcells = setStaleCells(context, manifest, fingerprint, params)
+        print('%d of %d cells at resolution %d need to be updated' %(len(topcells), len(context['topcells']), minresolution))
+    if parallelism == 'local':
+        if fusedpyramid: pool = createLocalPool(workers, initPyramidWorker, (warperargs, context))
+        elif cmdwarp: pool = createLocalPool(workers)
+        elif multiinput: pool = createLocalPool(workers, initWorkerWarpers, (warperargslist,))
+        elif mosaic: pool = createLocalPool(workers, initMosaicWorker, (warperargs, mosaicindex, mosaicargs))
+        else: pool = createLocalPool(workers, initWorkerWarper, warperargs)
+    elif parallelism != 'slurm' and not cmdwarp:
+        warper = TileWarper(*warperargs)
+        if multiinput: warpers = [warper] + [TileWarper(*layerargs) for layerargs in warperargslist[1:]]
+        if mosaic: mosaicwarper = MosaicWarper(mosaicindex, *mosaicargs)
+
+    if fusedpyramid:
+        # depth-first walk over the cell tree; parents are aggregated in memory from their subcells
+        if parallelism == 'local':
+            # the subtrees of a resolution with enough cells for all workers are built in parallel,
+            # the few levels above are aggregated from their tiles in the driver
+            splitres, splitcells = getSplitResolution(context, topcells, workers or multiprocessing.cpu_count())
+            if debug: print('Splitting the pyramid at resolution %d into %d subtrees' %(splitres, len(splitcells)))
+            for cellstr in splitcells:
+                jobs = submitLocalJob(pool, buildPyramidWorker, (cellstr,), jobs)
+            statuses = {}
+            built = {}
+            results = collectLocalJobs(jobs, debug = debug)
+            jobs = []
+            for j in range(len(splitcells)):
+                if results[j] is None:
+                    built[splitcells[j]] = None # failed; recorded as missing and retried in the next run
+                    continue
+                statuses.update(results[j][0])
+                built[splitcells[j]] = results[j][1]
+            if splitres > minresolution:
+                warper = TileWarper(*warperargs)
+                statuses.update(buildFusedPyramid(rddgs, warper, context, topcells, built))
+                warper.close()
+        else:
+            statuses = buildFusedPyramid(rddgs, warper, context, topcells)
+        for cellstr in statuses:
+            recordCell(manifest, cellstr, fingerprint, params, statuses[cellstr])
+        for i in range(maxresolution, minresolution-1, -1):
+            print('Resolution %d: %d tiles created' %(i, len([cellstr for cellstr in statuses
+                                                               if len(cellstr) - 1 == i and statuses[cellstr] == 'done'])))
+    elif dag:
+        # every cell only waits for its own subcells instead of for the whole resolution
+        with timedStage('enumerate') as event:
+            cells, children = buildCellDAG(regions, minresolution, maxresolution, nw, se)
+            event['cells'] = len(cells)
+        tasks = []
+        taskfiles = []
+        taskcells = set()
+        for c in cells:
+            cellstr = str(c)
+            if cellstr in skipcells: continue
+            filepath = os.path.join(outfileroot, getFilePath(c))
+            if len(cellstr) - 1 == maxresolution:
+                if cellstr in excludelist: continue
+                if not needsUpdate(manifest, cellstr, fingerprint, params, filepath): continue
+                subcellfiles = None
+            else:
+                updatedchildren = [child for child in children[cellstr] if child in taskcells]
+                if not updatedchildren:
+                    if not needsUpdate(manifest, cellstr, fingerprint, params, filepath): continue
+                    if not [child for child in children[cellstr] if hasData(manifest, child)]: continue
+                subcellfiles = getSubcellPaths(c, outfileroot)
+            taskcells.add(cellstr)
+            if os.path.exists(filepath): os.remove(filepath) # outdated tile
+            if not os.path.exists(os.path.dirname(filepath)):
+                if debug: print('now will create %s' %(os.path.dirname(filepath)))
+                os.makedirs(os.path.dirname(filepath))
+            if parallelism == 'slurm' or cmdwarp:
+                tasks.append((cellstr, runCommand, ('%s --cell %s' %(cellcmd, cellstr),)))
+            else:
+                tasks.append((cellstr, warpCellWorker, (filepath, getCellBounds(c), subcellfiles)))
+            taskfiles.append(filepath)
+        if parallelism == 'slurm':
+            # one job per subtree (and per cell above the split), see submitDAGSLURM()
+            jobs, celljobs = submitDAGSLURM([cellstr for cellstr, func, taskargs in tasks], children, cellcmd, jobs,
+                                            workers or 100, debug = debug)
+            states = getSLURMjobStates(jobs, debug = debug)
+            for j in range(len(tasks)):
+                recordCell(manifest, tasks[j][0], fingerprint, params,
+                           getTileStatus(taskfiles[j], isJobSuccessful(states.get(celljobs[tasks[j][0]]))))
+            jobs = []
+        else:
+            results = runDAGLocal(pool, tasks, children, debug = debug)
+            for j in range(len(tasks)):
+                result = results.get(tasks[j][0])
+                if result is None: status = 'failed'
+                elif cmdwarp: status = getTileStatus(taskfiles[j], result == 0)
+                else: status = result
+                recordCell(manifest, tasks[j][0], fingerprint, params, status)
+    else:
+        updated = numpy.array([], dtype = numpy.int64) # codes of the cells of the last resolution created again in this run
+        for i in range(maxresolution,minresolution-1,-1): # iterate over resolutions and create grids
+            with timedStage('enumerate', res = i) as event:
+                grid = regions.cells_from_region(i, nw, se, plane=False)
+                event['cells'] = sum([len(row) for row in grid])
+            if not overviews or i == maxresolution:
+                levelcells = [] # (cell, files of all inputs, status) of all tiles of this resolution created in this run
+            levelstart = len(levelcells)
+            cells = [c for row in grid for c in row if str(c) not in skipcells]
+            # file paths of the whole resolution and of all subcells at once, for every input
+            codes = encodeCells(cells)
+            layerpaths = [getFilePaths(codes, layerroot).tolist() for layerfile, layerroot, layerresample, layernodata in layers]
+            if i < maxresolution and not overviews:
+                childcodes = getChildren(codes)
+                layerchildpaths = [getFilePaths(childcodes.ravel(), layerroot).reshape(childcodes.shape).tolist()
+                                   for layerfile, layerroot, layerresample, layernodata in layers]
+                childupdated = numpy.isin(childcodes, updated).any(axis = 1)
+            for k in range(len(cells)):
+                c = cells[k]
+                if debug: print(str(c))
+                filepaths = [paths[k] for paths in layerpaths]
+                filepath = filepaths[0]
+                if debug: print(filepath)
+                for layerpath in filepaths:
+                    if not os.path.exists(os.path.dirname(layerpath)):
+                        if debug: print('now will create %s' %(os.path.dirname(layerpath)))
+                        os.makedirs(os.path.dirname(layerpath))
+                # Extract coordinates needed for tiling
+                vertices = c.vertices()                
+                xmin=vertices[0][0]
+                ymin=vertices[2][1]
+                xmax=vertices[1][0]
+                ymax=vertices[0][1]                 
+                bounds = (xmin, ymin, xmax, ymax)
+                outdated = True in [needsUpdate(manifests[j], str(c), fingerprints[j], paramslist[j], filepaths[j])
+                                    for j in range(len(layers))]
+                if i == maxresolution or overviews:  # grid with highest resolution is created from original data
+                    if str(c) not in excludelist and outdated:
+                        srcfiles = None
+                        if overviews: overview = selectOverview(overviewfactors, pixelsize, bounds, tilesize)
+                        else: overview = None
+                        warpstring = getWarpString(infile, filepath, bounds, s_srs, t_srs, int(dstnodata[0]),
+                                                   tilesize, blocksize, resample, overview, profile)
+                    else: warpstring = False
+                else: #create lower resolution grids from higher ones by resampling
+                    srcfiles = [appendstring for appendstring in layerchildpaths[0][k] if os.path.isfile(appendstring)]
+                    if not childupdated[k] and not outdated:
+                        warpstring = False # neither the tile nor its subcells changed
+                    elif not srcfiles:
+                        warpstring = False
+                        for layerpath in filepaths:
+                            if os.path.exists(layerpath): os.remove(layerpath) # outdated tile
+                        levelcells.append([str(c), filepaths, 'empty'])
+                    else:
+                        warpstring = getWarpString(' '.join(srcfiles), filepath, bounds, t_srs, t_srs, dstnodata[0],
+                                                   tilesize, blocksize, resample, profile = profile)
+                if debug: print(warpstring)
+                if warpstring: 
+                    for layerpath in filepaths:
+                        if os.path.exists(layerpath):
+                            with timedStage('delete', str(c)):
+                                os.remove(layerpath) # outdated tile
+                    levelcells.append([str(c), filepaths, None])
+                    if multiinput:
+                        # every input is warped from its own subcell tiles
+                        if srcfiles is None: subcellfiles = None
+                        else: subcellfiles = [childpaths[k] for childpaths in layerchildpaths]
+                    if  parallelism == 'slurm':
+                        if multiinput or mosaic: commands.append('%s --cell %s' %(cellcmd, str(c)))
+                        else: commands.append(warpstring)
+                    elif parallelism == 'local':
+                        if cmdwarp: jobs = submitLocalJob(pool, runCommand, (warpstring,), jobs)
+                        elif multiinput: jobs = submitLocalJob(pool, warpCellInputsWorker, (filepaths, bounds, subcellfiles, skipvalue), jobs)
+                        elif mosaic and srcfiles is None: jobs = submitLocalJob(pool, warpMosaicCellWorker, (filepath, bounds), jobs)
+                        else: jobs = submitLocalJob(pool, warpCellWorker, (filepath, bounds, srcfiles), jobs)
+                    elif cmdwarp:
+                        with timedStage('warp', str(c)):
+                            levelcells[-1][2] = (os.system(warpstring) == 0)
+                    elif multiinput: levelcells[-1][2] = warpCellInputs(warpers, filepaths, bounds, subcellfiles, skipvalue)
+                    elif mosaic and srcfiles is None: levelcells[-1][2] = warpMosaicCell(mosaicwarper, filepath, bounds)
+                    else: levelcells[-1][2] = warpCell(warper, filepath, bounds, srcfiles)
+
+            if overviews and i > minresolution:
+                # no resolution waits for another one; all tiles are collected after the last
+                print('Resolution %d: %d tiles queued' %(i, len(levelcells) - levelstart))
+                continue
+            if parallelism == 'slurm':
+                jobs = submitSLURMjobArray(commands, jobs, bundlesize, debug = debug)
+                commands = []
+                states = getSLURMjobStates(jobs, debug = debug) # check if all tiles are created and only afterwards go on
+                # the commands were queued in the order of the pending cells; every cell
+                # gets the state of the array task that ran its bundle
+                pending = [cellinfo for cellinfo in levelcells if cellinfo[2] is None]
+                if jobs:
+                    taskstates = getCommandStates(jobs[0], states.get(jobs[0]), len(pending), bundlesize)
+                    for j in range(len(pending)):
+                        pending[j][2] = isJobSuccessful(taskstates[j])
+                jobs = []
+            if parallelism == 'local':
+                results = collectLocalJobs(jobs, debug = debug)
+                jobs = []
+                pending = [cellinfo for cellinfo in levelcells if cellinfo[2] is None]
+                for j in range(len(pending)):
+                    if results[j] is None: pending[j][2] = 'failed'
+                    elif cmdwarp: pending[j][2] = (results[j] == 0)
+                    else: pending[j][2] = results[j]
+            # check if empty files were created; in-process warping never writes empty tiles
+            if (parallelism == 'slurm' and not (multiinput or mosaic)) or cmdwarp:
+                for cellstr, filepaths, status in levelcells:
+                    filepath = filepaths[0]
+                    if status is False: continue # incomplete tiles of failed commands are deleted below
+                    if os.path.exists(filepath):
+                        with timedStage('emptycheck', cellstr) as event:
+                            empty = isEmpty(filepath)
+                            event['status'] = 'empty' if empty else 'done'
+                        if empty:
+                            with timedStage('delete', cellstr):
+                                os.remove(filepath) # delete empty output files
+            for cellstr, filepaths, status in levelcells:
+                for j in range(len(layers)):
+                    if isinstance(status, list): layerstatus = status[j] # result of warpCellInputs()
+                    else: layerstatus = status
+                    if layerstatus is True or layerstatus is False: # result of an external command
+                        layerstatus = getTileStatus(filepaths[j], layerstatus)
+                    recordCell(manifests[j], cellstr, fingerprints[j], paramslist[j], layerstatus)
+            updated = encodeCells([cellinfo[0] for cellinfo in levelcells])
+            for j in range(len(layers)):
+                saveManifest(layers[j][1], manifests[j])
+            print('Resolution %d: %d tiles updated' %(i, len(levelcells) - levelstart))
+    if parallelism == 'local':
+        pool.close()
+        pool.join()
+    elif parallelism != 'slurm' and not cmdwarp:
+        warper.close()
+        if multiinput:
+            for layerwarper in warpers[1:]: layerwarper.close()
+        if mosaic: mosaicwarper.close()
+    for j in range(len(layers)):
+        saveManifest(layers[j][1], manifests[j])
+    if stats:
+        for layerfile, layerroot, layerresample, layernodata in layers:
+            for root, dirs, files in os.walk(layerroot):
+                for filename in files:
+                    if filename.endswith('.kea'): computeStatistics(os.path.join(root, filename))
+    elapsed = time.time() - start
+    logEvent('total', seconds = elapsed, minres = minresolution, maxres = maxresolution)
+    print('Elapsed time: %g seconds' %(elapsed))
+
+
+
+
+
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Extracts per-pixel time series from a data cube created by stacklayers.py.
+Only the cells, bands and blocks covering the requested points or bounding
+box are read; opened stacks are cached between queries
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import numpy
+import fnmatch
+import argparse
+import collections
+
+import osgeo.gdal as gdal
+from osgeo import osr
+from gdalconst import *
+
+from data_utils import *
+from zarr_utils import *
+
+
+def splitBandName(description):
+    ''' Split the description of a stacked band into (layer, band), see
+    stacktile.setBandNames() '''
+    parts = description.split(' ', 1)
+    if len(parts) == 1: parts.append('')
+    return parts[0], parts[1]
+
+
+class CubeReader(object):
+    """
+    Read access to the stacks of a data cube (KEA, VRT or Zarr). Up to maxopen
+    stacks are kept open; the least recently used one is closed first.
+    """
+
+    def __init__(self, cubedir, maxopen = 64, debug = False):
+        self.cubedir = cubedir
+        self.maxopen = maxopen
+        self.debug = debug
+        self.rddgs = getStandardDGGS()
+        self.cache = collections.OrderedDict() # cell name: stack, see openStack()
+        self.opened = 0
+
+    def openStack(self, cellstr):
+        ''' Return the stack of a cell as dictionary with the keys 'kind'
+        ('gdal' or 'zarr'), 'data', 'geotransform', 'size', 'bands'
+        (list of (layer, band) tuples) and 'nodata' (value of every band or
+        None); None if the cell was not stacked '''
+        if cellstr in self.cache:
+            self.cache.move_to_end(cellstr)
+            return self.cache[cellstr]
+        stack = None
+        filepath = os.path.join(self.cubedir, getFilePath(cellstr))
+        for candidate in [filepath, filepath[:-len('.kea')] + '.vrt']:
+            if os.path.exists(candidate):
+                ds = gdal.Open(candidate, GA_ReadOnly)
+                if ds is None: continue
+                bands = [splitBandName(ds.GetRasterBand(b).GetDescription()) for b in range(1, ds.RasterCount+1)]
+                nodata = [ds.GetRasterBand(b).GetNoDataValue() for b in range(1, ds.RasterCount+1)]
+                stack = {'kind': 'gdal', 'data': ds, 'geotransform': ds.GetGeoTransform(),
+                         'size': (ds.RasterYSize, ds.RasterXSize), 'bands': bands, 'nodata': nodata}
+                break
+        arraypath = getZarrPath(self.cubedir, cellstr)
+        if stack is None and zarr is not None and os.path.isdir(arraypath):
+            array, names = readZarrStack(arraypath)
+            nodata = list(array.attrs.get('nodata', [None] * len(names)))
+            stack = {'kind': 'zarr', 'data': array, 'geotransform': tuple(array.attrs['geotransform']),
+                     'size': tuple(array.shape[1:]), 'bands': [splitBandName(name) for name in names],
+                     'nodata': nodata}
+        if stack is None:
+            return None
+        self.opened += 1
+        self.cache[cellstr] = stack
+        if len(self.cache) > self.maxopen:
+            self.cache.popitem(last = False)
+        return stack
+
+    def readPixels(self, cellstr, rows, cols, bandindices):
+        ''' Read the values of the given pixels of a cell for the given bands
+        (0-based); returns an array of shape (bands, pixels) or None '''
+        stack = self.openStack(cellstr)
+        if stack is None:
+            return None
+        rows = numpy.asarray(rows)
+        cols = numpy.asarray(cols)
+        r0, r1 = rows.min(), rows.max() + 1
+        c0, c1 = cols.min(), cols.max() + 1
+        # one window read if the pixels are dense, otherwise pixel by pixel
+        dense = (r1 - r0) * (c1 - c0) <= 16 * len(rows)
+        values = numpy.empty((len(bandindices), len(rows)))
+        for k in range(len(bandindices)):
+            b = bandindices[k]
+            if stack['kind'] == 'zarr':
+                if dense:
+                    window = stack['data'][b, r0:r1, c0:c1]
+                    values[k] = window[rows - r0, cols - c0]
+                else:
+                    values[k] = stack['data'].get_coordinate_selection((numpy.full(len(rows), b), rows, cols))
+            else:
+                band = stack['data'].GetRasterBand(b+1)
+                if dense:
+                    window = band.ReadAsArray(int(c0), int(r0), int(c1 - c0), int(r1 - r0))
+                    values[k] = window[rows - r0, cols - c0]
+                else:
+                    for p in range(len(rows)):
+                        values[k, p] = band.ReadAsArray(int(cols[p]), int(rows[p]), 1, 1)[0, 0]
+        return values
+
+    def close(self):
+        self.cache.clear()
+
+
+def getPlaneCoords(lonlats):
+    ''' Project (lon, lat) coordinates into the rHEALPix plane; returns an
+    array of shape (n, 2) '''
+    transform = osr.CoordinateTransformation(getSpatialReference('EPSG:4326'),
+                                             getSpatialReference(getStandardProj4()))
+    return numpy.array([transform.TransformPoint(float(lon), float(lat))[:2] for lon, lat in lonlats])
+
+
+def locatePixels(reader, res, xy):
+    ''' Return cell, row and column of the pixel covering every plane point
+    at resolution res; points outside the cube get cell None '''
+    located = []
+    for x, y in xy:
+        c = reader.rddgs.cell_from_point(res, (x, y), plane = True)
+        if c is None:
+            located.append((None, -1, -1))
+            continue
+        stack = reader.openStack(str(c))
+        if stack is None:
+            located.append((str(c), -1, -1))
+            continue
+        gt = stack['geotransform']
+        col = int((x - gt[0]) / gt[1])
+        row = int((y - gt[3]) / gt[5])
+        row = min(max(row, 0), stack['size'][0] - 1)
+        col = min(max(col, 0), stack['size'][1] - 1)
+        located.append((str(c), row, col))
+    return located
+
+
+def getBBoxPixels(reader, res, bbox):
+    ''' Return the cell, row and column of all pixels whose centres lie within a
+    lon/lat bounding box (west, south, east, north) at resolution res '''
+    west, south, east, north = bbox
+    nw = [west, north]
+    se = [east, south]
+    tolonlat = osr.CoordinateTransformation(getSpatialReference(getStandardProj4()),
+                                            getSpatialReference('EPSG:4326'))
+    # outline of the box in the plane, densified to follow the projection
+    n = 16
+    outline = [(west + (east - west) * t / n, south) for t in range(n+1)] + \
+              [(west + (east - west) * t / n, north) for t in range(n+1)] + \
+              [(west, south + (north - south) * t / n) for t in range(n+1)] + \
+              [(east, south + (north - south) * t / n) for t in range(n+1)]
+    xy = getPlaneCoords(outline)
+    xmin, ymin = xy.min(axis = 0)
+    xmax, ymax = xy.max(axis = 0)
+    located = []
+    for row in reader.rddgs.cells_from_region(res, nw, se, plane = False):
+        for c in row:
+            stack = reader.openStack(str(c))
+            if stack is None: continue
+            gt = stack['geotransform']
+            ysize, xsize = stack['size']
+            c0 = max(0, int((xmin - gt[0]) / gt[1]))
+            c1 = min(xsize, int((xmax - gt[0]) / gt[1]) + 1)
+            r0 = max(0, int((ymax - gt[3]) / gt[5]))
+            r1 = min(ysize, int((ymin - gt[3]) / gt[5]) + 1)
+            if c0 >= c1 or r0 >= r1: continue
+            rows, cols = numpy.mgrid[r0:r1, c0:c1]
+            rows = rows.ravel()
+            cols = cols.ravel()
+            px = gt[0] + (cols + 0.5) * gt[1]
+            py = gt[3] + (rows + 0.5) * gt[5]
+            lonlat = numpy.array(tolonlat.TransformPoints(numpy.column_stack((px, py)).tolist()))[:, :2]
+            inside = (lonlat[:, 0] >= west) & (lonlat[:, 0] <= east) & (lonlat[:, 1] >= south) & (lonlat[:, 1] <= north)
+            for r, k in zip(rows[inside], cols[inside]):
+                located.append((str(c), int(r), int(k)))
+    return located
+
+
+def extractTimeSeries(reader, located, bandfilter = '*', layerfilter = '*'):
+    ''' Read the time series of located pixels
+
+        @type reader:     C{CubeReader}
+        @param reader:    open data cube
+        @type located:    C{list}
+        @param located:   (cell, row, column) of every pixel, see locatePixels() and getBBoxPixels()
+        @type bandfilter: C{str}
+        @param bandfilter: shell pattern the band names have to match
+        @type layerfilter: C{str}
+        @param layerfilter: shell pattern the layer names have to match
+        @rtype:           C{tuple}
+        @return:          (values, layers, bands): array of shape (layers, bands, pixels),
+                          nan where the stack of a pixel has no such band or the
+                          pixel holds the nodata value of the band, and the
+                          layer and band names of the first two axes
+    '''
+    bycell = collections.OrderedDict()
+    for p in range(len(located)):
+        cellstr, row, col = located[p]
+        if cellstr is None or row < 0: continue
+        if cellstr not in bycell: bycell[cellstr] = []
+        bycell[cellstr].append((p, row, col))
+    # all layers and bands that match the filters in any of the cells
+    layers = []
+    bands = []
+    for cellstr in bycell:
+        for layer, band in reader.openStack(cellstr)['bands']:
+            if not fnmatch.fnmatch(layer, layerfilter) or not fnmatch.fnmatch(band, bandfilter): continue
+            if layer not in layers: layers.append(layer)
+            if band not in bands: bands.append(band)
+    layers.sort()
+    bands.sort()
+    values = numpy.full((len(layers), len(bands), len(located)), numpy.nan)
+    for cellstr in bycell:
+        stack = reader.openStack(cellstr)
+        stackbands = stack['bands']
+        selected = [b for b in range(len(stackbands))
+                    if stackbands[b][0] in layers and stackbands[b][1] in bands]
+        if not selected: continue
+        pixels = bycell[cellstr]
+        cellvalues = reader.readPixels(cellstr, [row for p, row, col in pixels], [col for p, row, col in pixels], selected)
+        indices = [p for p, row, col in pixels]
+        for k in range(len(selected)):
+            layer, band = stackbands[selected[k]]
+            nodata = stack['nodata'][selected[k]]
+            if nodata is not None: cellvalues[k][cellvalues[k] == nodata] = numpy.nan
+            values[layers.index(layer), bands.index(band), indices] = cellvalues[k]
+    return values, layers, bands
+
+
+if __name__ == '__main__':
+    start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cubedir", type = str, help="Specify the data cube directory.")
+    parser.add_argument("res", type = int, help="Specify the grid resolution.")
+    parser.add_argument("-p", "--point", action = "append", help="lon,lat of a point; can be given several times")
+    parser.add_argument("-x", "--bbox", help="west,south,east,north of a bounding box in lat/long")
+    parser.add_argument("-b", "--bands", help="Shell pattern of the band names (default: *)")
+    parser.add_argument("-l", "--layers", help="Shell pattern of the layer names (default: *)")
+    parser.add_argument("-o", "--outfile", help="Write the time series to a .npz file")
+    parser.add_argument("-v", "--verbose", help="Show debug messages (default: False).", action ="store_true")
+
+    args = parser.parse_args()
+
+    if not args.point and not args.bbox:
+        print("Error: no point or bounding box specified")
+        sys.exit()
+
+    if args.bands:
+        bandfilter = args.bands
+    else:
+        bandfilter = '*'
+
+    if args.layers:
+        layerfilter = args.layers
+    else:
+        layerfilter = '*'
+
+    if args.verbose:
+        debug = True
+    else:
+        debug = False
+
+    reader = CubeReader(args.cubedir, debug = debug)
+    located = []
+    if args.point:
+        lonlats = [[float(v) for v in point.split(',')] for point in args.point]
+        located = located + locatePixels(reader, args.res, getPlaneCoords(lonlats))
+    if args.bbox:
+        located = located + getBBoxPixels(reader, args.res, [float(v) for v in args.bbox.split(',')])
+    values, layers, bands = extractTimeSeries(reader, located, bandfilter, layerfilter)
+    print('%d layers, %d bands, %d pixels from %d stacks' %(len(layers), len(bands), len(located), reader.opened))
+    if debug:
+        for p in range(len(located)):
+            print(located[p], values[:, :, p].tolist())
+    if args.outfile:
+        numpy.savez(args.outfile, values = values, layers = numpy.array(layers), bands = numpy.array(bands),
+                    cells = numpy.array([str(cellstr) for cellstr, row, col in located]),
+                    rows = numpy.array([row for cellstr, row, col in located]),
+                    cols = numpy.array([col for cellstr, row, col in located]))
+    reader.close()
+
+    elapsed = time.time() - start
+    print('Elapsed time (timeseries): %g seconds' %(elapsed))
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+"""
+Warping tools for reprojecting raster data into rHEALPix tiles, either in-process
+using the GDAL API or by building gdalwarp command strings
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import numpy
+
+from osgeo import gdal, osr
+from gdalconst import *
+
+from data_utils import *
+from instrument_utils import *
+
+
+# warp performance profiles, see getWarpProfile():
+# errorthreshold: maximum error in pixels of the approximate transformer (-et, 0 = exact)
+# warpmemory:     memory of a warp chunk in MB (-wm)
+# threads:        number of warping threads or ALL_CPUS (-multi -wo NUM_THREADS)
+# cachemax:       GDAL block cache for source and destination blocks in MB (GDAL_CACHEMAX)
+# samplesteps:    points per edge used to find the source window; also sets SAMPLE_GRID=YES,
+#                 which global (EPSG:4326) inputs need near the poles and the antimeridian
+# None keeps the GDAL default, so 'default' is identical to plain gdalwarp
+WARP_PROFILES = {
+    'default': {'errorthreshold': None, 'warpmemory': None, 'threads': None, 'cachemax': None, 'samplesteps': None},
+    'exact': {'errorthreshold': 0., 'warpmemory': None, 'threads': None, 'cachemax': None, 'samplesteps': None},
+    'fast': {'errorthreshold': 0.5, 'warpmemory': 512, 'threads': 'ALL_CPUS', 'cachemax': 512, 'samplesteps': None},
+    'global': {'errorthreshold': 0.125, 'warpmemory': 256, 'threads': None, 'cachemax': 256, 'samplesteps': 168},
+}
+
+# overview resampling methods of gdaladdo for the gdalwarp methods; gdalwarp-only
+# methods (statistics of the source pixels) fall back to the closest overview method
+OVERVIEW_RESAMPLING = {'near': 'NEAREST', 'bilinear': 'BILINEAR', 'cubic': 'CUBIC', 'cubicspline': 'CUBICSPLINE',
+                       'lanczos': 'LANCZOS', 'average': 'AVERAGE', 'rms': 'RMS', 'mode': 'MODE'}
+OVERVIEW_FALLBACKS = {'max': 'NEAREST', 'min': 'NEAREST', 'med': 'NEAREST', 'q1': 'NEAREST', 'q3': 'NEAREST',
+                      'sum': 'AVERAGE'}
+# metadata item that records the resampling method the overviews were built with
+OVERVIEW_METADATA = 'SCENZGRID_OVERVIEW_RESAMPLING'
+
+
+def getWarpProfile(name = 'default', **overrides):
+    ''' Return the settings of a warp performance profile, see WARP_PROFILES.
+    Settings given as keyword arguments replace those of the profile unless
+    they are None. '''
+    if name not in WARP_PROFILES:
+        raise ValueError('Unknown warp profile: %s' %(name))
+    profile = dict(WARP_PROFILES[name])
+    for key in overrides:
+        if key not in profile:
+            raise ValueError('Unknown warp profile setting: %s' %(key))
+        if overrides[key] is not None: profile[key] = overrides[key]
+    return profile
+
+
+def getProfileOptions(profile):
+    ''' Return the gdalwarp options of a warp performance profile '''
+    options = []
+    if not profile:
+        return options
+    if profile.get('errorthreshold') is not None: options += ['-et', repr(float(profile['errorthreshold']))]
+    if profile.get('warpmemory') is not None: options += ['-wm', str(profile['warpmemory'])]
+    if profile.get('threads') is not None: options += ['-multi', '-wo', 'NUM_THREADS=%s' %(profile['threads'])]
+    if profile.get('samplesteps') is not None:
+        options += ['-wo', 'SAMPLE_GRID=YES', '-wo', 'SAMPLE_STEPS=%d' %(profile['samplesteps'])]
+    return options
+
+
+def applyCacheMax(profile):
+    ''' Set the GDAL block cache of this process to the size of a warp
+    performance profile, if it defines one '''
+    if profile and profile.get('cachemax') is not None:
+        gdal.SetCacheMax(int(profile['cachemax']) * 1024 * 1024)
+
+
+def getWarpString(srcfiles, filepath, bounds, s_srs, t_srs, dstnodata, tilesize = 729,
+                  blocksize = 243, resample = 'cubic', overview = None, profile = None):
+    ''' Return the gdalwarp command string that creates a single tile
+
+        @type srcfiles:   C{str}
+        @param srcfiles:  space separated list of input files
+        @type filepath:   C{str}
+        @param filepath:  output tile
+        @type bounds:     C{tuple/list}
+        @param bounds:    (xmin, ymin, xmax, ymax) of the tile in target coordinates
+        @type overview:   C{int/str}
+        @param overview:  overview level of the input to warp from or 'NONE' for
+                          full resolution, see selectOverview(); gdalwarp decides if None
+        @type profile:    C{dict}
+        @param profile:   warp performance profile, see getWarpProfile()
+        @rtype:           C{str}
+        @return:          gdalwarp command string
+    '''
+    warpstring = 'gdalwarp -dstnodata %s -s_srs \'%s\' -t_srs \'%s\' -te %f %f %f %f -ts %d %d -r %s -co IMAGEBLOCKSIZE=%d -of kea' \
+        %(dstnodata, s_srs, t_srs, bounds[0], bounds[1], bounds[2], bounds[3], tilesize, tilesize,
+          resample, blocksize)
+    if overview is not None: warpstring = warpstring + ' -ovr %s' %(overview)
+    if profile:
+        warpstring = ' '.join([warpstring] + getProfileOptions(profile))
+        if profile.get('cachemax') is not None:
+            warpstring = warpstring + ' --config GDAL_CACHEMAX %d' %(profile['cachemax'])
+    return '%s %s %s' %(warpstring, srcfiles, filepath)
+
+
+def getOverviewFactors(src_ds):
+    ''' Return the reduction factors of the existing overviews of a raster
+    dataset (of its first band), from fine to coarse '''
+    band = src_ds.GetRasterBand(1)
+    return [src_ds.RasterXSize / float(band.GetOverview(k).XSize) for k in range(band.GetOverviewCount())]
+
+
+def getOverviewResampling(resample):
+    ''' Return the overview resampling method for a gdalwarp resampling method,
+    see OVERVIEW_RESAMPLING and OVERVIEW_FALLBACKS '''
+    if resample in OVERVIEW_RESAMPLING:
+        return OVERVIEW_RESAMPLING[resample]
+    fallback = OVERVIEW_FALLBACKS.get(resample, 'NEAREST')
+    print('Warning: overviews can not be built with resampling method %s. Using %s' %(resample, fallback))
+    return fallback
+
+
+def buildOverviews(infile, resample = 'cubic', tilesize = 729, debug = False):
+    ''' Build internal overviews of a raster file unless it already has some
+    that were built with the same resampling method (recorded in the metadata
+    item OVERVIEW_METADATA); overviews of unknown origin are built again.
+    The factors are powers of 3, like the cell sizes of successive rHEALPix
+    resolutions, down to about the size of a single tile.
+
+        @type infile:   C{str}
+        @param infile:  raster file, e.g. KEA or GeoTIFF
+        @type resample: C{str}
+        @param resample: resampling method of gdalwarp, used for the overviews as well
+                         (see getOverviewResampling())
+        @rtype:         C{list}
+        @return:        reduction factors of the overviews
+    '''
+    src_ds = gdal.Open(infile, GA_ReadOnly)
+    if src_ds is None:
+        raise IOError('Could not open the input image file: %s' %(infile))
+    method = getOverviewResampling(resample)
+    factors = getOverviewFactors(src_ds)
+    if factors:
+        built = src_ds.GetMetadataItem(OVERVIEW_METADATA)
+        if built == method:
+            if debug: print('Reusing overviews of %s: %s' %(infile, factors))
+            return factors
+        print('Overviews of %s were built with %s instead of %s. Building them again' %(infile, built or 'an unknown method', method))
+    existing = bool(factors)
+    factors = []
+    factor = 3
+    while max(src_ds.RasterXSize, src_ds.RasterYSize) / float(factor) >= tilesize:
+        factors.append(factor)
+        factor *= 3
+    src_ds = None
+    if not factors and not existing:
+        return []
+    # internal overviews if the file can be updated, otherwise an external .ovr file
+    src_ds = gdal.Open(infile, GA_Update)
+    if src_ds is None: src_ds = gdal.Open(infile, GA_ReadOnly)
+    if existing:
+        src_ds.BuildOverviews('NONE', []) # remove them where the format allows it, otherwise they are overwritten
+    if not factors:
+        factors = getOverviewFactors(src_ds) # left over if they could not be removed
+        src_ds = None
+        return factors
+    print('Building overviews of %s: %s' %(infile, factors))
+    if src_ds.BuildOverviews(method, factors) != 0:
+        raise IOError('Could not build the overviews of %s' %(infile))
+    src_ds.SetMetadataItem(OVERVIEW_METADATA, method) # in a .aux.xml file for read-only files
+    factors = getOverviewFactors(src_ds)
+    src_ds = None
+    return factors
+
+
+def getGroundPixelSize(src_ds):
+    ''' Return the pixel size of a raster dataset in metres; degrees of
+    geographic coordinates are converted at the equator '''
+    gt = src_ds.GetGeoTransform()
+    pixelsize = max(abs(gt[1]), abs(gt[5]))
+    sr = osr.SpatialReference()
+    sr.ImportFromWkt(src_ds.GetProjection())
+    if sr.IsGeographic():
+        return pixelsize * sr.GetSemiMajor() * numpy.pi / 180.
+    if sr.IsProjected():
+        return pixelsize * sr.GetLinearUnits()
+    return pixelsize
+
+
+def selectOverview(factors, pixelsize, bounds, tilesize = 729):
+    ''' Return the overview level whose ground resolution best matches the
+    pixels of a tile: the coarsest one that is not coarser than the tile, or
+    'NONE' for the full resolution (see the -ovr option of gdalwarp)
+
+        @type factors:    C{list}
+        @param factors:   reduction factors of the overviews, see getOverviewFactors()
+        @type pixelsize:  C{float}
+        @param pixelsize: pixel size of the full resolution in metres, see getGroundPixelSize()
+        @type bounds:     C{tuple/list}
+        @param bounds:    (xmin, ymin, xmax, ymax) of the tile in rHEALPix plane coordinates
+    '''
+    tilepixelsize = (bounds[2] - bounds[0]) / float(tilesize)
+    level = 'NONE'
+    for k in range(len(factors)):
+        if pixelsize * factors[k] <= tilepixelsize * 1.001: level = k
+    return level
+
+
+class TileWarper(object):
+    """
+    In-process replacement for the gdalwarp calls of tilerasterlayer.py.
+    The source dataset is opened and the spatial references are parsed only
+    once; every tile is then warped into memory (warpDataset(), warpArray())
+    and only written if it contains valid data (writeDataset(), writeTile()).
+    """
+
+    def __init__(self, infile, s_srs, t_srs, dstnodata, tilesize = 729, blocksize = 243,
+                 resample = 'cubic', debug = False, overviews = False, profile = None):
+        self.infile = infile
+        self.src_ds = gdal.Open(infile, GA_ReadOnly)
+        if self.src_ds is None:
+            raise IOError('Could not open the input image file: %s' %(infile))
+        self.s_srs = self._toWkt(s_srs)
+        self.t_srs = self._toWkt(t_srs)
+        self.dstnodata = dstnodata
+        self.tilesize = tilesize
+        self.blocksize = blocksize
+        self.resample = resample
+        self.debug = debug
+        # options that are identical for all tiles; only -te changes per tile
+        self.baseoptions = ['-ts', str(tilesize), str(tilesize),
+                            '-r', resample, '-dstnodata', str(dstnodata)] + getProfileOptions(profile)
+        self.profile = profile
+        applyCacheMax(profile)
+        self.fileoptions = ['-of', 'KEA', '-co', 'IMAGEBLOCKSIZE=%d' %(blocksize)]
+        self.dstwkt = None
+        self.datatype = self.src_ds.GetRasterBand(1).DataType
+        self.bandnames = [self.src_ds.GetRasterBand(b).GetDescription()
+                          for b in range(1, self.src_ds.RasterCount+1)]
+        # tiles of every resolution are warped from the best matching overview, see selectOverview()
+        self.overviews = overviews
+        if overviews:
+            self.factors = getOverviewFactors(self.src_ds)
+            self.pixelsize = getGroundPixelSize(self.src_ds)
+
+    def _toWkt(self, srs):
+        ''' Parse a user supplied SRS definition once and return it as WKT.
+        Falls back to the original definition if it can not be expressed as WKT
+        (e.g. older PROJ versions and the rhealpix projection) '''
+        sr = osr.SpatialReference()
+        if sr.SetFromUserInput(srs) != 0:
+            return srs
+        wkt = sr.ExportToWkt()
+        if not wkt:
+            return srs
+        return wkt
+
+    def getOptions(self, bounds, s_srs = None, memory = False):
+        ''' Return gdal.WarpOptions for a tile with the given bounds '''
+        fromsource = s_srs is None # not warped from tiles
+        if s_srs is None: s_srs = self.s_srs
+        if memory: fileoptions = ['-of', 'MEM']
+        else: fileoptions = self.fileoptions
+        options = self.baseoptions + fileoptions + ['-s_srs', s_srs, '-t_srs', self.t_srs,
+                                      '-te', repr(bounds[0]), repr(bounds[1]),
+                                      repr(bounds[2]), repr(bounds[3])]
+        if self.overviews and fromsource:
+            options = options + ['-ovr', str(self.getOverview(bounds))]
+        return gdal.WarpOptions(options = options)
+
+    def getOverview(self, bounds):
+        ''' Return the overview level the tile with the given bounds is warped from '''
+        return selectOverview(self.factors, self.pixelsize, bounds, self.tilesize)
+
+    def warpDataset(self, bounds, srcfiles = None):
+        ''' Warp the source dataset (or a list of already tiled files) into an
+        in-memory dataset of a single tile; None if warping failed '''
+        if srcfiles:
+            dst_ds = gdal.Warp('', srcfiles, options = self.getOptions(bounds, s_srs = self.t_srs, memory = True))
+        else:
+            dst_ds = gdal.Warp('', self.src_ds, options = self.getOptions(bounds, memory = True))
+        if dst_ds is None:
+            print('Warping failed for tile %s' %(str(bounds)))
+            return None
+        if self.dstwkt is None: self.dstwkt = dst_ds.GetProjection()
+        return dst_ds
+
+    def writeDataset(self, filepath, mem_ds):
+        ''' Write an in-memory tile as KEA file '''
+        dst_ds = gdal.GetDriverByName('KEA').CreateCopy(filepath, mem_ds, 0,
+                                                        ['IMAGEBLOCKSIZE=%d' %(self.blocksize)])
+        if dst_ds is None:
+            print('Could not create the output image file: %s' %(filepath))
+            return False
+        dst_ds = None
+        return True
+
+    def warpArray(self, bounds):
+        ''' Warp the source dataset into an in-memory tile
+
+            @type bounds:     C{tuple/list}
+            @param bounds:    (xmin, ymin, xmax, ymax) of the tile in target coordinates
+            @rtype:           C{numpy.ndarray}
+            @return:          array of shape (bands, tilesize, tilesize) or None
+        '''
+        dst_ds = self.warpDataset(bounds)
+        if dst_ds is None:
+            return None
+        array = dst_ds.ReadAsArray()
+        dst_ds = None
+        if array.ndim == 2: array = array[numpy.newaxis, :, :]
+        return array
+
+    def writeTile(self, filepath, array, bounds):
+        ''' Write an in-memory tile of shape (bands, tilesize, tilesize) as KEA file '''
+        driver = gdal.GetDriverByName('KEA')
+        bands, ysize, xsize = array.shape
+        dst_ds = driver.Create(filepath, xsize, ysize, bands, self.datatype,
+                               ['IMAGEBLOCKSIZE=%d' %(self.blocksize)])
+        if dst_ds is None:
+            print('Could not create the output image file: %s' %(filepath))
+            return False
+        dst_ds.SetGeoTransform((bounds[0], (bounds[2] - bounds[0]) / float(xsize), 0,
+                                bounds[3], 0, -(bounds[3] - bounds[1]) / float(ysize)))
+        if self.dstwkt is None:
+            sr = osr.SpatialReference()
+            sr.SetFromUserInput(self.t_srs)
+            self.dstwkt = sr.ExportToWkt()
+        dst_ds.SetProjection(self.dstwkt)
+        for b in range(bands):
+            band = dst_ds.GetRasterBand(b+1)
+            band.SetNoDataValue(self.dstnodata)
+            if b < len(self.bandnames): band.SetDescription(self.bandnames[b])
+            band.WriteArray(array[b])
+        dst_ds = None
+        return True
+
+    def readTile(self, filepath):
+        ''' Read an existing tile into an array of shape (bands, tilesize, tilesize);
+        None if it can not be read '''
+        src_ds = gdal.Open(filepath, GA_ReadOnly)
+        if src_ds is None:
+            return None
+        array = src_ds.ReadAsArray()
+        src_ds = None
+        if array.ndim == 2: array = array[numpy.newaxis, :, :]
+        return array
+
+    def close(self):
+        self.src_ds = None
+
+
+def warpCell(warper, filepath, bounds, subcellfiles = None):
+    ''' Create the tile of a single cell. The tile is warped in memory and only
+    written if it contains valid data. Tiles of lower resolutions are warped from
+    those of subcellfiles that exist at the time of the call.
+
+        @type warper:       C{TileWarper}
+        @param warper:      warping engine
+        @type filepath:     C{str}
+        @param filepath:    output tile
+        @type bounds:       C{tuple/list}
+        @param bounds:      (xmin, ymin, xmax, ymax) of the tile in target coordinates
+        @type subcellfiles: C{list}
+        @param subcellfiles: candidate tiles of the subcells; None at maxres
+        @rtype:             C{str}
+        @return:            'done', 'empty' or 'failed'
+    '''
+    cellstr = getCellFromTilePath(filepath)
+    srcfiles = None
+    if subcellfiles is not None:
+        srcfiles = [f for f in subcellfiles if os.path.isfile(f)]
+        if not srcfiles:
+            logEvent('warp', cellstr, 0.0, status = 'empty', inputs = 0)
+            return 'empty'
+    with timedStage('warp', cellstr) as event:
+        mem_ds = warper.warpDataset(bounds, srcfiles)
+        if srcfiles is not None:
+            event['inputs'] = len(srcfiles)
+            event['bytesread'] = getFileSize(srcfiles)
+        elif warper.overviews:
+            event['overview'] = warper.getOverview(bounds)
+        event['status'] = 'done' if mem_ds is not None else 'failed'
+    if mem_ds is None:
+        return 'failed'
+    with timedStage('emptycheck', cellstr) as event:
+        empty = isEmptyDataset(mem_ds)
+        event['status'] = 'empty' if empty else 'done'
+    if empty:
+        if warper.debug: print('Empty tile detected: %s' %(filepath))
+        return 'empty'
+    with timedStage('write', cellstr) as event:
+        written = warper.writeDataset(filepath, mem_ds)
+        event['status'] = 'done' if written else 'failed'
+        if written: event['byteswritten'] = getFileSize(filepath)
+    if not written:
+        return 'failed'
+    return 'done'
+
+def isSkipDataset(src_ds, skipvalue):
+    ''' Returns True if the valid pixels of an open raster dataset all have
+    the value skipvalue, e.g. a fully cloudy tile of a cloud mask '''
+    for b in range(1, src_ds.RasterCount+1):
+        band = src_ds.GetRasterBand(b)
+        array = band.ReadAsArray()
+        valid = getValidMask(array, band.GetNoDataValue())
+        if numpy.any(array[valid] != skipvalue):
+            return False
+    return True
+
+
+def warpCellInputs(warpers, filepaths, bounds, subcellfiles = None, skipvalue = None):
+    ''' Create the tiles of a single cell for several co-registered inputs.
+    The first input is warped first and decides for all of them: if its tile
+    contains no valid data (or only skipvalue) no input is warped any further
+    and no tile is written. Tiles of further inputs without valid data are not
+    written either.
+
+        @type warpers:      C{list}
+        @param warpers:     TileWarper of every input
+        @type filepaths:    C{list}
+        @param filepaths:   output tile of every input
+        @type bounds:       C{tuple/list}
+        @param bounds:      (xmin, ymin, xmax, ymax) of the tile in target coordinates
+        @type subcellfiles: C{list}
+        @param subcellfiles: candidate tiles of the subcells of every input; None at maxres
+        @type skipvalue:    C{float}
+        @param skipvalue:   value of the first input that marks a cell as empty
+        @rtype:             C{list}
+        @return:            'done', 'empty' or 'failed' for every input
+    '''
+    cellstr = getCellFromTilePath(filepaths[0])
+    statuses = []
+    for k in range(len(warpers)):
+        srcfiles = None
+        if subcellfiles is not None:
+            srcfiles = [f for f in subcellfiles[k] if os.path.isfile(f)]
+            if not srcfiles:
+                if k == 0: return ['empty'] * len(warpers)
+                statuses.append('empty')
+                continue
+        with timedStage('warp', cellstr, input = k) as event:
+            mem_ds = warpers[k].warpDataset(bounds, srcfiles)
+            event['status'] = 'done' if mem_ds is not None else 'failed'
+        if mem_ds is None:
+            if k == 0: return ['failed'] * len(warpers)
+            statuses.append('failed')
+            continue
+        with timedStage('emptycheck', cellstr, input = k) as event:
+            empty = isEmptyDataset(mem_ds) or (k == 0 and skipvalue is not None and isSkipDataset(mem_ds, skipvalue))
+            event['status'] = 'empty' if empty else 'done'
+        if empty:
+            if warpers[k].debug: print('Empty tile detected: %s' %(filepaths[k]))
+            if k == 0: return ['empty'] * len(warpers)
+            statuses.append('empty') # e.g. flats without data where the mask is valid
+            continue
+        with timedStage('write', cellstr, input = k) as event:
+            written = warpers[k].writeDataset(filepaths[k], mem_ds)
+            event['status'] = 'done' if written else 'failed'
+            if written: event['byteswritten'] = getFileSize(filepaths[k])
+        mem_ds = None
+        if written: statuses.append('done')
+        else: statuses.append('failed')
+    return statuses
+
+
+# TileWarper of the current worker process, see initWorkerWarper()
+_workerwarper = None
+
+def initWorkerWarper(*args):
+    ''' Pool initializer that creates one TileWarper per worker process, so that
+    each worker opens the source dataset only once '''
+    global _workerwarper
+    _workerwarper = TileWarper(*args)
+
+def warpCellWorker(filepath, bounds, subcellfiles = None):
+    ''' Create a single tile with the TileWarper of the current worker process,
+    see warpCell() '''
+    return warpCell(_workerwarper, filepath, bounds, subcellfiles)
+
+
+# TileWarper of every input of the current worker process, see initWorkerWarpers()
+_workerwarpers = []
+
+def initWorkerWarpers(warperargslist):
+    ''' Pool initializer that creates one TileWarper per input and worker process '''
+    global _workerwarpers
+    _workerwarpers = [TileWarper(*warperargs) for warperargs in warperargslist]
+
+def warpCellInputsWorker(filepaths, bounds, subcellfiles = None, skipvalue = None):
+    ''' Create the tiles of a single cell for all inputs with the TileWarpers
+    of the current worker process, see warpCellInputs() '''
+    return warpCellInputs(_workerwarpers, filepaths, bounds, subcellfiles, skipvalue)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Chunked storage of the data cube in Zarr arrays as an alternative to one KEA
+file per cell. Every cell is an array of shape (bands, y, x) with one
+compressed chunk per band and block, laid out like the KEA files. New layers
+are appended along the band (time) axis instead of rewriting the cell.
+
+"""
+# This file is part of scenzgrid-py
+# Copyright (C) 2014 Markus U. Mueller (muellerm AT landcareresearch DOT co DOT nz)
+# Copyright (C) 2014 Robert Gibb (gibbr AT landcareresearch DOT co DOT nz)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import numpy
+
+import osgeo.gdal as gdal
+from osgeo import gdal_array
+from gdalconst import *
+
+try: # optional, only needed for the Zarr cube
+    import zarr
+except ImportError:
+    zarr = None
+
+from data_utils import *
+
+ZARR_NAME = 'cube.zarr'
+
+
+def checkZarr():
+    ''' Exit with an error message if zarr is not installed '''
+    if zarr is None:
+        print("Error: the Zarr cube requires the zarr package")
+        sys.exit(1)
+
+
+def getZarrPath(outfileroot, c):
+    ''' Return the directory of the array of a cell within the Zarr cube of
+    outfileroot; the cells are nested like the KEA files, see getFilePath() '''
+    return os.path.join(outfileroot, ZARR_NAME, getFilePath(c)[:-len('.kea')])
+
+
+def readInputBands(inputfiles, layernames, bandnames = None):
+    ''' Open the input tiles of a cell and return (datasets, bands), where
+    bands holds (input, band, description, nodata, dtype) for every output band '''
+    src = []
+    bands = []
+    for j in range(len(inputfiles)):
+        src_ds = gdal.Open(inputfiles[j], GA_ReadOnly)
+        if src_ds is None:
+            print("Could not open the input image file: ", inputfiles[j])
+            return None, None
+        src.append(src_ds)
+        for b in range(1, src_ds.RasterCount+1):
+            band = src_ds.GetRasterBand(b)
+            if bandnames is not None: bandname = bandnames[j][b-1]
+            else: bandname = band.GetDescription()
+            bands.append((j, b, layernames[j] + ' ' + bandname, band.GetNoDataValue(),
+                          gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)))
+    return src, bands
+
+
+def getSourceStamps(inputfiles):
+    ''' Return [path, size, mtime] of every input tile, stored with a Zarr
+    array to recognise tiles that changed since they were written '''
+    stamps = []
+    for filepath in inputfiles:
+        stat = os.stat(filepath)
+        stamps.append([os.path.abspath(filepath), stat.st_size, int(stat.st_mtime)])
+    return stamps
+
+
+def writeZarrStack(arraypath, inputfiles, layernames, debug = False, bandnames = None, blocksize = 243):
+    ''' Write the stack of a cell into its Zarr array. If the array already
+    holds the leading bands of the stack (e.g. all but the newest scenes),
+    written from the same unchanged tiles, and the new bands fit into its data
+    type, only the missing bands are read and appended; otherwise the array is
+    rewritten.
+
+        @type arraypath:  C{str}
+        @param arraypath: directory of the array, see getZarrPath()
+        @type inputfiles: C{list}
+        @param inputfiles: input tiles in stacking order
+        @type layernames: C{list}
+        @param layernames: layer names of the input tiles
+        @type bandnames:  C{list}
+        @param bandnames: band descriptions of every input; read from the tiles if None
+        @rtype:           C{bool}
+        @return:          True if the array was written
+    '''
+    src, bands = readInputBands(inputfiles, layernames, bandnames)
+    if src is None:
+        return False
+    names = [band[2] for band in bands]
+    stamps = getSourceStamps(inputfiles)
+    ysize = src[0].RasterYSize
+    xsize = src[0].RasterXSize
+
+    first = 0
+    array = None
+    if os.path.exists(arraypath):
+        array = zarr.open_array(store = arraypath, mode = 'r+')
+        existing = list(array.attrs.get('bands', []))
+        sources = list(array.attrs.get('sources', []))
+        # the bands of the tiles the array was written from, which have to be unchanged
+        sourcebands = len([band for band in bands if band[0] < len(sources)])
+        if tuple(array.shape[1:]) == (ysize, xsize) and existing == names[:len(existing)] and \
+           sources == stamps[:len(sources)] and sourcebands == len(existing) and \
+           numpy.result_type(array.dtype, *[band[4] for band in bands[len(existing):]]) == array.dtype:
+            first = len(existing)
+            if first == len(names):
+                if debug: print('%s is up to date' %(arraypath))
+                return True
+        else:
+            array = None
+    if array is None:
+        dtype = numpy.result_type(*[band[4] for band in bands])
+        nodata = bands[0][3]
+        if nodata is None: nodata = 0
+        array = zarr.open_array(store = arraypath, mode = 'w', shape = (0, ysize, xsize),
+                                chunks = (1, blocksize, blocksize), dtype = dtype, fill_value = nodata)
+        array.attrs['geotransform'] = list(src[0].GetGeoTransform())
+        array.attrs['projection'] = src[0].GetProjection()
+    if debug: print('%s: writing bands %d to %d' %(arraypath, first+1, len(names)))
+
+    # grow the band axis once and fill the new bands one by one; existing chunks are not touched
+    array.resize((len(names), ysize, xsize))
+    buffer = numpy.empty((ysize, xsize), dtype = array.dtype)
+    for k in range(first, len(names)):
+        j, b = bands[k][:2]
+        src[j].GetRasterBand(b).ReadAsArray(buf_obj = buffer)
+        array[k] = buffer
+    src = None
+    array.attrs['bands'] = names
+    array.attrs['sources'] = stamps
+    array.attrs['nodata'] = [band[3] for band in bands]
+    return True
+
+
+def readZarrStack(arraypath):
+    ''' Return (array, band descriptions) of the Zarr array of a cell '''
+    array = zarr.open_array(store = arraypath, mode = 'r')
+    return array, list(array.attrs.get('bands', []))